@@ -0,0 +1,139 @@
+import time
+import threading
+
+# Admission control and per-client inbound rate limits for VMServer.
+#
+# Limits throttle rather than drop: a client over its frame or byte rate has its reader paused,
+# so its own TCP window fills and it slows down, while everyone else is unaffected. This bounds
+# how much broadcast fan-out (one CLIENT: line -> a frame to every socket) a single client causes.
+# All rates are read live from AdmissionControl, so console changes apply to connected clients.
+
+# Frames that carry upload payload are covered by the byte rate, not the frame rate
+BULK_FRAMES = (b'IMAGE_CHUNK:', b'BULK_SINK:', b'STREAM_FRAME:')
+
+
+class TokenBucket:
+    """Rate limiter that may go into debt; consume() returns how long the caller should wait"""
+
+    def __init__(self, rate, burst):
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+
+    def consume(self, amount, rate=None, burst=None):
+        with self.lock:
+            if rate is not None:
+                self.rate, self.burst = rate, burst
+            if not self.rate:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class ClientLimiter:
+    """One connection's frame and byte buckets"""
+
+    def __init__(self, control, address):
+        self.control = control
+        self.address = address
+        self.frames = TokenBucket(control.message_rate, control.message_burst)
+        self.bytes = TokenBucket(control.upload_rate, control.upload_rate)
+        self.throttled = 0  # Seconds this client's reader was paused
+
+    def admit_bytes(self, size):
+        """Seconds to pause before reading on, after size bytes arrived"""
+        control = self.control
+        return self.pause(self.bytes.consume(size, control.upload_rate, control.upload_rate), 'bytes')
+
+    def admit_frame(self, frame):
+        if frame.startswith(BULK_FRAMES):
+            return 0.0
+        control = self.control
+        return self.pause(self.frames.consume(1, control.message_rate, control.message_burst), 'frames')
+
+    def pause(self, delay, kind):
+        if delay > 0:
+            delay = min(delay, 5.0)
+            self.throttled += delay
+            self.control.count(f'throttled_{kind}', delay)
+            time.sleep(delay)
+        return delay
+
+
+class AdmissionControl:
+    """Connection cap, accept pacing and the per-client limits, plus their counters"""
+
+    def __init__(self, max_connections=100, accept_rate=50, message_rate=100, message_burst=200,
+                 upload_rate=0):
+        self.max_connections = max_connections
+        self.accept_rate = accept_rate  # New connections per second, 0 for no pacing
+        self.message_rate = message_rate  # Frames per second per client, 0 for no limit
+        self.message_burst = message_burst
+        self.upload_rate = upload_rate  # Inbound bytes per second per client, 0 for no limit
+        self.accepts = TokenBucket(accept_rate, accept_rate)
+        self.lock = threading.Lock()
+        self.metrics = {'accepted': 0, 'rejected_full': 0, 'accept_paced': 0.0,
+                        'throttled_frames': 0.0, 'throttled_bytes': 0.0,
+                        'throttle_events_frames': 0, 'throttle_events_bytes': 0}
+
+    def count(self, name, seconds):
+        with self.lock:
+            self.metrics[name] += seconds
+            kind = name.rsplit('_', 1)[1]
+            self.metrics[f'throttle_events_{kind}'] += 1
+
+    def pace_accept(self):
+        """Called before each accept(); bursts beyond accept_rate wait in the listen backlog"""
+        delay = self.accepts.consume(1, self.accept_rate, self.accept_rate)
+        if delay > 0:
+            with self.lock:
+                self.metrics['accept_paced'] += delay
+            time.sleep(delay)
+
+    def admit(self, connected):
+        """True if a new connection fits under max_connections"""
+        with self.lock:
+            if self.max_connections and connected >= self.max_connections:
+                self.metrics['rejected_full'] += 1
+                return False
+            self.metrics['accepted'] += 1
+            return True
+
+    def set_limit(self, name, value):
+        """Console: change one limit for new and connected clients"""
+        if name in ('msgs', 'messages'):
+            self.message_rate = value
+            self.message_burst = 2 * value
+        elif name == 'burst':
+            self.message_burst = value
+        elif name == 'upload':
+            self.upload_rate = value * 1e6
+        elif name in ('max', 'connections'):
+            self.max_connections = int(value)
+        elif name == 'accept':
+            self.accept_rate = value
+        else:
+            raise ValueError(f"unknown limit {name}")
+
+    def summary(self, limiters=()):
+        def per_second(value, unit):
+            return f"{value:g} {unit}/s" if value else "unlimited"
+        with self.lock:
+            m = dict(self.metrics)
+        lines = [f"Limits: max {self.max_connections or 'unlimited'} connections, accept "
+                 f"{per_second(self.accept_rate, 'conn')}, per client {per_second(self.message_rate, 'frames')} "
+                 f"(burst {self.message_burst:g}), upload "
+                 f"{per_second(self.upload_rate / 1e6, 'MB') if self.upload_rate else 'unlimited'}",
+                 f"Connections accepted {m['accepted']}, rejected (full) {m['rejected_full']}, "
+                 f"accept pacing {m['accept_paced']:.1f} s",
+                 f"Readers paused: frame rate {m['throttle_events_frames']}x / {m['throttled_frames']:.1f} s, "
+                 f"upload rate {m['throttle_events_bytes']}x / {m['throttled_bytes']:.1f} s"]
+        for limiter in sorted(limiters, key=lambda l: l.throttled, reverse=True)[:5]:
+            if limiter.throttled:
+                lines.append(f"  {limiter.address}: paused {limiter.throttled:.1f} s")
+        return "\n".join(lines)
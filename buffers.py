@@ -0,0 +1,217 @@
+import base64
+import tempfile
+import threading
+
+# Bounded inbound framing for the servers.
+#
+# Each connection keeps its partial (not yet newline-terminated) frame in memory only up to
+# connection_limit bytes, and all connections together only up to the process-wide limit.
+# A frame that grows past either is moved to an anonymous temp file and keeps arriving there.
+# Hard limits reject the connection: a single frame over max_frame, or more than spill_limit
+# bytes spilled to disk across all connections.
+
+MB = 1024 * 1024
+
+
+class InboundLimitError(Exception):
+    """A connection broke a hard inbound limit and should be rejected"""
+
+
+class MemoryBudget:
+    """Process-wide accounting of inbound buffer memory and spilled bytes, shared by every connection"""
+
+    def __init__(self, limit=256 * MB, connection_limit=1 * MB, max_frame=64 * MB, spill_limit=1024 * MB):
+        self.limit = limit
+        self.connection_limit = connection_limit
+        self.max_frame = max_frame
+        self.spill_limit = spill_limit
+        self.lock = threading.Lock()
+        self.used = 0
+        self.peak = 0
+        self.spilled = 0  # Bytes currently in temp files
+        self.spilled_frames = 0
+        self.spilled_bytes = 0
+        self.rejected = 0
+
+    def reserve(self, size):
+        with self.lock:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self, size):
+        with self.lock:
+            self.used -= size
+
+    def reserve_spill(self, size):
+        with self.lock:
+            if self.spilled + size > self.spill_limit:
+                raise InboundLimitError(f"server spill space exhausted ({self.spill_limit // MB} MB)")
+            self.spilled += size
+
+    def release_spill(self, size, completed=False):
+        with self.lock:
+            self.spilled -= size
+            if completed:
+                self.spilled_frames += 1
+                self.spilled_bytes += size
+
+    def record_rejection(self):
+        with self.lock:
+            self.rejected += 1
+
+    def summary(self):
+        with self.lock:
+            return (f"Inbound memory: {self.used / MB:.1f} / {self.limit / MB:.0f} MB "
+                    f"(peak {self.peak / MB:.1f} MB, {self.connection_limit / MB:g} MB per connection)\n"
+                    f"Spilled to disk: {self.spilled / MB:.1f} MB now, {self.spilled_frames} frames / "
+                    f"{self.spilled_bytes / MB:.1f} MB total (frame limit {self.max_frame / MB:g} MB)\n"
+                    f"Connections rejected for size: {self.rejected}")
+
+
+class SpilledFrame:
+    """A complete frame held in a temp file instead of memory (newline not included)"""
+
+    def __init__(self, file, size, head, budget):
+        self.file = file
+        self.size = size
+        self.head = head  # First bytes of the frame, enough to see its type and header fields
+        self.budget = budget
+
+    def startswith(self, prefix):
+        return self.head.startswith(prefix)
+
+    def chunks(self, offset=0, chunk_size=MB):
+        self.file.seek(offset)
+        while True:
+            chunk = self.file.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            self.budget.release_spill(self.size, completed=True)
+
+
+class FrameBuffer:
+    """Splits one connection's byte stream into newline frames within the budget"""
+
+    HEAD_SIZE = 1024
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.buffer = bytearray()
+        self.held = 0  # Bytes of buffer reserved from the budget
+        self.spill = None
+        self.spill_size = 0
+        self.spill_head = b""
+
+    def feed(self, data):
+        """Add received bytes; return the completed frames as bytes or SpilledFrame"""
+        frames = []
+        if self.spill is not None:
+            newline = data.find(b'\n')
+            if newline < 0:
+                self.spill_write(data)
+                return frames
+            self.spill_write(data[:newline])
+            frames.append(self.finish_spill())
+            data = data[newline + 1:]
+
+        scan_from = len(self.buffer)  # The held partial frame has no newline in it
+        self.buffer += data
+        start = 0
+        newline = self.buffer.find(b'\n', scan_from)
+        while newline >= 0:
+            frames.append(bytes(self.buffer[start:newline]))
+            start = newline + 1
+            newline = self.buffer.find(b'\n', start)
+        if start:
+            del self.buffer[:start]
+
+        if len(self.buffer) > self.budget.connection_limit or not self.hold(len(self.buffer)):
+            self.start_spill()
+        return frames
+
+    def hold(self, size):
+        """Move this connection's reservation to size bytes; False if the global budget is spent"""
+        if size > self.held:
+            if not self.budget.reserve(size - self.held):
+                return False
+        elif size < self.held:
+            self.budget.release(self.held - size)
+        self.held = size
+        return True
+
+    def start_spill(self):
+        self.spill = tempfile.TemporaryFile(prefix="frame_")
+        self.spill_size = 0
+        self.spill_head = b""
+        self.spill_write(bytes(self.buffer))
+        self.buffer = bytearray()
+        self.hold(0)
+
+    def spill_write(self, data):
+        if self.spill_size + len(data) > self.budget.max_frame:
+            raise InboundLimitError(f"frame larger than {self.budget.max_frame // MB} MB")
+        self.budget.reserve_spill(len(data))
+        if len(self.spill_head) < self.HEAD_SIZE:
+            self.spill_head += data[:self.HEAD_SIZE - len(self.spill_head)]
+        self.spill.write(data)
+        self.spill_size += len(data)
+
+    def finish_spill(self):
+        # The frame keeps its share of spill space until the handler closes it
+        frame = SpilledFrame(self.spill, self.spill_size, self.spill_head, self.budget)
+        self.spill = None
+        self.spill_size = 0
+        return frame
+
+    def close(self):
+        self.hold(0)
+        if self.spill is not None:
+            self.budget.release_spill(self.spill_size)
+            self.spill.close()
+            self.spill = None
+
+    def buffered(self):
+        return self.held + self.spill_size
+
+
+def decode_spilled_image(frame, prefix, path_for):
+    """Stream-decode a spilled '<prefix><filename>|<base64>' frame to path_for(filename); returns (filename, path)"""
+    separator = frame.head.find(b'|')
+    if not frame.startswith(prefix) or separator < 0:
+        raise ValueError("invalid image frame")
+    filename = frame.head[len(prefix):separator].decode('utf-8', errors='replace').strip()
+    path = path_for(filename)
+    pending = b""
+    with open(path, 'wb') as f:
+        for chunk in frame.chunks(offset=separator + 1):
+            pending += chunk.translate(None, b" \t\r")
+            usable = len(pending) - len(pending) % 4  # base64 decodes in 4 character groups
+            f.write(base64.b64decode(pending[:usable]))
+            pending = pending[usable:]
+        if pending:
+            f.write(base64.b64decode(pending))
+    return filename, path
+
+
+def add_budget_arguments(parser):
+    parser.add_argument('--memory-budget', type=float, default=256, metavar='MB',
+                        help="inbound buffer memory for all connections together (default: 256)")
+    parser.add_argument('--connection-buffer', type=float, default=1, metavar='MB',
+                        help="in-memory partial frame per connection before it spills to disk (default: 1)")
+    parser.add_argument('--max-frame', type=float, default=64, metavar='MB',
+                        help="largest single frame accepted, spilled or not (default: 64)")
+    parser.add_argument('--spill-limit', type=float, default=1024, metavar='MB',
+                        help="temp file space for spilled frames across connections (default: 1024)")
+
+
+def budget_from_args(args):
+    return MemoryBudget(int(args.memory_budget * MB), int(args.connection_buffer * MB),
+                        int(args.max_frame * MB), int(args.spill_limit * MB))
@@ -0,0 +1,89 @@
+import gzip
+import time
+import struct
+import threading
+
+# Capture files of inbound server traffic, written by VMServer --record and read by replay.py.
+#
+# gzip stream: MAGIC, then records of
+#   <kind:u8> <connection:u32> <seconds since capture start:f64> <length:u32> <frame bytes>
+# kind is OPEN (frame = peer address), FRAME (one newline-delimited frame, newline stripped) or CLOSE.
+
+MAGIC = b"VMCAP1\n"
+OPEN, FRAME, CLOSE = 0, 1, 2
+HEADER = struct.Struct('<BIdI')
+
+
+class CaptureWriter:
+    """Appends timestamped records from any thread to one capture file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'wb', compresslevel=1)  # Fast: recording must not slow the server
+        self.file.write(MAGIC)
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.next_connection = 0
+        self.frames = 0
+        self.bytes = 0
+
+    def open_connection(self, address):
+        with self.lock:
+            self.next_connection += 1
+            connection = self.next_connection
+        self.write(OPEN, connection, f"{address[0]}:{address[1]}".encode('ascii'))
+        return connection
+
+    def frame(self, connection, data):
+        self.write(FRAME, connection, data)
+
+    def frame_file(self, connection, frame):
+        """Record a buffers.SpilledFrame by copying it from its temp file"""
+        header = HEADER.pack(FRAME, connection, time.perf_counter() - self.start, frame.size)
+        with self.lock:
+            if self.file:
+                self.file.write(header)
+                for chunk in frame.chunks():
+                    self.file.write(chunk)
+                self.frames += 1
+                self.bytes += frame.size
+
+    def close_connection(self, connection):
+        self.write(CLOSE, connection, b"")
+
+    def write(self, kind, connection, data):
+        header = HEADER.pack(kind, connection, time.perf_counter() - self.start, len(data))
+        with self.lock:
+            if self.file:
+                self.file.write(header)
+                self.file.write(data)
+                if kind == FRAME:
+                    self.frames += 1
+                    self.bytes += len(data)
+
+    def close(self):
+        with self.lock:
+            if not self.file:
+                return
+            self.file.close()
+            self.file = None
+        print(f"Capture saved: {self.path} ({self.frames} frames, {self.bytes / 1e6:.1f} MB)")
+
+
+def read_capture(path):
+    """Yield (kind, connection, timestamp, data); a truncated file (server killed) ends early"""
+    with gzip.open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        try:
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                kind, connection, timestamp, length = HEADER.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    return
+                yield kind, connection, timestamp, data
+        except EOFError:
+            return
@@ -1,9 +1,18 @@
 import socket
 import threading
 import tkinter as tk
-from tkinter import scrolledtext, messagebox, filedialog
+from tkinter import scrolledtext, messagebox, filedialog, ttk
+from message_log import MessageLog
+from transfer import UploadQueue, UploadAssembler, format_queue_stats
+from content_cache import ContentCache, sha256_bytes
+from compression import FrameCompressor, available_codecs, negotiate, decompress_frame
+from handshake import hello_frame, parse_hello
+from stream import FrameSender, ScreenStreamer, LatestMailbox, SequenceFilter, parse_frame
+import image_prep
+import discovery
 import time
 import base64
+import io
 import os
 import json
 from datetime import datetime
@@ -13,15 +22,13 @@ try:
 except ImportError:
     PIL_AVAILABLE = False
 
-try:
-    import torch
-    import numpy as np
-    YOLO_AVAILABLE = True
-except ImportError:
-    YOLO_AVAILABLE = False
+import detector
+YOLO_AVAILABLE = detector.TORCH_AVAILABLE
 
 class WindowsClient:
-    def __init__(self):
+    def __init__(self, detector_backend="eager", num_threads=None, interop_threads=None,
+                 tile_threshold=2048, tile_overlap=0.2, server_detection=False, mirror_console=False,
+                 max_in_flight=4, preprocessor=None, preprocess=False, share_detections=False, max_rate=0):
         self.client_socket = None
         self.connected = False
         self.running = False
@@ -30,56 +37,99 @@ class WindowsClient:
         self.processed_images_dir = "processed_images"
         self.selected_image_path = None
         self.yolo_model = None
+        # Detector backend ('eager', 'torchscript' or 'quantized') and torch threading
+        self.detector_backend = detector_backend
+        self.num_threads = num_threads
+        self.interop_threads = interop_threads
+        # Images whose longest side exceeds tile_threshold px are detected in overlapping tiles
+        self.tile_threshold = tile_threshold
+        self.tile_overlap = tile_overlap
+        self.tiled_detector = None
+        # With server_detection the server broadcasts DETECTIONS frames and no local model is loaded
+        self.server_detection = server_detection
+        self.image_index = {}  # Image name -> local path, for drawing server detections
+        # Send our local detection results as compact DETECTIONS frames for peers to draw
+        self.share_detections = share_detections
+        self.mirror_console = mirror_console  # Also print every GUI message to stdout
+        self.send_lock = threading.Lock()  # Keeps frames from the GUI and upload threads whole
+        self.compressor = None  # Set when the server picks one of the codecs we offered
+        # Asked of the server in HELLO: cap on what it sends us in bytes/s (0: our fair share)
+        self.max_rate = max_rate
+        self.server_limits = {}  # The server's limits from its HELLO reply
+        # Optional downscale/recompress before upload, toggled from the GUI
+        self.preprocessor = preprocessor or image_prep.UploadPreprocessor()
+        self.preprocess_enabled = preprocess
+        # Uploads survive reconnects: unacknowledged files are re-sent on resume
+        self.upload_queue = UploadQueue(
+            self.send_frame, max_in_flight,
+            on_progress=lambda stats: self.root.after(0, self.update_upload_progress, stats),
+            on_file_done=self.upload_file_done,
+            prepare=self.prepare_upload
+        )
+        # Live streams: each stage keeps only the newest frame per stream, so latency can't build up
+        self.stream_sender = None
+        self.screen_streamer = None
+        self.stream_seq = SequenceFilter()
+        self.stream_inbox = LatestMailbox()  # Received, still base64
+        self.stream_detect_inbox = LatestMailbox()  # Decoded, waiting for the local model
+        self.stream_display = LatestMailbox()  # Decoded, waiting for the Tk thread
+        self.stream_display_scheduled = False
+        self.stream_display_lock = threading.Lock()
+        self.stream_muted = set()  # Streams whose window the user closed
+        self.stream_boxes = {}  # stream_id -> latest detections (local model or server DETECTIONS)
+        self.stream_windows = {}
         self.setup_directories()
+        # Content-addressed index of received images; re-pushed images are not downloaded again
+        self.cache = ContentCache(self.received_images_dir)
+        # Chunked SERVER_IMAGE_* downloads, reassembled like the server does uploads
+        self.downloads = UploadAssembler(os.path.join(self.received_images_dir, ".partial"))
         self.setup_yolo()
         self.setup_gui()
+        if PIL_AVAILABLE:
+            threading.Thread(target=self.stream_decode_loop, daemon=True).start()
+        if self.yolo_model:
+            threading.Thread(target=self.stream_detect_loop, daemon=True).start()
         
     def setup_directories(self):
         """Create directories for storing images"""
         os.makedirs(self.received_images_dir, exist_ok=True)
         os.makedirs(self.processed_images_dir, exist_ok=True)
     
-    def detect_best_ip(self):
-        """Detect the best default IP address to use"""
-        try:
-            import socket
-            import subprocess
-            
-            # Try to get local IP addresses
+    def find_servers(self, auto=False):
+        """Look for servers with a UDP discovery probe in the background, then fill in the best one"""
+        def probe():
             try:
-                if os.name == 'nt':  # Windows
-                    result = subprocess.run(['ipconfig'], capture_output=True, text=True)
-                    if result.returncode == 0:
-                        lines = result.stdout.split('\n')
-                        for line in lines:
-                            if 'IPv4 Address' in line and '192.168.56' in line:
-                                return "192.168.56.1"  # VM network
-                            elif 'IPv4 Address' in line and '172.' in line:
-                                return "172.20.10.7"  # Mobile hotspot - use VM IP
-                            elif 'IPv4 Address' in line and '192.168.1' in line:
-                                return "192.168.56.1"  # Home network - use VM IP
-                else:  # Linux/Mac
-                    result = subprocess.run(['ip', 'addr'], capture_output=True, text=True)
-                    if result.returncode == 0:
-                        lines = result.stdout.split('\n')
-                        for line in lines:
-                            if 'inet ' in line and '192.168.56' in line:
-                                return "192.168.56.1"
-                            elif 'inet ' in line and '172.' in line:
-                                return "172.20.10.7"
-                            elif 'inet ' in line and '192.168.1' in line:
-                                return "192.168.56.1"
-            except:
-                pass
-                
-            # Fallback to VM IP if we can't detect
-            return "172.20.10.7"
-            
-        except:
-            return "172.20.10.7"
+                results = [r for r in discovery.discover() if r.get('service') == 'vm']
+            except Exception as e:
+                results = []
+                print(f"Discovery failed: {e}")
+            self.root.after(0, self.apply_discovery, results, auto)
+        if not auto:
+            self.add_message("Searching the LAN for servers...", "system")
+        threading.Thread(target=probe, daemon=True).start()
+    
+    def apply_discovery(self, results, auto):
+        """Show discovered servers and put the lowest-RTT one in the address fields"""
+        if not results:
+            if not auto:
+                self.add_message("No servers answered discovery; enter the VM IP manually", "error")
+            return
+        for reply in results:
+            self.add_message(f"Found server {discovery.format_server(reply)}", "system")
+        # Leave the fields alone once connected or if the user already typed an address
+        if self.connected or (auto and self.ip_entry.get().strip() != self.default_ip):
+            return
+        best = results[0]
+        self.ip_entry.delete(0, tk.END)
+        self.ip_entry.insert(0, best['address'])
+        self.port_entry.delete(0, tk.END)
+        self.port_entry.insert(0, str(best['port']))
     
     def setup_yolo(self):
-        """Initialize YOLOv5 model"""
+        """Initialize YOLOv5 model on the configured detector backend"""
+        if self.server_detection:
+            print("Using server-side detections - local YOLOv5 model not loaded")
+            return
         if not YOLO_AVAILABLE:
             print("YOLO not available - install torch and numpy")
             return
@@ -90,10 +140,12 @@ class WindowsClient:
             
             # Check if YOLO model file exists
             if os.path.exists(model_path):
-                # Load YOLOv5 model
-                self.yolo_model = torch.hub.load('ultralytics/yolov5', 'custom', path=model_path)
-                self.yolo_model.eval()  # Set to evaluation mode
-                print("YOLOv5 model loaded successfully!")
+                detector.configure_threads(self.num_threads, self.interop_threads)
+                self.yolo_model = detector.create_backend(self.detector_backend, model_path)
+                self.tiled_detector = detector.TiledDetector(
+                    self.yolo_model, threshold=self.tile_threshold, overlap=self.tile_overlap
+                )
+                print(f"YOLOv5 model loaded successfully! (backend: {self.detector_backend})")
             else:
                 print("YOLOv5 model file not found. Download yolov5s.pt")
                 print("Auto-detection will be disabled.")
@@ -103,78 +155,74 @@ class WindowsClient:
             print(f"Failed to load YOLOv5 model: {e}")
             self.yolo_model = None
     
-    def detect_objects(self, image_path):
-        """Run YOLOv5 object detection on image"""
+    def detect_objects(self, image_path, image_ref=None):
+        """Run YOLOv5 object detection on image; image_ref=(name, sha256) allows sharing the results"""
         if not self.yolo_model:
             return None, "YOLOv5 model not available"
             
         try:
             print(f"🔍 YOLOv5: Starting object detection on {os.path.basename(image_path)}")
             
-            # Run YOLOv5 inference
-            results = self.yolo_model(image_path)
-            
-            # Parse results
-            detections = []
-            for *box, conf, cls in results.xyxy[0].cpu().numpy():
-                if conf > 0.3:  # Confidence threshold
-                    x1, y1, x2, y2 = map(int, box)
-                    label = self.yolo_model.names[int(cls)]
-                    detections.append({
-                        'label': label,
-                        'confidence': float(conf),
-                        'box': [x1, y1, x2 - x1, y2 - y1]  # Convert to x, y, w, h format
-                    })
-            
-            print(f"🎯 YOLOv5: Detected {len(detections)} objects")
+            # Run inference on the selected backend, tiled for very large images
+            detections, stats = self.tiled_detector.detect(image_path)
+            elapsed_ms = stats['latency_ms']
+            tiles_note = f" over {stats['tiles']} tiles" if stats['tiles'] else ""
+            
+            print(f"🎯 YOLOv5: Detected {len(detections)} objects{tiles_note} in {elapsed_ms:.0f} ms")
             for det in detections:
                 print(f"   - {det['label']}: {det['confidence']:.2f}")
             
             # Draw detections on image
             processed_image_path = self.draw_detections_pil(image_path, detections)
+            if image_ref and self.share_detections:
+                self.send_detections(image_ref, image_path, detections)
             
-            return processed_image_path, f"Detected {len(detections)} objects"
+            return processed_image_path, f"Detected {len(detections)} objects{tiles_note} in {elapsed_ms:.0f} ms"
             
         except Exception as e:
             print(f"❌ YOLOv5: Detection failed: {e}")
             return None, f"Detection failed: {e}"
     
+    def draw_boxes(self, image, detections):
+        """Draw bounding boxes and labels onto a PIL image in place"""
+        draw = ImageDraw.Draw(image)
+        
+        # Generate colors for different classes
+        colors = ['red', 'blue', 'green', 'yellow', 'purple', 'orange', 'pink', 'brown']
+        
+        for i, detection in enumerate(detections):
+            x, y, w, h = detection['box']
+            label = detection['label']
+            confidence = detection['confidence']
+            
+            # Get color for this detection
+            color = colors[i % len(colors)]
+            
+            # Draw bounding box
+            draw.rectangle([x, y, x + w, y + h], outline=color, width=3)
+            
+            # Draw label with confidence
+            label_text = f"{label}: {confidence:.2f}"
+            
+            try:
+                # Try to use a default font
+                font = ImageFont.load_default()
+            except:
+                font = None
+            
+            # Draw label background
+            bbox = draw.textbbox((x, y - 20), label_text, font=font)
+            draw.rectangle(bbox, fill=color)
+            
+            # Draw label text
+            draw.text((x, y - 20), label_text, fill='white', font=font)
+    
     def draw_detections_pil(self, original_path, detections):
         """Draw bounding boxes and labels on image using PIL"""
         try:
             # Open image with PIL
             image = Image.open(original_path)
-            draw = ImageDraw.Draw(image)
-            
-            # Generate colors for different classes
-            colors = ['red', 'blue', 'green', 'yellow', 'purple', 'orange', 'pink', 'brown']
-            
-            for i, detection in enumerate(detections):
-                x, y, w, h = detection['box']
-                label = detection['label']
-                confidence = detection['confidence']
-                
-                # Get color for this detection
-                color = colors[i % len(colors)]
-                
-                # Draw bounding box
-                draw.rectangle([x, y, x + w, y + h], outline=color, width=3)
-                
-                # Draw label with confidence
-                label_text = f"{label}: {confidence:.2f}"
-                
-                try:
-                    # Try to use a default font
-                    font = ImageFont.load_default()
-                except:
-                    font = None
-                
-                # Draw label background
-                bbox = draw.textbbox((x, y - 20), label_text, font=font)
-                draw.rectangle(bbox, fill=color)
-                
-                # Draw label text
-                draw.text((x, y - 20), label_text, fill='white', font=font)
+            self.draw_boxes(image, detections)
             
             # Save processed image
             base_name = os.path.splitext(os.path.basename(original_path))[0]
@@ -202,9 +250,9 @@ class WindowsClient:
         self.ip_entry = tk.Entry(conn_frame, width=20)
         self.ip_entry.pack(side='left', padx=5)
         
-        # Try to detect the best default IP
-        default_ip = self.detect_best_ip()
-        self.ip_entry.insert(0, default_ip)
+        # Replaced by the best discovered server once the background probe answers
+        self.default_ip = "127.0.0.1"
+        self.ip_entry.insert(0, self.default_ip)
         
         tk.Label(conn_frame, text="Port:").pack(side='left', padx=(10,0))
         self.port_entry = tk.Entry(conn_frame, width=8)
@@ -224,6 +272,9 @@ class WindowsClient:
                                    font=('Arial', 8), width=2)
         self.network_btn.pack(side='left', padx=2)
         
+        self.find_btn = tk.Button(conn_frame, text="Find", command=self.find_servers, font=('Arial', 8))
+        self.find_btn.pack(side='left', padx=2)
+        
         self.status_label = tk.Label(conn_frame, text="Disconnected", fg="red")
         self.status_label.pack(side='right')
         
@@ -237,6 +288,7 @@ class WindowsClient:
             bg='#f0f0f0'
         )
         self.message_area.pack(fill='both', expand=True, pady=5)
+        self.message_log = MessageLog(self.root, self.message_area, mirror_console=self.mirror_console)
 
         # Image controls frame
         image_frame = tk.Frame(self.root)
@@ -246,6 +298,17 @@ class WindowsClient:
         self.select_image_btn = tk.Button(image_frame, text="Select Image", command=self.select_image, state='disabled')
         self.select_image_btn.pack(side='left', padx=5)
         
+        self.batch_upload_btn = tk.Button(image_frame, text="Batch...", command=self.batch_upload, state='disabled')
+        self.batch_upload_btn.pack(side='left', padx=2)
+        self.folder_upload_btn = tk.Button(image_frame, text="Folder...", command=lambda: self.batch_upload(folder=True), state='disabled')
+        self.folder_upload_btn.pack(side='left', padx=2)
+        self.share_screen_btn = tk.Button(image_frame, text="Share Screen", command=self.toggle_screen_share, state='disabled')
+        self.share_screen_btn.pack(side='left', padx=2)
+        
+        self.preprocess_var = tk.BooleanVar(value=self.preprocess_enabled)
+        tk.Checkbutton(image_frame, text=f"Shrink to {self.preprocessor.max_dimension}px",
+                       variable=self.preprocess_var, command=self.toggle_preprocess).pack(side='left', padx=2)
+        
         self.selected_file_label = tk.Label(image_frame, text="No image selected", fg="gray")
         self.selected_file_label.pack(side='left', padx=5)
         
@@ -258,6 +321,17 @@ class WindowsClient:
         self.view_processed_btn = tk.Button(image_frame, text="View Detected", command=self.view_processed_images, state='disabled')
         self.view_processed_btn.pack(side='right', padx=5)
         
+        # Upload progress, throughput and cancel
+        progress_frame = tk.Frame(self.root)
+        progress_frame.pack(fill='x', padx=10)
+        
+        self.upload_progress = ttk.Progressbar(progress_frame, mode='determinate', maximum=100)
+        self.upload_progress.pack(side='left', fill='x', expand=True)
+        self.upload_status_label = tk.Label(progress_frame, text="", fg="gray", width=32, anchor='w')
+        self.upload_status_label.pack(side='left', padx=5)
+        self.cancel_upload_btn = tk.Button(progress_frame, text="Cancel Upload", command=self.cancel_upload, state='disabled')
+        self.cancel_upload_btn.pack(side='right')
+        
         # Input area for sending text messages
         input_frame = tk.Frame(self.root)
         input_frame.pack(pady=5, fill='x', padx=10)
@@ -325,6 +399,9 @@ class WindowsClient:
             self.input_entry.config(state='normal')
             self.send_btn.config(state='normal')
             self.select_image_btn.config(state='normal')
+            self.batch_upload_btn.config(state='normal')
+            self.folder_upload_btn.config(state='normal')
+            self.share_screen_btn.config(state='normal')
             self.view_images_btn.config(state='normal')
             self.view_processed_btn.config(state='normal')
             if self.selected_image_path:
@@ -336,6 +413,17 @@ class WindowsClient:
             receive_thread.daemon = True
             receive_thread.start()
             
+            # Ask for IMAGE_OFFER instead of full pushes so cached images are not re-sent,
+            # and for chunked downloads we can resume after a disconnect. HELLO also carries our
+            # version and limits; FEATURES is for servers from before HELLO (each server answers one)
+            features = ['offers', 'chunked', 'resume'] + available_codecs()
+            self.send_frame(hello_frame(features, {'max_rate': self.max_rate}, client="client.py"))
+            self.send_frame(f"FEATURES:{','.join(features)}\n".encode('utf-8'))
+            
+            # Continue any upload batch interrupted by a previous disconnect, once the server's
+            # reply says whether it can dedup and resume (apply_server_features)
+            self.upload_queue.await_features()
+            
         except Exception as e:
             error_msg = str(e)
             if "Connection refused" in error_msg:
@@ -367,6 +455,12 @@ class WindowsClient:
                 # Process complete frames from buffer (ending with \n)
                 while b'\n' in buffer:
                     line_bytes, buffer = buffer.split(b'\n', 1)
+                    if line_bytes.startswith(b'ZFRAME:'):
+                        try:
+                            line_bytes = decompress_frame(line_bytes)
+                        except Exception as e:
+                            print(f"Bad compressed frame: {e}")
+                            continue
                     try:
                         line = line_bytes.decode('utf-8').strip()
                     except UnicodeDecodeError:
@@ -392,19 +486,94 @@ class WindowsClient:
                             self.handle_received_image(data, "server")
                         self.root.after(0, lambda: handle_image(image_data))
                         
+                    elif line.startswith(('SERVER_IMAGE_BEGIN:', 'SERVER_IMAGE_CHUNK:', 'SERVER_IMAGE_END:')):
+                        # Chunked server image; chat frames can arrive between its chunks
+                        self.handle_download_frame(line)
+                        
+                    elif line.startswith('IMAGE_OFFER:'):
+                        # Server is pushing an image: fetch it only if we don't hold these bytes
+                        self.handle_image_offer(line[12:])
+                    
+                    elif line.startswith('NOT_MODIFIED:'):
+                        filename = line[13:].split('|', 1)[0]
+                        self.add_message(f"📷 {filename} unchanged, using cached copy", "system")
+                        
                     elif line.startswith('IMAGE_LIST:'):
                         # Handle server images list (for future use)
                         data = line[11:]  # Remove 'IMAGE_LIST:' prefix
                         try:
                             image_list = json.loads(data)
-                            self.root.after(0, lambda lst=image_list: self.add_message(f"Server has {len(lst)} images available", "system"))
+                            self.add_message(f"Server has {len(image_list)} images available", "system")
                         except:
                             pass
                             
                     elif line.startswith('IMAGE_ERROR:'):
                         # Handle image error
                         error = line[12:]  # Remove 'IMAGE_ERROR:' prefix
-                        self.root.after(0, lambda err=error: self.add_message(f"Image Error: {err}", "error"))
+                        self.add_message(f"Image Error: {error}", "error")
+                    
+                    elif line.startswith('CONNECTION_REJECTED:'):
+                        # Server hit a hard limit for this connection and is closing it
+                        self.add_message(f"Server closed the connection: {line[20:]}", "error")
+                    
+                    elif line.startswith('IMAGE_DONE:'):
+                        # Server stored one of our chunked uploads
+                        self.upload_queue.acknowledge(line[11:])
+                    
+                    elif line.startswith('IMAGE_FAILED:'):
+                        transfer_id, _, reason = line[13:].partition('|')
+                        self.upload_queue.fail(transfer_id, reason)
+                    
+                    elif line.startswith('IMAGE_MISSING:'):
+                        # Server doesn't have the bytes we offered by hash; upload them
+                        self.upload_queue.missing(line[14:])
+                    
+                    elif line.startswith('FEATURES:'):
+                        # Features the server supports; dedup lets uploads of known content be skipped
+                        self.apply_server_features({f.strip() for f in line[9:].split(',')})
+                    
+                    elif line.startswith('HELLO:'):
+                        # Handshake reply: the server's version, the features this connection uses, its limits
+                        try:
+                            version, features, limits, body = parse_hello(line[6:])
+                        except (ValueError, TypeError) as e:
+                            print(f"Bad HELLO from server: {e}")
+                            continue
+                        self.server_limits = limits
+                        self.add_message(f"Server {body.get('server', '?')} (protocol {version}): "
+                                         f"{', '.join(sorted(features)) or 'no optional features'}", "system")
+                        self.apply_server_features(features)
+                    
+                    elif line.startswith('IMAGE_OFFSET:'):
+                        # Server has this much of an interrupted upload; the rest follows
+                        transfer_id, _, offset = line[13:].partition('|')
+                        self.upload_queue.offset_reply(transfer_id, offset)
+                    
+                    elif line.startswith('SERVER_IMAGE_CANCEL:'):
+                        # An interrupted download can't be resumed (the image changed or is gone)
+                        transfer_id, _, reason = line[20:].partition('|')
+                        self.downloads.cancel("server", transfer_id)
+                        self.add_message(f"Download not resumed: {reason}", "system")
+                    
+                    elif line.startswith('STREAM_FRAME:'):
+                        # Live frame: only the newest one per stream is ever decoded
+                        try:
+                            stream_id, seq, data = parse_frame(line[13:])
+                        except ValueError as e:
+                            print(f"Bad stream frame: {e}")
+                            continue
+                        if self.stream_seq.accept(stream_id, seq):
+                            self.stream_inbox.put(stream_id, (seq, data))
+                    
+                    elif line.startswith('STREAM_END:'):
+                        stream_id = line[11:]
+                        self.stream_seq.forget(stream_id)
+                        self.stream_inbox.put(stream_id, None)
+                    
+                    elif line.startswith('DETECTIONS:'):
+                        # Server-side detection results for an image
+                        payload = line[11:]  # Remove 'DETECTIONS:' prefix
+                        self.root.after(0, lambda data=payload: self.handle_detections(data))
                 
                 # Only trim buffer if no complete message is waiting (to avoid breaking large images)
                 if len(buffer) > 3145728 and b'\n' not in buffer:  # 3MB and no complete message
@@ -417,11 +586,11 @@ class WindowsClient:
                 if self.running:
                     print(f"Receive error: {e}")
                     err_text = f"Connection error: {e}"
-                    self.root.after(0, lambda msg=err_text: self.add_message(msg, "error"))
+                    self.add_message(err_text, "error")
                 break
 
         if self.running:
-            self.root.after(0, lambda: self.add_message("Connection lost to VM server", "error"))
+            self.add_message("Connection lost to VM server", "error")
             self.root.after(0, self.cleanup_connection)
     
     def process_text_message(self, payload):
@@ -432,7 +601,7 @@ class WindowsClient:
                 data = payload[15:]  # Remove 'IMAGE_RECEIVED:' prefix
                 if '|' in data:
                     sender_ip, filename = data.split('|', 1)
-                    self.root.after(0, lambda: self.add_message(f"📷 Image received from {sender_ip}: {filename}", "system"))
+                    self.add_message(f"📷 Image received from {sender_ip}: {filename}", "system")
                 return
             
             # Process regular text messages
@@ -450,13 +619,13 @@ class WindowsClient:
             if has_sender:
                 # Identify if this message is ours
                 if self.local_ip and sender == self.local_ip:
-                    self.root.after(0, lambda msg=text: self.add_message(msg, "you"))
+                    self.add_message(text, "you")
                 else:
                     display_sender = sender if sender else "Peer"
-                    self.root.after(0, lambda snd=display_sender, msg=text: self.add_message(f"{snd}: {msg}", "peer"))
+                    self.add_message(f"{display_sender}: {text}", "peer")
             else:
                 # Treat entire payload as plain VM text
-                self.root.after(0, lambda msg=payload: self.add_message(msg, "vm"))
+                self.add_message(payload, "vm")
     
     def handle_received_image(self, image_data, source):
         """Handle received image data"""
@@ -493,6 +662,66 @@ class WindowsClient:
                 self.add_message(f"Image decode error: {decode_error}", "error")
                 return
             
+            self.save_received_image(filename, image_bytes, source)
+            
+        except Exception as e:
+            print(f"Error in handle_received_image: {e}")
+            import traceback
+            traceback.print_exc()
+            self.add_message(f"Error saving image: {e}", "error")
+    
+    def handle_download_frame(self, line):
+        """SERVER_IMAGE_BEGIN/CHUNK/END from the server, written to a partial file until complete"""
+        command, payload = line.split(':', 1)
+        try:
+            if command == 'SERVER_IMAGE_BEGIN':
+                self.downloads.begin("server", payload)
+            elif command == 'SERVER_IMAGE_CHUNK':
+                self.downloads.chunk("server", payload)
+            else:
+                filename, temp_path, _ = self.downloads.end("server", payload)
+                with open(temp_path, 'rb') as f:
+                    image_bytes = f.read()
+                os.remove(temp_path)
+                self.root.after(0, self.save_received_image, filename, image_bytes, "server")
+        except Exception as e:
+            self.add_message(f"Image download failed: {e}", "error")
+    
+    def apply_server_features(self, features):
+        self.upload_queue.server_features(features)
+        codec = negotiate(features)
+        self.compressor = FrameCompressor(codec) if codec else None
+        if 'resume' in features:
+            self.resume_downloads()
+    
+    def resume_downloads(self):
+        """Ask for the rest of every chunked download a previous connection left unfinished"""
+        for transfer_id, meta, received in self.downloads.partials():
+            if not meta.get('sha256'):
+                self.downloads.cancel("server", transfer_id)  # From a server that can't resume
+                continue
+            try:
+                offset = self.downloads.resume("server", transfer_id)
+            except ValueError:
+                continue
+            if offset is None:
+                continue
+            self.send_frame(f"SERVER_IMAGE_RESUME:{transfer_id}|{meta['filename']}|{meta['sha256']}|{offset}\n"
+                            .encode('utf-8'))
+            self.add_message(f"📷 Resuming download of {meta['filename']} at {offset // 1024} KB", "system")
+    
+    def save_received_image(self, filename, image_bytes, source):
+        """Store decoded image bytes (unless already cached) and run local detection"""
+        try:
+            # Same bytes already on disk: just record the name, don't store a duplicate
+            digest = sha256_bytes(image_bytes)
+            cached_path = self.cache.lookup(digest)
+            if cached_path:
+                self.cache.remember(filename, digest)
+                self.image_index[filename] = cached_path
+                self.add_message(f"📷 {filename} already cached as {os.path.basename(cached_path)}", "system")
+                return
+            
             # Generate unique filename with timestamp
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             saved_filename = f"{timestamp}_{source}_{filename}"
@@ -503,17 +732,21 @@ class WindowsClient:
             # Save image to file
             with open(filepath, 'wb') as f:
                 f.write(image_bytes)
+            self.cache.add(filepath, name=filename, data=image_bytes)
             
             # Verify file was created
             if os.path.exists(filepath):
                 file_size = os.path.getsize(filepath)
                 print(f"Image successfully saved: {saved_filename} ({file_size} bytes)")
                 self.add_message(f"📷 Image saved: {saved_filename} ({file_size} bytes)", "system")
+                self.image_index[filename] = filepath
                 
                 # Automatically run YOLO detection on received image
-                if self.yolo_model:
+                if self.server_detection:
+                    pass  # Overlay is drawn when the server's DETECTIONS frame arrives
+                elif self.yolo_model:
                     self.add_message("🔍 Running YOLO object detection...", "system")
-                    processed_path, result_msg = self.detect_objects(filepath)
+                    processed_path, result_msg = self.detect_objects(filepath, (filename, digest))
                     if processed_path:
                         self.add_message(f"🎯 YOLO: {result_msg}", "system")
                         self.add_message(f"💾 Processed image saved", "system")
@@ -526,11 +759,66 @@ class WindowsClient:
                 self.add_message("Failed to save image file", "error")
             
         except Exception as e:
-            print(f"Error in handle_received_image: {e}")
+            print(f"Error in save_received_image: {e}")
             import traceback
             traceback.print_exc()
             self.add_message(f"Error saving image: {e}", "error")
     
+    def handle_image_offer(self, payload):
+        """IMAGE_OFFER:<filename>|<sha256>|<size> - request the image unless it is already cached"""
+        try:
+            filename, digest, size = payload.split('|')
+        except ValueError:
+            self.add_message("Invalid image offer received", "error")
+            return
+        cached_path = self.cache.lookup(digest)
+        if cached_path:
+            self.cache.remember(filename, digest)
+            self.image_index[filename] = cached_path
+            self.add_message(f"📷 Server pushed {filename}, already cached", "system")
+            return
+        try:
+            self.send_frame(f"REQUEST_IMAGE:{filename}\n".encode('utf-8'))
+            print(f"Requesting offered image {filename} ({size} bytes)")
+        except Exception as e:
+            self.add_message(f"Failed to request image {filename}: {e}", "error")
+    
+    def send_detections(self, image_ref, image_path, detections):
+        """Share results as a DETECTIONS frame: peers draw them on their own copy of the image"""
+        image_name, image_hash = image_ref
+        try:
+            with Image.open(image_path) as image:
+                size = image.size
+            payload = detector.encode_detections(image_name, size, detections, image_hash)
+            self.send_frame(f"DETECTIONS:{payload}\n".encode('utf-8'))
+            self.add_message(f"📤 Shared {len(detections)} detections for {image_name} ({len(payload)} bytes)", "system")
+        except Exception as e:
+            self.add_message(f"Failed to share detections: {e}", "error")
+    
+    def handle_detections(self, payload):
+        """Draw a DETECTIONS frame (from the server or a peer) onto the local copy of the image"""
+        try:
+            image_name, _, detections, image_hash = detector.decode_detections(payload)
+        except Exception as e:
+            self.add_message(f"Invalid detections frame: {e}", "error")
+            return
+        
+        if image_name.startswith('stream:'):
+            # stream:<stream_id>#<seq> - overlay the boxes on the live view, no log line per frame
+            self.stream_boxes[image_name[7:].split('#', 1)[0]] = detections
+            return
+        
+        labels = ", ".join(sorted({d['label'] for d in detections})) or "nothing"
+        self.add_message(f"🎯 Server detected {len(detections)} objects in {image_name}: {labels}", "system")
+        
+        # Prefer the content hash: our copy may be stored under a different name
+        local_path = (image_hash and self.cache.lookup(image_hash)) or self.image_index.get(image_name)
+        if local_path and os.path.exists(local_path) and PIL_AVAILABLE:
+            if self.draw_detections_pil(local_path, detections):
+                self.add_message(f"💾 Overlay drawn for {image_name}", "system")
+        else:
+            self.add_message(f"No local copy of {image_name} to draw detections on", "system")
+    
     def add_message(self, message, msg_type="vm"):
         timestamp = time.strftime("%H:%M:%S")
         
@@ -547,9 +835,8 @@ class WindowsClient:
         else:
             formatted_msg = f"[{timestamp}] {message}\n"
         
-        self.message_area.insert(tk.END, formatted_msg)
-        self.message_area.see(tk.END)
-        print(f"GUI Updated: {formatted_msg.strip()}")
+        # Safe from any thread: lines are coalesced into one widget update per frame
+        self.message_log.append(formatted_msg)
 
     def send_message(self):
         if not (self.connected and self.client_socket):
@@ -559,11 +846,20 @@ class WindowsClient:
             return
         try:
             frame = f"CLIENT:{text}\n".encode('utf-8')
-            self.client_socket.sendall(frame)
+            self.send_frame(frame)
             self.input_entry.delete(0, tk.END)
         except Exception as e:
             self.add_message(f"Send failed: {e}", "error")
     
+    def send_frame(self, frame):
+        """Send one complete frame from any thread without interleaving with other frames"""
+        with self.send_lock:
+            if not self.client_socket:
+                raise ConnectionError("Not connected")
+            if self.compressor:
+                frame = self.compressor.compress(frame)
+            self.client_socket.sendall(frame)
+    
     def select_image(self):
         """Select an image file to send"""
         if not PIL_AVAILABLE:
@@ -599,29 +895,163 @@ class WindowsClient:
             self.show_pillow_warning()
             return
             
-        try:
-            # Read image file
-            with open(self.selected_image_path, 'rb') as f:
-                image_data = f.read()
-            
-            # Encode image as base64
-            base64_data = base64.b64encode(image_data).decode('utf-8')
-            filename = os.path.basename(self.selected_image_path)
-            
-            # Send image to server
-            message = f"IMAGE:{filename}|{base64_data}\n"
-            self.client_socket.send(message.encode('utf-8'))
-            
+        # Stream the file in chunks on the background upload queue
+        path = self.selected_image_path
+        self.upload_queue.add([path])
+        self.add_message(f"📷 Uploading {os.path.basename(path)}...", "system")
+        
+        # Clear selection
+        self.selected_image_path = None
+        self.selected_file_label.config(text="No image selected", fg="gray")
+        self.send_image_btn.config(state='disabled')
+    
+    def batch_upload(self, folder=False):
+        """Queue several files, or every image in a folder, for pipelined upload"""
+        if folder:
+            directory = filedialog.askdirectory(title="Select Folder to Upload")
+            if not directory:
+                return
+            paths = sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                           if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')))
+        else:
+            paths = filedialog.askopenfilenames(
+                title="Select Images to Send",
+                filetypes=[("Image files", "*.png *.jpg *.jpeg *.gif *.bmp"), ("All files", "*.*")]
+            )
+        if paths:
+            added = self.upload_queue.add(paths)
+            self.add_message(f"📷 Queued {added} images for upload", "system")
+    
+    def update_upload_progress(self, stats):
+        """Show aggregate upload progress, throughput and ETA"""
+        total = stats['bytes_total']
+        self.upload_progress['value'] = stats['bytes_sent'] * 100 / total if total else 0
+        self.upload_status_label.config(text=format_queue_stats(stats), fg="black")
+        self.cancel_upload_btn.config(state='normal' if stats['active'] else 'disabled')
+    
+    def upload_file_done(self, status, path, message):
+        """Per-file result from the upload queue (any thread)"""
+        filename = os.path.basename(path)
+        if status == 'done':
             self.add_message(f"📷 Image sent: {filename}", "you")
+            self.image_index[filename] = path
+        elif status == 'cancelled':
+            self.add_message(message, "system")
+        else:
+            self.add_message(f"Image send failed: {filename}: {message}", "error")
+    
+    def cancel_upload(self):
+        self.upload_queue.cancel()
+    
+    def toggle_preprocess(self):
+        # Mirrored into a plain attribute because the upload thread can't read Tk variables
+        self.preprocess_enabled = self.preprocess_var.get()
+    
+    def prepare_upload(self, path):
+        """Upload queue hook (background thread): shrink and recompress the image if enabled"""
+        if self.preprocess_enabled and PIL_AVAILABLE:
+            return self.preprocessor(path)
+        return path, None
+    
+    def toggle_screen_share(self):
+        """Start or stop streaming this screen to the other clients"""
+        if self.screen_streamer:
+            self.stop_screen_share()
+            return
+        if not PIL_AVAILABLE:
+            messagebox.showerror("Error", "Pillow is required for screen sharing")
+            return
+        self.stream_sender = FrameSender(self.send_frame)
+        self.screen_streamer = ScreenStreamer(self.stream_sender)
+        self.share_screen_btn.config(text="Stop Sharing")
+        self.add_message(f"Sharing screen as stream {self.stream_sender.stream_id}", "system")
+    
+    def stop_screen_share(self):
+        if not self.screen_streamer:
+            return
+        self.screen_streamer.stop()
+        self.stream_sender.stop()
+        stats = self.stream_sender.stats()
+        self.add_message(f"Screen sharing stopped: {stats['sent']} frames sent, "
+                         f"{stats['dropped']} stale frames dropped", "system")
+        self.screen_streamer = None
+        self.stream_sender = None
+        self.share_screen_btn.config(text="Share Screen")
+    
+    def stream_decode_loop(self):
+        """Decode the newest frame of each live stream and hand it to the view and the detector"""
+        while True:
+            for stream_id, item in self.stream_inbox.take(timeout=1.0).items():
+                if item is None:
+                    self.stream_display.put(stream_id, None)
+                else:
+                    seq, data = item
+                    try:
+                        image = Image.open(io.BytesIO(base64.b64decode(data)))
+                        image.load()
+                    except Exception as e:
+                        print(f"Bad stream frame {stream_id}#{seq}: {e}")
+                        continue
+                    if self.yolo_model:
+                        self.stream_detect_inbox.put(stream_id, image)
+                    boxes = self.stream_boxes.get(stream_id)
+                    if boxes:
+                        image = image.convert('RGB')
+                        self.draw_boxes(image, boxes)
+                    self.stream_display.put(stream_id, (seq, image))
+                
+                with self.stream_display_lock:
+                    schedule = not self.stream_display_scheduled
+                    self.stream_display_scheduled = True
+                if schedule:
+                    self.root.after(0, self.show_stream_frames)
+    
+    def stream_detect_loop(self):
+        """Run the local model on whichever stream frame is newest when it becomes free"""
+        while True:
+            for stream_id, image in self.stream_detect_inbox.take(timeout=1.0).items():
+                try:
+                    self.stream_boxes[stream_id] = self.yolo_model.detect(image)
+                except Exception as e:
+                    print(f"Stream detection failed: {e}")
+    
+    def show_stream_frames(self):
+        """Tk thread: show the newest decoded frame of each stream in its own window"""
+        with self.stream_display_lock:
+            self.stream_display_scheduled = False
+        for stream_id, item in self.stream_display.take(timeout=0).items():
+            window = self.stream_windows.get(stream_id)
+            if stream_id in self.stream_muted:
+                if item is None:
+                    self.stream_muted.discard(stream_id)
+                continue
+            if item is None:
+                if window:
+                    window[0].destroy()
+                    del self.stream_windows[stream_id]
+                self.add_message(f"Live stream {stream_id} ended", "system")
+                continue
             
-            # Clear selection
-            self.selected_image_path = None
-            self.selected_file_label.config(text="No image selected", fg="gray")
-            self.send_image_btn.config(state='disabled')
-            
-        except Exception as e:
-            messagebox.showerror("Send Error", f"Failed to send image: {e}")
-            self.add_message(f"Image send failed: {e}", "error")
+            seq, image = item
+            if not window:
+                top = tk.Toplevel(self.root)
+                label = tk.Label(top)
+                label.pack()
+                top.protocol("WM_DELETE_WINDOW", lambda sid=stream_id: self.close_stream_window(sid))
+                window = self.stream_windows[stream_id] = (top, label)
+                self.add_message(f"Live stream {stream_id} started", "system")
+            top, label = window
+            photo = ImageTk.PhotoImage(image)
+            label.config(image=photo)
+            label.image = photo  # Keep reference
+            top.title(f"Live stream {stream_id} - frame {seq}")
+    
+    def close_stream_window(self, stream_id):
+        # Stop showing a stream until it ends; frames keep being dropped cheaply
+        self.stream_muted.add(stream_id)
+        window = self.stream_windows.pop(stream_id, None)
+        if window:
+            window[0].destroy()
     
     def view_received_images(self):
         """Open the received images folder"""
@@ -749,6 +1179,11 @@ To find the server IP on the VM:
     def cleanup_connection(self):
         self.connected = False
         self.running = False
+        self.upload_queue.suspend()
+        self.compressor = None
+        self.server_limits = {}
+        self.stop_screen_share()
+        self.downloads.detach("server")  # Half-received images are resumed on the next connection
         
         if self.client_socket:
             try:
@@ -769,22 +1204,62 @@ To find the server IP on the VM:
         self.input_entry.config(state='disabled')
         self.send_btn.config(state='disabled')
         self.select_image_btn.config(state='disabled')
+        self.batch_upload_btn.config(state='disabled')
+        self.folder_upload_btn.config(state='disabled')
+        self.share_screen_btn.config(state='disabled')
         self.send_image_btn.config(state='disabled')
         self.view_images_btn.config(state='disabled')
         self.view_processed_btn.config(state='disabled')
     
     def clear_messages(self):
-        self.message_area.delete(1.0, tk.END)
+        self.message_log.clear()
     
     def on_closing(self):
         self.disconnect_from_server()
         self.root.destroy()
     
     def run(self):
+        self.find_servers(auto=True)
         self.root.mainloop()
 
 def main():
-    client = WindowsClient()
+    import argparse
+    parser = argparse.ArgumentParser(description="VM-Windows communication client")
+    parser.add_argument('--backend', choices=detector.BACKENDS, default='eager',
+                        help="YOLOv5 detector backend (default: eager)")
+    parser.add_argument('--threads', type=int, help="torch intra-op threads")
+    parser.add_argument('--interop-threads', type=int, help="torch inter-op threads")
+    parser.add_argument('--tile-threshold', type=int, default=2048,
+                        help="tile detection above this longest side in px, 0 disables (default: 2048)")
+    parser.add_argument('--tile-overlap', type=float, default=0.2, help="tile overlap fraction (default: 0.2)")
+    parser.add_argument('--server-detection', action='store_true',
+                        help="draw the server's DETECTIONS frames instead of loading a local model")
+    parser.add_argument('--share-detections', action='store_true',
+                        help="send local detection results to peers as compact DETECTIONS frames")
+    parser.add_argument('--log-console', action='store_true', help="mirror GUI messages to stdout")
+    parser.add_argument('--max-in-flight', type=int, default=4,
+                        help="uploads streamed ahead of the server's acknowledgement (default: 4)")
+    parser.add_argument('--max-rate', type=float, default=0, metavar='MB/s',
+                        help="ask the server to send us at most this much (default: no cap)")
+    image_prep.add_arguments(parser)
+    parser.add_argument('--benchmark', metavar='FOLDER',
+                        help="compare detector backends on the images in FOLDER and exit")
+    parser.add_argument('--model', default="yolov5s.pt", help="YOLOv5 weights for --benchmark")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        if not YOLO_AVAILABLE:
+            print("YOLO not available - install torch and numpy")
+            return
+        detector.configure_threads(args.threads, args.interop_threads)
+        detector.benchmark(args.benchmark, args.model)
+        return
+
+    client = WindowsClient(args.backend, args.threads, args.interop_threads,
+                           args.tile_threshold, args.tile_overlap, args.server_detection,
+                           args.log_console, args.max_in_flight,
+                           image_prep.from_args(args), args.preprocess, args.share_detections,
+                           args.max_rate * 1e6)
     client.run()
 
 if __name__ == "__main__":
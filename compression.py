@@ -0,0 +1,118 @@
+import time
+import zlib
+import base64
+import threading
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+# Optional per-frame compression, negotiated per connection.
+#
+# The client lists the codecs it can decode in its FEATURES: frame (zstd, zlib); the server picks the
+# best one both sides have and names it in its own FEATURES: reply. From then on either side may send
+#   ZFRAME:<codec>|<base64 of the compressed frame>
+# in place of any frame. Only text-like frames of at least min_size bytes are compressed, and only when
+# that makes them smaller; image, stream and bulk payloads are already compressed and go out as they are.
+# Frames stay newline-delimited, so buffering, capture and replay see ordinary frames.
+
+PREFERENCE = ('zstd', 'zlib')
+MIN_SIZE = 512
+MAX_DECOMPRESSED = 16 * 1024 * 1024  # A ZFRAME may not expand beyond this
+# Frames whose payload is base64 of JPEG/PNG or test data
+SKIP_PREFIXES = (b'IMAGE:', b'IMAGE_CHUNK:', b'SERVER_IMAGE:', b'SERVER_IMAGE_CHUNK:', b'STREAM_FRAME:',
+                 b'BULK_', b'ZFRAME:')
+
+
+def available_codecs():
+    return [codec for codec in PREFERENCE if codec != 'zstd' or ZSTD_AVAILABLE]
+
+
+def negotiate(features):
+    """Best codec in both our list and the peer's FEATURES, or None"""
+    for codec in available_codecs():
+        if codec in features:
+            return codec
+    return None
+
+
+def compress_bytes(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return zlib.compress(data, 1)
+
+
+def decompress_bytes(codec, data):
+    if codec == 'zstd':
+        if not ZSTD_AVAILABLE:
+            raise ValueError("zstd frame received but zstandard is not installed")
+        with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+            result = reader.read(MAX_DECOMPRESSED + 1)
+    elif codec == 'zlib':
+        reader = zlib.decompressobj()
+        result = reader.decompress(data, MAX_DECOMPRESSED + 1)
+    else:
+        raise ValueError(f"unknown codec {codec}")
+    if len(result) > MAX_DECOMPRESSED:
+        raise ValueError(f"compressed frame expands beyond {MAX_DECOMPRESSED // (1024 * 1024)} MB")
+    return result
+
+
+class CompressionStats:
+    """Totals across connections: bytes before/after and CPU seconds, for the stats command"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = self.skipped = self.raw_bytes = self.wire_bytes = 0
+        self.compress_cpu = 0.0
+        self.inflated_frames = self.inflated_bytes = 0
+        self.decompress_cpu = 0.0
+
+    def summary(self):
+        with self.lock:
+            ratio = self.raw_bytes / self.wire_bytes if self.wire_bytes else 0.0
+            return (f"Compression: {self.frames} frames {self.raw_bytes / 1024:.1f} -> {self.wire_bytes / 1024:.1f} KB "
+                    f"(ratio {ratio:.2f}, {self.skipped} not worth it), {self.compress_cpu * 1000:.1f} ms CPU; "
+                    f"inbound {self.inflated_frames} frames -> {self.inflated_bytes / 1024:.1f} KB, "
+                    f"{self.decompress_cpu * 1000:.1f} ms CPU")
+
+
+class FrameCompressor:
+    """One connection's negotiated codec, applied to outgoing frames (newline included)"""
+
+    def __init__(self, codec, stats=None, min_size=MIN_SIZE):
+        self.codec = codec
+        self.stats = stats or CompressionStats()
+        self.min_size = min_size
+        self.prefix = f"ZFRAME:{codec}|".encode('ascii')
+
+    def compress(self, frame):
+        if len(frame) < self.min_size or frame.startswith(SKIP_PREFIXES):
+            return frame
+        started = time.thread_time()
+        packed = self.prefix + base64.b64encode(compress_bytes(self.codec, frame[:-1])) + b"\n"
+        elapsed = time.thread_time() - started
+        with self.stats.lock:
+            self.stats.compress_cpu += elapsed
+            if len(packed) >= len(frame):
+                self.stats.skipped += 1
+                return frame
+            self.stats.frames += 1
+            self.stats.raw_bytes += len(frame)
+            self.stats.wire_bytes += len(packed)
+        return packed
+
+
+def decompress_frame(frame, stats=None):
+    """Original frame (without newline) for a ZFRAME:<codec>|<base64> frame"""
+    codec, _, data = frame[7:].partition(b'|')
+    started = time.thread_time()
+    result = decompress_bytes(codec.decode('ascii', errors='replace'), base64.b64decode(data))
+    if stats:
+        with stats.lock:
+            stats.decompress_cpu += time.thread_time() - started
+            stats.inflated_frames += 1
+            stats.inflated_bytes += len(result)
+    return result
@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+
+# Content hashing shared by the servers (conditional sends, deduplicated storage) and clients
+# (local image cache)
+
+
+def sha256_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def sha256_file(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class HashCache:
+    """Server side: sha256 of files, recomputed only when size or mtime change"""
+
+    def __init__(self):
+        self.hashes = {}  # path -> (size, mtime, sha256)
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        stat = os.stat(path)
+        with self.lock:
+            cached = self.hashes.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+            return cached[2]
+        digest = sha256_file(path)
+        with self.lock:
+            self.hashes[path] = (stat.st_size, stat.st_mtime, digest)
+        return digest
+
+
+class ContentCache:
+    """Client side: content-addressed index over the received images folder.
+
+    Changes are appended to a journal, one line each, and folded into the JSON index when the
+    cache is next loaded, so filling a large gallery doesn't rewrite the whole index per image.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, ".content_index.json")
+        self.journal_path = os.path.join(directory, ".content_index.jsonl")
+        self.by_hash = {}  # sha256 -> filename inside directory
+        self.by_name = {}  # server-side image name -> sha256 last received for it
+        self.lock = threading.Lock()
+        if os.path.exists(self.index_path):
+            self.load()
+        else:
+            # First run: index what is already on disk without blocking startup
+            self.replay_journal()
+            threading.Thread(target=self.scan, daemon=True).start()
+
+    def load(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.by_hash = data.get('by_hash', {})
+            self.by_name = data.get('by_name', {})
+        except (OSError, ValueError) as e:
+            print(f"Content cache index unreadable, rebuilding: {e}")
+            self.replay_journal()
+            self.scan()
+            return
+        if self.replay_journal():
+            self.save()
+
+    def replay_journal(self):
+        """Apply the changes journaled since the index was written; returns how many"""
+        if not os.path.exists(self.journal_path):
+            return 0
+        count = 0
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Torn last line after a crash
+                if entry.get('file'):
+                    self.by_hash[entry['sha256']] = entry['file']
+                if entry.get('name'):
+                    self.by_name[entry['name']] = entry['sha256']
+                count += 1
+        return count
+
+    def save(self):
+        """Write the whole index and start a new journal"""
+        with self.lock:
+            temp_path = self.index_path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'by_hash': self.by_hash, 'by_name': self.by_name}, f)
+            os.replace(temp_path, self.index_path)
+            try:
+                os.remove(self.journal_path)
+            except OSError:
+                pass
+
+    def journal(self, entry):
+        # Caller holds self.lock, so the line can't land between save()'s snapshot and its cleanup
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def scan(self):
+        found = {}
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename.startswith('.') or not os.path.isfile(path):
+                continue
+            try:
+                found.setdefault(sha256_file(path), filename)
+            except OSError:
+                continue
+        with self.lock:
+            for digest, filename in found.items():
+                self.by_hash.setdefault(digest, filename)
+        self.save()
+
+    def lookup(self, digest):
+        """Local path holding these bytes, or None"""
+        with self.lock:
+            filename = self.by_hash.get(digest)
+        if filename:
+            path = os.path.join(self.directory, filename)
+            if os.path.exists(path):
+                return path
+            with self.lock:
+                self.by_hash.pop(digest, None)
+        return None
+
+    def hash_for_name(self, name):
+        """Hash of the copy we hold for a server image name, if it is still on disk"""
+        with self.lock:
+            digest = self.by_name.get(name)
+        return digest if digest and self.lookup(digest) else None
+
+    def remember(self, name, digest):
+        """Record that a server image name currently has this content"""
+        with self.lock:
+            self.by_name[name] = digest
+            self.journal({'sha256': digest, 'name': name})
+
+    def add(self, path, name=None, data=None):
+        """Index a saved file (optionally under its server name) and return its hash"""
+        digest = sha256_bytes(data) if data is not None else sha256_file(path)
+        with self.lock:
+            self.by_hash[digest] = os.path.basename(path)
+            if name:
+                self.by_name[name] = digest
+            self.journal({'sha256': digest, 'file': os.path.basename(path), 'name': name})
+        return digest
+
+
+class ContentStore:
+    """Server side: every distinct upload is kept once, under objects/<ab>/<cd>/<sha256>.
+
+    The timestamped names in received_images/ are hard links to those objects (copies where the
+    filesystem has none), and names.jsonl records which hash every stored name has. A client that
+    sent the hash first (IMAGE_LINK) gets a new name for existing content without uploading it.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, "objects")
+        self.log_path = os.path.join(directory, "names.jsonl")
+        self.names = {}  # Stored name -> sha256
+        self.sizes = {}  # sha256 -> size of the object
+        self.lock = threading.Lock()
+        # This run: new objects, uploads that turned out to be duplicates, uploads skipped by hash
+        self.stored = self.duplicates = self.linked = 0
+        self.disk_saved = self.upload_saved = 0
+        os.makedirs(self.objects_dir, exist_ok=True)
+        if os.path.exists(self.log_path):
+            self.load()
+
+    def load(self):
+        with open(self.log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    self.names[entry['name']] = entry['sha256']
+                    self.sizes[entry['sha256']] = entry['size']
+                except (ValueError, KeyError):
+                    continue  # Torn last line after a crash
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:4], digest)
+
+    def has(self, digest):
+        # Only well-formed hashes ever reach the filesystem
+        if len(digest) != 64 or digest.strip('0123456789abcdef'):
+            return False
+        return os.path.exists(self.object_path(digest))
+
+    def temp_path(self):
+        """Scratch file inside the store, on the same filesystem as the objects"""
+        return os.path.join(self.directory, f"incoming_{uuid.uuid4().hex}.tmp")
+
+    def put_bytes(self, data, path):
+        """Store decoded image bytes and publish them as path; returns the sha256"""
+        digest = sha256_bytes(data)
+        duplicate = self.has(digest)
+        if not duplicate:
+            temp_path = self.temp_path()
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            self.add_object(temp_path, digest)
+        self.publish(digest, path, len(data), 'duplicate' if duplicate else 'stored')
+        return digest
+
+    def put_file(self, source, path):
+        """Move a received file into the store (or drop it if the content is known) and publish it as path"""
+        digest = sha256_file(source)
+        size = os.path.getsize(source)
+        duplicate = self.has(digest)
+        if duplicate:
+            os.remove(source)
+        else:
+            self.add_object(source, digest)
+        self.publish(digest, path, size, 'duplicate' if duplicate else 'stored')
+        return digest
+
+    def link(self, digest, path):
+        """Publish already stored content under a new name; False if the hash is unknown"""
+        if not self.has(digest):
+            return False
+        self.publish(digest, path, os.path.getsize(self.object_path(digest)), 'linked')
+        return True
+
+    def add_object(self, source, digest):
+        target = self.object_path(digest)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source, target)
+
+    def publish(self, digest, path, size, how):
+        # Replace, never write through: an existing name may be a link to another object
+        if os.path.lexists(path):
+            os.remove(path)
+        try:
+            os.link(self.object_path(digest), path)
+        except OSError:
+            shutil.copyfile(self.object_path(digest), path)
+        entry = {'name': os.path.basename(path), 'sha256': digest, 'size': size, 'time': time.time()}
+        with self.lock:
+            self.names[entry['name']] = digest
+            self.sizes[digest] = size
+            if how == 'stored':
+                self.stored += 1
+            else:
+                self.disk_saved += size
+                if how == 'duplicate':
+                    self.duplicates += 1
+                else:
+                    self.linked += 1
+                    self.upload_saved += size
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def summary(self):
+        with self.lock:
+            return (f"Image store: {len(self.names)} names -> {len(self.sizes)} objects "
+                    f"({sum(self.sizes.values()) / 1e6:.1f} MB on disk)\n"
+                    f"  This run: {self.stored} new, {self.duplicates} duplicate uploads, "
+                    f"{self.linked} skipped by hash; {self.disk_saved / 1e6:.1f} MB disk and "
+                    f"{self.upload_saved / 1e6:.1f} MB upload saved")
@@ -0,0 +1,536 @@
+import os
+import time
+import json
+try:
+    import torch
+    import numpy as np
+    TORCH_AVAILABLE = True
+except ImportError:
+    TORCH_AVAILABLE = False
+
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+# Pluggable YOLOv5 detector backends tuned for CPU-only machines
+
+BACKENDS = ('eager', 'torchscript', 'quantized')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+
+def configure_threads(num_threads=None, interop_threads=None):
+    """Apply torch intra-op / inter-op thread counts (None keeps torch defaults)"""
+    if not TORCH_AVAILABLE:
+        return
+    if num_threads:
+        torch.set_num_threads(int(num_threads))
+    if interop_threads:
+        try:
+            # Only allowed once, before any inter-op parallel work has started
+            torch.set_num_interop_threads(int(interop_threads))
+        except RuntimeError as e:
+            print(f"Could not set inter-op threads: {e}")
+    print(f"Torch threads: intra-op={torch.get_num_threads()}, inter-op={torch.get_num_interop_threads()}")
+
+
+def letterbox(image, size):
+    """Resize a PIL image into a size x size square keeping aspect ratio, return (tensor, scale, pad)"""
+    image = image.convert('RGB')
+    width, height = image.size
+    scale = min(size / width, size / height)
+    new_w, new_h = max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+    resized = image.resize((new_w, new_h), Image.BILINEAR)
+    canvas = Image.new('RGB', (size, size), (114, 114, 114))
+    pad_x, pad_y = (size - new_w) // 2, (size - new_h) // 2
+    canvas.paste(resized, (pad_x, pad_y))
+    array = np.asarray(canvas, dtype=np.float32) / 255.0
+    tensor = torch.from_numpy(array.transpose(2, 0, 1).copy())
+    return tensor, scale, (pad_x, pad_y)
+
+
+def non_max_suppression(pred, conf_threshold=0.3, iou_threshold=0.45, max_det=300):
+    """Filter raw YOLOv5 output (N, 5+classes) into an (M, 6) tensor of xyxy, conf, cls"""
+    import torchvision
+    pred = pred[pred[:, 4] > conf_threshold]
+    if not pred.shape[0]:
+        return torch.zeros((0, 6))
+    scores = pred[:, 5:] * pred[:, 4:5]
+    conf, cls = scores.max(1)
+    keep = conf > conf_threshold
+    pred, conf, cls = pred[keep], conf[keep], cls[keep]
+    # Center xywh -> corner xyxy
+    boxes = torch.empty((pred.shape[0], 4))
+    boxes[:, 0] = pred[:, 0] - pred[:, 2] / 2
+    boxes[:, 1] = pred[:, 1] - pred[:, 3] / 2
+    boxes[:, 2] = pred[:, 0] + pred[:, 2] / 2
+    boxes[:, 3] = pred[:, 1] + pred[:, 3] / 2
+    keep = torchvision.ops.batched_nms(boxes, conf, cls, iou_threshold)[:max_det]
+    return torch.cat((boxes[keep], conf[keep, None], cls[keep, None].float()), 1)
+
+
+def to_detections(rows, names, conf_threshold=0.3):
+    """Convert (M, 6) xyxy/conf/cls rows into the client's detection dicts"""
+    detections = []
+    for *box, conf, cls in rows.cpu().numpy():
+        if conf > conf_threshold:
+            x1, y1, x2, y2 = map(int, box)
+            detections.append({
+                'label': names[int(cls)],
+                'confidence': float(conf),
+                'box': [x1, y1, x2 - x1, y2 - y1]  # x, y, w, h
+            })
+    return detections
+
+
+class DetectorBackend:
+    """Base class: load() once, then predict(images) -> per-image (M, 6) xyxy/conf/cls rows"""
+    name = 'base'
+    batchable = True  # False when the model only accepts a batch of one
+
+    def __init__(self, model_path="yolov5s.pt", conf_threshold=0.3, iou_threshold=0.45, img_size=640):
+        self.model_path = model_path
+        self.conf_threshold = conf_threshold
+        self.iou_threshold = iou_threshold
+        self.img_size = img_size
+        self.names = []
+
+    def load_hub_model(self):
+        """Load the YOLOv5 AutoShape model from torch hub"""
+        model = torch.hub.load('ultralytics/yolov5', 'custom', path=self.model_path)
+        model.eval()
+        names = model.names
+        self.names = [names[i] for i in sorted(names)] if isinstance(names, dict) else list(names)
+        return model
+
+    def load(self):
+        raise NotImplementedError
+
+    def predict(self, images):
+        raise NotImplementedError
+
+    def detect(self, image):
+        """Detect on one image (path or PIL image) and return detection dicts"""
+        if not isinstance(image, Image.Image):
+            image = Image.open(image)
+        return to_detections(self.predict([image])[0], self.names, self.conf_threshold)
+
+    def run_raw(self, model, images):
+        """Letterbox, run a raw (non-AutoShape) model and map boxes back to image coordinates"""
+        prepared = [letterbox(image, self.img_size) for image in images]
+        with torch.inference_mode():
+            if self.batchable:
+                outputs = self.forward(model, torch.stack([p[0] for p in prepared]))
+            else:
+                outputs = [self.forward(model, p[0].unsqueeze(0))[0] for p in prepared]
+
+        results = []
+        for image, (_, scale, (pad_x, pad_y)), out in zip(images, prepared, outputs):
+            rows = non_max_suppression(out.float(), self.conf_threshold, self.iou_threshold)
+            rows[:, [0, 2]] = ((rows[:, [0, 2]] - pad_x) / scale).clamp(0, image.width)
+            rows[:, [1, 3]] = ((rows[:, [1, 3]] - pad_y) / scale).clamp(0, image.height)
+            results.append(rows)
+        return results
+
+    @staticmethod
+    def forward(model, batch):
+        out = model(batch)
+        return out[0] if isinstance(out, (list, tuple)) else out
+
+
+class EagerBackend(DetectorBackend):
+    """fp32 eager PyTorch through the hub AutoShape wrapper (original behaviour)"""
+    name = 'eager'
+
+    def load(self):
+        self.model = self.load_hub_model()
+        return self
+
+    def predict(self, images):
+        with torch.inference_mode():
+            results = self.model(list(images), size=self.img_size)
+        return [rows.cpu() for rows in results.xyxy]
+
+
+class TorchScriptBackend(DetectorBackend):
+    """TorchScript-traced model at a fixed input size, cached next to the weights"""
+    name = 'torchscript'
+    batchable = False  # Traced with batch size 1
+
+    def script_path(self):
+        return f"{os.path.splitext(self.model_path)[0]}.torchscript-{self.img_size}.pt"
+
+    def load(self):
+        path = self.script_path()
+        if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(self.model_path):
+            extra = {'names.json': ''}
+            self.model = torch.jit.load(path, _extra_files=extra)
+            self.names = json.loads(extra['names.json'])
+            print(f"Loaded TorchScript model: {path}")
+        else:
+            raw = self.load_hub_model().model  # Unwrap AutoShape to the plain nn.Module
+            example = torch.zeros((1, 3, self.img_size, self.img_size))
+            with torch.inference_mode():
+                self.model = torch.jit.trace(raw, example, strict=False, check_trace=False)
+            self.model = torch.jit.freeze(self.model.eval())
+            torch.jit.save(self.model, path, _extra_files={'names.json': json.dumps(self.names)})
+            print(f"Traced TorchScript model saved: {path}")
+        return self
+
+    def predict(self, images):
+        return self.run_raw(self.model, images)
+
+
+class QuantizedConv(torch.nn.Module if TORCH_AVAILABLE else object):
+    """One conv run in int8: quantize its input, int8 conv, back to float for the fp32 activation"""
+
+    def __init__(self, conv):
+        super().__init__()
+        self.quant = torch.ao.quantization.QuantStub()
+        self.conv = conv
+        self.dequant = torch.ao.quantization.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+class QuantizedBackend(DetectorBackend):
+    """Static int8 convolutions, calibrated on sample images; activations and the Detect head stay fp32.
+
+    Dynamic quantization would only touch Linear layers, which YOLOv5 barely has, so each Conv2d is
+    wrapped in quant/dequant stubs, observed over a few real images and converted to a quantized conv.
+    """
+    name = 'quantized'
+    CALIBRATION_DIRS = ('client_received_images', 'received_images', 'server_images')
+    CALIBRATION_IMAGES = 16
+
+    def __init__(self, model_path="yolov5s.pt", calibration_dir=None, **kwargs):
+        super().__init__(model_path, **kwargs)
+        self.calibration_dir = calibration_dir
+
+    def calibration_images(self):
+        directories = [self.calibration_dir] if self.calibration_dir else self.CALIBRATION_DIRS
+        for directory in directories:
+            if not os.path.isdir(directory):
+                continue
+            paths = sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                           if f.lower().endswith(IMAGE_EXTENSIONS))[:self.CALIBRATION_IMAGES]
+            if paths:
+                images = []
+                for path in paths:
+                    with Image.open(path) as img:
+                        images.append(img.convert('RGB'))
+                return images
+        # Noise gives poor activation ranges, but a usable model beats none
+        print("Warning: no calibration images found, calibrating the int8 model on noise")
+        return [Image.fromarray(np.random.randint(0, 256, (self.img_size, self.img_size, 3), dtype=np.uint8))
+                for _ in range(4)]
+
+    def load(self):
+        engines = torch.backends.quantized.supported_engines
+        for engine in ('fbgemm', 'x86', 'qnnpack'):
+            if engine in engines:
+                torch.backends.quantized.engine = engine
+                break
+        raw = self.load_hub_model().model.float().eval()
+        qconfig = torch.ao.quantization.get_default_qconfig(torch.backends.quantized.engine)
+        # Keep the Detect output convs in fp32; box coordinates are sensitive to rounding
+        head = {id(m) for d in raw.modules() if type(d).__name__ == 'Detect' for m in d.modules()}
+        wrapped = 0
+        for parent in list(raw.modules()):
+            if id(parent) in head:
+                continue
+            for child_name, child in list(parent.named_children()):
+                if type(child) is torch.nn.Conv2d:
+                    wrapper = QuantizedConv(child)
+                    wrapper.qconfig = qconfig
+                    setattr(parent, child_name, wrapper)
+                    wrapped += 1
+        torch.ao.quantization.prepare(raw, inplace=True)
+        images = self.calibration_images()
+        with torch.no_grad():
+            for image in images:
+                self.forward(raw, letterbox(image, self.img_size)[0].unsqueeze(0))
+        self.model = torch.ao.quantization.convert(raw, inplace=True).eval()
+        converted = sum(1 for m in self.model.modules() if isinstance(m, torch.ao.nn.quantized.Conv2d))
+        if not converted:
+            raise RuntimeError(f"no layers were quantized ({wrapped} convs found); use another backend")
+        print(f"Quantized model ready: {converted} int8 convs, calibrated on {len(images)} images "
+              f"(engine: {torch.backends.quantized.engine})")
+        return self
+
+    def predict(self, images):
+        return self.run_raw(self.model, images)
+
+
+class TiledDetector:
+    """Sliced inference for large images: overlapping tiles, batched or parallel, merged with NMS"""
+
+    def __init__(self, backend, threshold=2048, tile_size=None, overlap=0.2,
+                 batch_size=4, workers=2, include_full=True):
+        self.backend = backend
+        self.threshold = threshold  # Tile when the longest side exceeds this (0 disables tiling)
+        self.tile_size = tile_size or backend.img_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.workers = workers
+        self.include_full = include_full  # Also run the whole image so large objects stay intact
+
+    def tile_origins(self, width, height):
+        """Top-left corners of overlapping tiles covering the image"""
+        step = max(1, int(self.tile_size * (1 - self.overlap)))
+
+        def axis(length):
+            if length <= self.tile_size:
+                return [0]
+            starts = list(range(0, length - self.tile_size, step))
+            starts.append(length - self.tile_size)  # Last tile flush with the edge
+            return starts
+
+        return [(x, y) for y in axis(height) for x in axis(width)]
+
+    def predict_tiles(self, crops):
+        """Run crops in batches (batchable backends) or across worker threads"""
+        batches = [crops[i:i + self.batch_size] for i in range(0, len(crops), self.batch_size)]
+        if self.backend.batchable or self.workers <= 1:
+            results = [self.backend.predict(batch) for batch in batches]
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                results = list(pool.map(self.backend.predict, batches))
+        return [rows for batch in results for rows in batch]
+
+    def detect(self, image_path):
+        """Return (detections, stats) with tiling applied above the size threshold"""
+        import torchvision
+        start = time.perf_counter()
+        image = Image.open(image_path)
+        image.load()
+        width, height = image.size
+
+        if not self.threshold or max(width, height) <= self.threshold:
+            detections = self.backend.detect(image)
+            return detections, {'tiles': 0, 'latency_ms': (time.perf_counter() - start) * 1000}
+
+        origins = self.tile_origins(width, height)
+        crops = [image.crop((x, y, min(x + self.tile_size, width), min(y + self.tile_size, height)))
+                 for x, y in origins]
+        tile_rows = self.predict_tiles(crops)
+
+        # Shift every tile's boxes into full-image coordinates in one tensor
+        merged = []
+        for (x, y), rows in zip(origins, tile_rows):
+            if rows.shape[0]:
+                rows = rows.clone()
+                rows[:, [0, 2]] += x
+                rows[:, [1, 3]] += y
+                merged.append(rows)
+        if self.include_full:
+            merged.extend(self.backend.predict([image]))
+        merged = torch.cat(merged) if merged else torch.zeros((0, 6))
+
+        if merged.shape[0]:
+            keep = torchvision.ops.batched_nms(merged[:, :4], merged[:, 4], merged[:, 5].long(),
+                                               self.backend.iou_threshold)
+            merged = merged[keep]
+
+        detections = to_detections(merged, self.backend.names, self.backend.conf_threshold)
+        stats = {'tiles': len(origins), 'latency_ms': (time.perf_counter() - start) * 1000}
+        return detections, stats
+
+
+def create_backend(name="eager", model_path="yolov5s.pt", **kwargs):
+    """Build and load the backend called name"""
+    classes = {cls.name: cls for cls in (EagerBackend, TorchScriptBackend, QuantizedBackend)}
+    if name not in classes:
+        raise ValueError(f"Unknown detector backend '{name}' (choose from {', '.join(BACKENDS)})")
+    return classes[name](model_path, **kwargs).load()
+
+
+def encode_detections(image_name, size, detections, image_hash=None):
+    """Compact DETECTIONS frame payload: image reference plus parallel label/confidence/box arrays"""
+    data = {
+        'image': image_name,
+        'size': list(size),
+        'labels': [d['label'] for d in detections],
+        'confidences': [round(d['confidence'], 3) for d in detections],
+        'boxes': [[round(v) for v in d['box']] for d in detections],
+    }
+    if image_hash:
+        data['hash'] = image_hash  # Lets receivers find their copy even if it is stored under another name
+    return json.dumps(data, separators=(',', ':'))
+
+
+def decode_detections(payload):
+    """Parse a DETECTIONS payload back into (image_name, size, detection dicts, image_hash or None)"""
+    data = json.loads(payload)
+    detections = [{'label': label, 'confidence': conf, 'box': box}
+                  for label, conf, box in zip(data['labels'], data['confidences'], data['boxes'])]
+    return data['image'], data.get('size'), detections, data.get('hash')
+
+
+_worker_backend = None
+
+
+def _init_worker(backend_name, model_path, num_threads):
+    """Process pool initializer: load one model per worker process"""
+    global _worker_backend
+    torch.set_num_threads(max(1, num_threads))
+    _worker_backend = create_backend(backend_name, model_path)
+
+
+def _detect_batch(paths):
+    """Run one batched inference in a worker process"""
+    images, results = [], {}
+    for i, path in enumerate(paths):
+        try:
+            image = Image.open(path)
+            image.load()
+            images.append((i, image))
+        except Exception as e:
+            results[i] = {'error': str(e)}
+    if images:
+        rows = _worker_backend.predict([image for _, image in images])
+        for (i, image), image_rows in zip(images, rows):
+            results[i] = {
+                'size': image.size,
+                'detections': to_detections(image_rows, _worker_backend.names, _worker_backend.conf_threshold),
+            }
+    return [results[i] for i in range(len(paths))]
+
+
+class DetectionService:
+    """Shared detector: jobs are batched over a short window and run in a worker process pool"""
+
+    def __init__(self, backend="eager", model_path="yolov5s.pt", workers=1,
+                 max_batch=8, batch_window=0.05):
+        import threading
+        import queue
+        from concurrent.futures import ProcessPoolExecutor
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.jobs = queue.Queue()
+        self.running = True
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker,
+            initargs=(backend, model_path, threads)
+        )
+        self.batcher = threading.Thread(target=self.batch_loop, daemon=True)
+        self.batcher.start()
+        print(f"Detection service started: {workers} worker(s), backend {backend}, batch <= {max_batch}")
+
+    def submit(self, path, callback):
+        """Queue path for detection; callback(result) runs when its batch completes"""
+        self.jobs.put((path, callback))
+
+    def batch_loop(self):
+        import queue
+        while self.running:
+            try:
+                batch = [self.jobs.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.jobs.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            future = self.pool.submit(_detect_batch, [path for path, _ in batch])
+            future.add_done_callback(lambda f, jobs=batch: self.deliver(f, jobs))
+
+    def deliver(self, future, jobs):
+        try:
+            results = future.result()
+        except Exception as e:
+            results = [{'error': str(e)}] * len(jobs)
+        for (path, callback), result in zip(jobs, results):
+            try:
+                callback(result)
+            except Exception as e:
+                print(f"Detection callback failed for {path}: {e}")
+
+    def shutdown(self):
+        self.running = False
+        self.pool.shutdown(wait=False)
+
+
+def box_iou(a, b):
+    """IoU of two x, y, w, h boxes"""
+    ax2, ay2, bx2, by2 = a[0] + a[2], a[1] + a[3], b[0] + b[2], b[1] + b[3]
+    iw = max(0, min(ax2, bx2) - max(a[0], b[0]))
+    ih = max(0, min(ay2, by2) - max(a[1], b[1]))
+    inter = iw * ih
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+
+def agreement(reference, detections, iou_threshold=0.5):
+    """Greedy match against reference detections, return (precision, recall)"""
+    matched = set()
+    hits = 0
+    for det in detections:
+        for i, ref in enumerate(reference):
+            if i not in matched and ref['label'] == det['label'] and box_iou(ref['box'], det['box']) >= iou_threshold:
+                matched.add(i)
+                hits += 1
+                break
+    precision = hits / len(detections) if detections else 1.0
+    recall = hits / len(reference) if reference else 1.0
+    return precision, recall
+
+
+def benchmark(folder, model_path="yolov5s.pt", backends=BACKENDS, warmup=1):
+    """Compare latency and agreement with the eager backend over the images in folder"""
+    images = sorted(os.path.join(folder, f) for f in os.listdir(folder)
+                    if f.lower().endswith(IMAGE_EXTENSIONS))
+    if not images:
+        print(f"No images found in {folder}")
+        return {}
+
+    print(f"Benchmarking {len(backends)} backends on {len(images)} images from {folder}")
+    reference, reference_name = None, None
+    report = {}
+    for name in backends:
+        try:
+            load_start = time.perf_counter()
+            extra = {'calibration_dir': folder} if name == 'quantized' else {}
+            backend = create_backend(name, model_path, **extra)
+            load_time = time.perf_counter() - load_start
+        except Exception as e:
+            print(f"{name}: failed to load ({e})")
+            continue
+
+        for path in images[:warmup]:
+            backend.detect(path)
+
+        latencies, outputs = [], []
+        for path in images:
+            start = time.perf_counter()
+            outputs.append(backend.detect(path))
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        if reference is None:
+            reference, reference_name = outputs, name  # First loaded backend is the accuracy baseline
+        scores = [agreement(ref, out) for ref, out in zip(reference, outputs)]
+        latencies.sort()
+        report[name] = {
+            'load_s': load_time,
+            'mean_ms': sum(latencies) / len(latencies),
+            'p50_ms': latencies[len(latencies) // 2],
+            'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            'precision': sum(s[0] for s in scores) / len(scores),
+            'recall': sum(s[1] for s in scores) / len(scores),
+        }
+
+    print(f"\n{'backend':<12}{'load s':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'prec':>8}{'recall':>8}")
+    for name, r in report.items():
+        print(f"{name:<12}{r['load_s']:>8.1f}{r['mean_ms']:>10.1f}{r['p50_ms']:>10.1f}"
+              f"{r['p95_ms']:>10.1f}{r['precision']:>8.2f}{r['recall']:>8.2f}")
+    print(f"(precision/recall measured against '{reference_name}')")
+    return report
@@ -0,0 +1,189 @@
+import json
+import time
+import uuid
+import socket
+import asyncio
+import threading
+
+# LAN server discovery: servers answer a UDP probe, clients broadcast it and rank the replies by RTT.
+#
+#   client -> DISCOVER_SERVER <nonce>                  (broadcast and unicast, UDP port 12399)
+#   server -> {"nonce","service","name","port","clients","version"}   (JSON, to the sender)
+
+DISCOVERY_PORT = 12399
+SERVER_VERSION = "1.2"
+
+# Addresses that used to be hard-coded in the client; probed by unicast in case broadcast is filtered
+FALLBACK_HOSTS = ("172.20.10.7", "192.168.56.1", "10.0.2.15", "127.0.0.1")
+
+
+class DiscoveryResponder:
+    """Answers discovery probes for a server; info() supplies the current reply fields"""
+
+    def __init__(self, info, port=DISCOVERY_PORT):
+        self.info = info
+        self.port = port
+        self.running = False
+        self.sock = None
+
+    def start(self):
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                # Lets server.py and image_server.py both answer on one machine
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.sock.bind(('', self.port))
+            self.sock.settimeout(1.0)
+        except OSError as e:
+            print(f"Discovery disabled, UDP port {self.port} unavailable: {e}")
+            return
+        self.running = True
+        threading.Thread(target=self.run, daemon=True).start()
+        print(f"Answering discovery probes on UDP port {self.port}")
+
+    def run(self):
+        while self.running:
+            try:
+                data, address = self.sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if not data.startswith(b"DISCOVER_SERVER"):
+                continue
+            reply = dict(self.info())
+            reply['nonce'] = data[len(b"DISCOVER_SERVER"):].strip().decode('ascii', errors='ignore')
+            reply['version'] = SERVER_VERSION
+            try:
+                self.sock.sendto(json.dumps(reply).encode('utf-8'), address)
+            except OSError as e:
+                print(f"Discovery reply to {address} failed: {e}")
+
+    def stop(self):
+        self.running = False
+        if self.sock:
+            self.sock.close()
+
+
+def local_addresses():
+    """IPv4 addresses of this machine, best guess first"""
+    addresses = []
+    try:
+        # Connecting a UDP socket sends nothing but picks the interface of the default route
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.connect(("8.8.8.8", 80))
+        addresses.append(probe.getsockname()[0])
+        probe.close()
+    except OSError:
+        pass
+    try:
+        for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
+            if info[4][0] not in addresses:
+                addresses.append(info[4][0])
+    except OSError:
+        pass
+    return [a for a in addresses if not a.startswith("127.")]
+
+
+def broadcast_targets():
+    """Limited broadcast plus the /24 directed broadcast of every local interface"""
+    targets = ["255.255.255.255"]
+    for address in local_addresses():
+        subnet_broadcast = address.rsplit('.', 1)[0] + ".255"
+        if subnet_broadcast not in targets:
+            targets.append(subnet_broadcast)
+    return targets
+
+
+class _DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, sent, replies):
+        self.sent = sent  # nonce -> perf_counter() at send
+        self.replies = replies  # (address, port, service) -> reply
+
+    def datagram_received(self, data, address):
+        try:
+            reply = json.loads(data)
+        except ValueError:
+            return
+        sent_at = self.sent.get(reply.get('nonce'))
+        if sent_at is None:
+            return  # Not one of our probes
+        reply['address'] = address[0]
+        reply['rtt_ms'] = (time.perf_counter() - sent_at) * 1000
+        key = (address[0], reply.get('port'), reply.get('service'))
+        if key not in self.replies or reply['rtt_ms'] < self.replies[key]['rtt_ms']:
+            self.replies[key] = reply
+
+    def error_received(self, exc):
+        pass  # ICMP unreachable from a unicast target without a server
+
+
+async def discover_async(timeout=0.5, port=DISCOVERY_PORT, hosts=FALLBACK_HOSTS):
+    """Probe every broadcast target and host at once; replies sorted by RTT"""
+    sent, replies = {}, {}
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: _DiscoveryProtocol(sent, replies), local_addr=('0.0.0.0', 0), allow_broadcast=True
+    )
+    try:
+        base = uuid.uuid4().hex[:8]
+        for i, target in enumerate(broadcast_targets() + list(hosts)):
+            nonce = f"{base}-{i}"
+            sent[nonce] = time.perf_counter()
+            try:
+                transport.sendto(f"DISCOVER_SERVER {nonce}".encode('ascii'), (target, port))
+            except OSError:
+                pass  # No route to that subnet
+        await asyncio.sleep(timeout)
+    finally:
+        transport.close()
+    return sorted(replies.values(), key=lambda r: r['rtt_ms'])
+
+
+async def probe_tcp_async(hosts, port, timeout=0.5, concurrency=256):
+    """Fallback for servers without discovery: connect to every host concurrently, sorted by connect time"""
+    limit = asyncio.Semaphore(concurrency)
+
+    async def probe(host):
+        async with limit:
+            start = time.perf_counter()
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+            except (OSError, asyncio.TimeoutError):
+                return None
+            rtt_ms = (time.perf_counter() - start) * 1000
+            writer.close()
+            return {'address': host, 'port': port, 'rtt_ms': rtt_ms, 'service': 'tcp'}
+
+    results = await asyncio.gather(*(probe(h) for h in hosts))
+    return sorted((r for r in results if r), key=lambda r: r['rtt_ms'])
+
+
+def subnet_hosts():
+    """Every host address in the local /24 subnets"""
+    hosts = []
+    for address in local_addresses():
+        prefix = address.rsplit('.', 1)[0]
+        hosts.extend(f"{prefix}.{i}" for i in range(1, 255))
+    return hosts
+
+
+def discover(timeout=0.5, port=DISCOVERY_PORT, hosts=FALLBACK_HOSTS):
+    """Blocking wrapper around discover_async for threads and scripts"""
+    return asyncio.run(discover_async(timeout, port, hosts))
+
+
+def probe_tcp(hosts, port, timeout=0.5):
+    return asyncio.run(probe_tcp_async(hosts, port, timeout))
+
+
+def format_server(reply):
+    """One line summary of a discover() or probe_tcp() result"""
+    details = [reply.get('service', '')]
+    if reply.get('version'):
+        details.append(f"v{reply['version']}")
+    if 'clients' in reply:
+        details.append(f"{reply['clients']} clients")
+    name = f" ({reply['name']})" if reply.get('name') else ""
+    return f"{reply['address']}:{reply['port']}{name} [{', '.join(details)}] {reply['rtt_ms']:.1f} ms"
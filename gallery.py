@@ -0,0 +1,318 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import tkinter as tk
+from PIL import Image, ImageTk
+
+# In-app gallery for received images: virtualized thumbnail grid backed by an on-disk thumbnail cache
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+
+
+def load_scaled(path, size):
+    """Open an image scaled to fit size, using JPEG draft decoding so large photos stay cheap"""
+    image = Image.open(path)
+    if image.format == 'JPEG':
+        # Decode at 1/2..1/8 scale straight from the JPEG, far cheaper than a full decode
+        image.draft('RGB', size)
+    image.thumbnail(size, Image.Resampling.LANCZOS)
+    return image
+
+
+class PreviewLoader:
+    """Decodes previews on one background thread; a newer request supersedes any not yet shown"""
+
+    def __init__(self, widget, size, on_ready):
+        self.widget = widget  # Any Tk widget, used to hop back onto the Tk thread
+        self.size = size
+        self.on_ready = on_ready  # on_ready(path, image, error) on the Tk thread
+        self.request = None
+        self.generation = 0
+        self.condition = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def load(self, path):
+        with self.condition:
+            self.generation += 1
+            self.request = (self.generation, path)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.request is None:
+                    self.condition.wait()
+                generation, path = self.request
+                self.request = None
+            try:
+                image, error = load_scaled(path, self.size), None
+                image.load()
+            except Exception as e:
+                image, error = None, e
+            try:
+                self.widget.after(0, self.deliver, generation, path, image, error)
+            except RuntimeError:
+                return  # Window closed
+
+    def deliver(self, generation, path, image, error):
+        if generation == self.generation:  # Drop results for selections already replaced
+            self.on_ready(path, image, error)
+
+
+class ThumbnailCache:
+    """Thumbnails stored under <folder>/.thumbs, keyed by file name, size and mtime"""
+
+    def __init__(self, directory, size=128):
+        self.directory = directory
+        self.size = size
+        self.thumb_dir = os.path.join(directory, ".thumbs")
+        os.makedirs(self.thumb_dir, exist_ok=True)
+
+    def thumb_path(self, path):
+        stat = os.stat(path)
+        key = f"{os.path.basename(path)}|{stat.st_size}|{stat.st_mtime_ns}|{self.size}"
+        return os.path.join(self.thumb_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + ".jpg")
+
+    def load(self, path):
+        """PIL thumbnail for path, generated and written to disk on first use"""
+        thumb_path = self.thumb_path(path)
+        if os.path.exists(thumb_path):
+            try:
+                image = Image.open(thumb_path)
+                image.load()
+                return image
+            except OSError:
+                pass  # Corrupt cache entry, regenerate it
+
+        image = load_scaled(path, (self.size, self.size)).convert('RGB')
+
+        temp_path = thumb_path + ".tmp"
+        image.save(temp_path, 'JPEG', quality=80)
+        os.replace(temp_path, thumb_path)
+        return image
+
+
+class ThumbnailGallery(tk.Frame):
+    """Scrollable grid of thumbnails; only the cells in view exist on the canvas"""
+
+    def __init__(self, parent, directory, on_open=None, thumb_size=128, memory_cache=512):
+        super().__init__(parent)
+        self.directory = directory
+        self.on_open = on_open  # Called with the full path on double-click
+        self.thumbs = ThumbnailCache(directory, thumb_size)
+        self.thumb_size = thumb_size
+        self.cell_width = thumb_size + 16
+        self.cell_height = thumb_size + 32
+        self.files = []  # Newest first (received names start with a timestamp)
+        self.known = set()
+        self.selected = None
+        self.columns = 1
+        self.cells = {}  # Index into files -> canvas item ids, visible cells only
+        self.render_scheduled = False
+
+        # PhotoImages are Tk objects: created and evicted on the Tk thread only
+        self.photos = OrderedDict()
+        self.memory_cache = memory_cache
+        self.failed = set()
+
+        # Thumbnail requests, newest request served first so the current view fills in before old ones
+        self.pending = []
+        self.queued = set()
+        self.wanted = set()
+        self.pending_lock = threading.Condition()
+        self.running = True
+
+        self.canvas = tk.Canvas(self, bg='white', highlightthickness=0, yscrollincrement=20)
+        scrollbar = tk.Scrollbar(self, command=self.canvas.yview)
+        scrollbar.pack(side='right', fill='y')
+        self.canvas.pack(side='left', fill='both', expand=True)
+
+        def on_view_changed(first, last):
+            scrollbar.set(first, last)
+            self.schedule_render()
+        self.canvas.configure(yscrollcommand=on_view_changed)
+
+        self.canvas.bind('<Configure>', lambda e: self.schedule_render())
+        self.canvas.bind('<Button-1>', self.on_click)
+        self.canvas.bind('<Double-Button-1>', self.on_double_click)
+        self.canvas.bind('<MouseWheel>', lambda e: self.canvas.yview_scroll(-3 if e.delta > 0 else 3, 'units'))
+        self.canvas.bind('<Button-4>', lambda e: self.canvas.yview_scroll(-3, 'units'))
+        self.canvas.bind('<Button-5>', lambda e: self.canvas.yview_scroll(3, 'units'))
+
+        threading.Thread(target=self.thumbnail_worker, daemon=True).start()
+
+    # File list
+
+    def rescan(self):
+        """List the folder on a background thread, then replace the grid contents"""
+        def scan():
+            try:
+                names = [entry.name for entry in os.scandir(self.directory)
+                         if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS)]
+            except OSError as e:
+                print(f"Gallery scan failed: {e}")
+                return
+            names.sort(reverse=True)
+            self.after(0, self.set_files, names)
+        threading.Thread(target=scan, daemon=True).start()
+
+    def set_files(self, names):
+        self.files = names
+        self.known = set(names)
+        self.clear_cells()
+        self.schedule_render()
+
+    def add(self, filename):
+        """Show a newly received file without rescanning the folder"""
+        if filename in self.known or not filename.lower().endswith(IMAGE_EXTENSIONS):
+            return
+        self.known.add(filename)
+        self.files.insert(0, filename)
+        self.clear_cells()  # Indexes shifted by one
+        self.schedule_render()
+
+    def selected_path(self):
+        return os.path.join(self.directory, self.selected) if self.selected else None
+
+    # Rendering
+
+    def schedule_render(self):
+        # Coalesce scroll/resize/arrival events into one render per idle pass
+        if not self.render_scheduled:
+            self.render_scheduled = True
+            self.after_idle(self.render)
+
+    def clear_cells(self):
+        for items in self.cells.values():
+            for item in items:
+                self.canvas.delete(item)
+        self.cells = {}
+
+    def render(self):
+        self.render_scheduled = False
+        columns = max(1, self.canvas.winfo_width() // self.cell_width)
+        if columns != self.columns:
+            self.columns = columns
+            self.clear_cells()
+        rows = (len(self.files) + columns - 1) // columns
+        self.canvas.configure(scrollregion=(0, 0, columns * self.cell_width, rows * self.cell_height))
+
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        first = max(0, int(top // self.cell_height) - 1) * columns
+        last = min(len(self.files), (int(bottom // self.cell_height) + 2) * columns)
+        visible = range(first, last)
+
+        for index in list(self.cells):
+            if index not in visible:
+                for item in self.cells.pop(index):
+                    self.canvas.delete(item)
+        for index in visible:
+            if index not in self.cells:
+                self.cells[index] = self.draw_cell(index)
+
+        self.request_thumbnails([self.files[i] for i in visible])
+
+    def draw_cell(self, index):
+        filename = self.files[index]
+        row, column = divmod(index, self.columns)
+        x = column * self.cell_width + self.cell_width // 2
+        y = row * self.cell_height
+        center_y = y + 8 + self.thumb_size // 2
+        half = self.thumb_size // 2
+        items = []
+
+        if filename == self.selected:
+            items.append(self.canvas.create_rectangle(
+                x - self.cell_width // 2 + 2, y + 2, x + self.cell_width // 2 - 2, y + self.cell_height - 2,
+                fill='#cce0ff', outline='#3d7edb'))
+
+        photo = self.photos.get(filename)
+        if photo:
+            self.photos.move_to_end(filename)
+            items.append(self.canvas.create_image(x, center_y, image=photo))
+        else:
+            items.append(self.canvas.create_rectangle(x - half, center_y - half, x + half, center_y + half,
+                                                      fill='#eeeeee', outline='#dddddd'))
+            if filename in self.failed:
+                items.append(self.canvas.create_text(x, center_y, text="unreadable", fill='gray'))
+
+        label = filename if len(filename) <= 22 else filename[:10] + "…" + filename[-10:]
+        items.append(self.canvas.create_text(x, y + self.cell_height - 14, text=label, font=('Arial', 8)))
+        return items
+
+    def redraw(self, filename):
+        for index in list(self.cells):
+            if self.files[index] == filename:
+                for item in self.cells[index]:
+                    self.canvas.delete(item)
+                self.cells[index] = self.draw_cell(index)
+
+    # Thumbnails
+
+    def request_thumbnails(self, filenames):
+        with self.pending_lock:
+            self.wanted = set(filenames)
+            for filename in reversed(filenames):
+                if filename not in self.photos and filename not in self.failed and filename not in self.queued:
+                    self.queued.add(filename)
+                    self.pending.append(filename)
+            self.pending_lock.notify()
+
+    def thumbnail_worker(self):
+        while self.running:
+            with self.pending_lock:
+                while self.running and not self.pending:
+                    self.pending_lock.wait()
+                if not self.running:
+                    return
+                filename = self.pending.pop()
+                self.queued.discard(filename)
+                if filename not in self.wanted:
+                    continue  # Scrolled out of view before we got to it
+            try:
+                image = self.thumbs.load(os.path.join(self.directory, filename))
+            except Exception as e:
+                print(f"Thumbnail failed for {filename}: {e}")
+                image = None
+            try:
+                self.after(0, self.thumbnail_ready, filename, image)
+            except RuntimeError:
+                return  # Window closed
+
+    def thumbnail_ready(self, filename, image):
+        if image is None:
+            self.failed.add(filename)
+        else:
+            self.photos[filename] = ImageTk.PhotoImage(image)
+            while len(self.photos) > self.memory_cache:
+                self.photos.popitem(last=False)
+        self.redraw(filename)
+
+    def stop(self):
+        with self.pending_lock:
+            self.running = False
+            self.pending_lock.notify()
+
+    # Mouse
+
+    def index_at(self, event):
+        column = int(self.canvas.canvasx(event.x) // self.cell_width)
+        row = int(self.canvas.canvasy(event.y) // self.cell_height)
+        index = row * self.columns + column
+        if column < self.columns and 0 <= index < len(self.files):
+            return index
+        return None
+
+    def on_click(self, event):
+        index = self.index_at(event)
+        previous, self.selected = self.selected, self.files[index] if index is not None else None
+        for filename in (previous, self.selected):
+            if filename:
+                self.redraw(filename)
+
+    def on_double_click(self, event):
+        index = self.index_at(event)
+        if index is not None and self.on_open:
+            self.on_open(os.path.join(self.directory, self.files[index]))
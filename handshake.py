@@ -0,0 +1,43 @@
+import json
+from compression import negotiate
+
+# Optional capability handshake, sent by newer clients as their first frame:
+#   client -> HELLO:{"version":2,"features":["offers","chunked","resume","zstd","zlib"],"limits":{"max_rate":0}}
+#   server -> HELLO:{"version":2,"server":"1.2","features":[...used on this connection...],"limits":{...}}
+# The server's features are what this connection will use: the client's optional features it also
+# supports, its own (dedup, resume) and the best compression codec both sides have. Its limits tell
+# the client what it will accept (max_frame, msg_rate, upload_rate, ...). A client limit of
+# max_rate (bytes/s) caps what the server sends it.
+#
+# Servers from before HELLO ignore the frame, so clients follow it with the older FEATURES: frame,
+# which a server that has answered HELLO ignores in turn. Clients that send neither keep the plain
+# newline protocol of version 1.
+
+PROTOCOL_VERSION = 2
+CLIENT_FEATURES = ('offers', 'chunked', 'resume')  # Optional behaviour a client may ask the server for
+
+
+def hello_frame(features, limits=None, **fields):
+    body = dict(fields, version=PROTOCOL_VERSION, features=list(features), limits=limits or {})
+    return f"HELLO:{json.dumps(body, separators=(',', ':'))}\n".encode('utf-8')
+
+
+def parse_hello(payload):
+    """(version, features, limits, body) from a HELLO payload; ValueError if it isn't one"""
+    body = json.loads(payload)
+    if not isinstance(body, dict):
+        raise ValueError("HELLO payload is not an object")
+    limits = body.get('limits') or {}
+    if not isinstance(limits, dict):
+        raise ValueError("HELLO limits are not an object")
+    return int(body.get('version', 1)), {str(f) for f in body.get('features', [])}, limits, body
+
+
+def select_features(offered, server_features, client_features=CLIENT_FEATURES, compress=True):
+    """Features a connection uses, server side: shared optional ones, our own, and one codec"""
+    features = [f for f in client_features if f in offered]
+    features += [f for f in server_features if f not in features]
+    codec = negotiate(offered) if compress else None
+    if codec:
+        features.append(codec)
+    return features
@@ -6,15 +6,35 @@ import base64
 import os
 import json
 from datetime import datetime
-from PIL import Image, ImageTk
+from PIL import ImageTk
+from message_log import MessageLog
+from transfer import UploadQueue, format_queue_stats
+from content_cache import ContentCache, sha256_bytes
+from handshake import hello_frame, parse_hello
+import image_prep
+from gallery import ThumbnailGallery, PreviewLoader, load_scaled
 
 class ImageClient:
-    def __init__(self):
+    def __init__(self, mirror_console=False, max_in_flight=4, preprocessor=None, preprocess=False):
         self.client_socket = None
+        self.mirror_console = mirror_console  # Also print activity log lines to stdout
+        self.send_lock = threading.Lock()  # Keeps frames from the GUI and upload threads whole
+        # Optional downscale/recompress before upload, toggled from the GUI
+        self.preprocessor = preprocessor or image_prep.UploadPreprocessor()
+        self.preprocess_enabled = preprocess
+        # Uploads survive reconnects: unacknowledged files are re-sent on resume
+        self.upload_queue = UploadQueue(
+            self.send_frame, max_in_flight,
+            on_progress=lambda stats: self.root.after(0, self.update_upload_progress, stats),
+            on_file_done=self.upload_file_done,
+            prepare=self.prepare_upload
+        )
         self.connected = False
         self.running = False
         self.received_images_dir = "client_received_images"
         self.setup_directories()
+        # Content-addressed index of received images, used for conditional downloads
+        self.cache = ContentCache(self.received_images_dir)
         self.setup_gui()
         
     def setup_directories(self):
@@ -54,8 +74,8 @@ class ImageClient:
         self.notebook.pack(fill='both', expand=True)
         
         # Send Image Tab
-        self.send_frame = tk.Frame(self.notebook)
-        self.notebook.add(self.send_frame, text="Send Images")
+        self.send_tab = tk.Frame(self.notebook)
+        self.notebook.add(self.send_tab, text="Send Images")
         self.setup_send_tab()
         
         # Receive Images Tab
@@ -82,7 +102,7 @@ class ImageClient:
     
     def setup_send_tab(self):
         # Image selection frame
-        select_frame = tk.Frame(self.send_frame)
+        select_frame = tk.Frame(self.send_tab)
         select_frame.pack(pady=10, fill='x')
         
         tk.Button(select_frame, text="Select Image", command=self.select_image).pack(side='left')
@@ -93,8 +113,26 @@ class ImageClient:
                                        command=self.send_image, state='disabled')
         self.send_image_btn.pack(side='right')
         
+        self.batch_upload_btn = tk.Button(select_frame, text="Batch Upload...", command=self.batch_upload)
+        self.batch_upload_btn.pack(side='right', padx=5)
+        
+        self.preprocess_var = tk.BooleanVar(value=self.preprocess_enabled)
+        tk.Checkbutton(select_frame, text=f"Shrink to {self.preprocessor.max_dimension}px",
+                       variable=self.preprocess_var, command=self.toggle_preprocess).pack(side='right', padx=5)
+        
+        # Upload progress, throughput and cancel
+        progress_frame = tk.Frame(self.send_tab)
+        progress_frame.pack(fill='x')
+        
+        self.upload_progress = ttk.Progressbar(progress_frame, mode='determinate', maximum=100)
+        self.upload_progress.pack(side='left', fill='x', expand=True)
+        self.upload_status_label = tk.Label(progress_frame, text="", fg="gray", width=32, anchor='w')
+        self.upload_status_label.pack(side='left', padx=5)
+        self.cancel_upload_btn = tk.Button(progress_frame, text="Cancel", command=self.cancel_upload, state='disabled')
+        self.cancel_upload_btn.pack(side='right')
+        
         # Image preview frame
-        preview_frame = tk.Frame(self.send_frame)
+        preview_frame = tk.Frame(self.send_tab)
         preview_frame.pack(pady=10, fill='both', expand=True)
         
         tk.Label(preview_frame, text="Image Preview:", font=('Arial', 12, 'bold')).pack(anchor='w')
@@ -102,6 +140,7 @@ class ImageClient:
         self.preview_label = tk.Label(preview_frame, text="No image selected", 
                                     bg='lightgray', width=40, height=15)
         self.preview_label.pack(pady=5)
+        self.preview_loader = PreviewLoader(self.preview_label, (300, 300), self.apply_preview)
         
         self.selected_image_path = None
     
@@ -112,18 +151,9 @@ class ImageClient:
         
         tk.Label(list_frame, text="Received Images:", font=('Arial', 12, 'bold')).pack(anchor='w')
         
-        # Listbox with scrollbar
-        listbox_frame = tk.Frame(list_frame)
-        listbox_frame.pack(fill='both', expand=True, pady=5)
-        
-        scrollbar = tk.Scrollbar(listbox_frame)
-        scrollbar.pack(side='right', fill='y')
-        
-        self.received_listbox = tk.Listbox(listbox_frame, yscrollcommand=scrollbar.set)
-        self.received_listbox.pack(side='left', fill='both', expand=True)
-        scrollbar.config(command=self.received_listbox.yview)
-        
-        self.received_listbox.bind('<Double-Button-1>', self.view_received_image)
+        # Thumbnail grid; only visible cells are drawn and thumbnails are cached in .thumbs/
+        self.gallery = ThumbnailGallery(list_frame, self.received_images_dir, on_open=self.open_image_viewer)
+        self.gallery.pack(fill='both', expand=True, pady=5)
         
         # Buttons for received images
         recv_btn_frame = tk.Frame(list_frame)
@@ -166,6 +196,7 @@ class ImageClient:
         tk.Label(log_frame, text="Activity Log:", font=('Arial', 10, 'bold')).pack(anchor='w')
         self.activity_log = scrolledtext.ScrolledText(log_frame, height=8, font=('Consolas', 9))
         self.activity_log.pack(fill='x', pady=5)
+        self.activity_log_model = MessageLog(self.root, self.activity_log, mirror_console=self.mirror_console)
     
     def connect_to_server(self):
         if self.connected:
@@ -199,9 +230,18 @@ class ImageClient:
             receive_thread.daemon = True
             receive_thread.start()
             
+            # Ask for IMAGE_OFFER instead of full pushes so cached images are not re-sent;
+            # HELLO for current servers, FEATURES for ones from before it
+            self.send_frame(hello_frame(['offers'], client="image_client.py"))
+            self.send_frame(b"FEATURES:offers\n")
+            
             # Request server images list
             self.request_server_images()
             
+            # Continue any upload batch interrupted by a previous disconnect, once the server's
+            # HELLO or FEATURES reply says whether it can dedup and resume
+            self.upload_queue.await_features()
+            
         except Exception as e:
             messagebox.showerror("Connection Error", f"Failed to connect: {str(e)}")
             self.cleanup_connection()
@@ -226,11 +266,11 @@ class ImageClient:
                 continue
             except Exception as e:
                 if self.running:
-                    self.root.after(0, lambda: self.log_activity(f"Connection error: {e}"))
+                    self.log_activity(f"Connection error: {e}")
                 break
         
         if self.running:
-            self.root.after(0, lambda: self.log_activity("Connection lost to server"))
+            self.log_activity("Connection lost to server")
             self.root.after(0, self.cleanup_connection)
     
     def process_server_message(self, message):
@@ -244,7 +284,7 @@ class ImageClient:
                 # Handle notification of image from another client
                 data = message[15:]  # Remove 'IMAGE_RECEIVED:' prefix
                 sender_ip, filename = data.split('|', 1)
-                self.root.after(0, lambda: self.log_activity(f"Image received from {sender_ip}: {filename}"))
+                self.log_activity(f"Image received from {sender_ip}: {filename}")
                 
             elif message.startswith('IMAGE_LIST:'):
                 # Handle server images list
@@ -252,13 +292,66 @@ class ImageClient:
                 image_list = json.loads(data)
                 self.root.after(0, lambda: self.update_server_images_list(image_list))
                 
+            elif message.startswith('IMAGE_DONE:'):
+                # Server stored one of our chunked uploads
+                self.upload_queue.acknowledge(message[11:].strip())
+                
+            elif message.startswith('IMAGE_FAILED:'):
+                transfer_id, _, reason = message[13:].partition('|')
+                self.upload_queue.fail(transfer_id, reason)
+                
+            elif message.startswith('IMAGE_MISSING:'):
+                # Server doesn't have the bytes we offered by hash; upload them
+                self.upload_queue.missing(message[14:].strip())
+                
+            elif message.startswith('FEATURES:'):
+                # Features the server supports; dedup lets uploads of known content be skipped
+                self.upload_queue.server_features({f.strip() for f in message[9:].split(',')})
+                
+            elif message.startswith('HELLO:'):
+                # Handshake reply: server version and the features this connection uses
+                try:
+                    version, features, limits, body = parse_hello(message[6:])
+                except (ValueError, TypeError) as e:
+                    self.log_activity(f"Bad HELLO from server: {e}")
+                    return
+                self.upload_queue.server_features(features)
+                self.log_activity(f"Server {body.get('server', '?')} (protocol {version})")
+                
+            elif message.startswith('IMAGE_OFFSET:'):
+                # Server has this much of an interrupted upload; the rest follows
+                transfer_id, _, offset = message[13:].strip().partition('|')
+                self.upload_queue.offset_reply(transfer_id, offset)
+                
+            elif message.startswith('IMAGE_OFFER:'):
+                # Server is pushing an image: fetch it only if we don't hold these bytes
+                filename, digest, size = message[12:].strip().split('|')
+                cached_path = self.cache.lookup(digest)
+                if cached_path:
+                    self.cache.remember(filename, digest)
+                    self.log_activity(f"Server pushed {filename}, already cached as {os.path.basename(cached_path)}")
+                else:
+                    self.send_frame(f"REQUEST_IMAGE:{filename}\n".encode('utf-8'))
+                    self.log_activity(f"Server pushed {filename} ({int(size) // 1024} KB), downloading")
+                
+            elif message.startswith('NOT_MODIFIED:'):
+                # Conditional download: our cached copy is current
+                filename, _, digest = message[13:].strip().partition('|')
+                cached_path = self.cache.lookup(digest)
+                self.log_activity(f"{filename} unchanged, using cached copy "
+                                  f"{os.path.basename(cached_path) if cached_path else ''}")
+                
+            elif message.startswith('CONNECTION_REJECTED:'):
+                # Server hit a hard limit for this connection and is closing it
+                self.log_activity(f"Server closed the connection: {message[20:].strip()}")
+                
             elif message.startswith('IMAGE_ERROR:'):
                 # Handle image error
                 error = message[12:]  # Remove 'IMAGE_ERROR:' prefix
-                self.root.after(0, lambda: self.log_activity(f"Error: {error}"))
+                self.log_activity(f"Error: {error}")
                 
         except Exception as e:
-            self.root.after(0, lambda: self.log_activity(f"Error processing message: {e}"))
+            self.log_activity(f"Error processing message: {e}")
     
     def handle_received_image(self, image_data, source):
         try:
@@ -273,6 +366,14 @@ class ImageClient:
             # Decode base64 image data
             image_bytes = base64.b64decode(base64_data)
             
+            # Same bytes already on disk: just record the name, don't store a duplicate
+            digest = sha256_bytes(image_bytes)
+            cached_path = self.cache.lookup(digest)
+            if cached_path:
+                self.cache.remember(filename, digest)
+                self.log_activity(f"Image {filename} already cached as {os.path.basename(cached_path)}")
+                return
+            
             # Generate unique filename with timestamp
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             saved_filename = f"{timestamp}_{source}_{filename}"
@@ -281,12 +382,13 @@ class ImageClient:
             # Save image to file
             with open(filepath, 'wb') as f:
                 f.write(image_bytes)
+            self.cache.add(filepath, name=filename, data=image_bytes)
             
-            self.root.after(0, lambda: self.log_activity(f"Image saved: {saved_filename}"))
-            self.root.after(0, self.refresh_received_list)
+            self.log_activity(f"Image saved: {saved_filename}")
+            self.root.after(0, self.gallery.add, saved_filename)
             
         except Exception as e:
-            self.root.after(0, lambda: self.log_activity(f"Error saving image: {e}"))
+            self.log_activity(f"Error saving image: {e}")
     
     def select_image(self):
         filetypes = [
@@ -308,40 +410,74 @@ class ImageClient:
             self.show_image_preview(filename)
     
     def show_image_preview(self, image_path):
-        try:
-            # Open and resize image for preview
-            image = Image.open(image_path)
-            image.thumbnail((300, 300), Image.Resampling.LANCZOS)
-            photo = ImageTk.PhotoImage(image)
-            
-            self.preview_label.config(image=photo, text="")
-            self.preview_label.image = photo  # Keep reference
-            
-        except Exception as e:
-            self.preview_label.config(image="", text=f"Preview error: {e}")
+        # Decoded off the Tk thread; picking another file before it finishes discards this one
+        self.preview_label.config(text="Loading preview...")
+        self.preview_loader.load(image_path)
+    
+    def apply_preview(self, image_path, image, error):
+        if error:
+            self.preview_label.config(image="", text=f"Preview error: {error}")
+            return
+        photo = ImageTk.PhotoImage(image)
+        self.preview_label.config(image=photo, text="")
+        self.preview_label.image = photo  # Keep reference
     
     def send_image(self):
         if not (self.connected and self.selected_image_path):
             return
             
-        try:
-            # Read image file
-            with open(self.selected_image_path, 'rb') as f:
-                image_data = f.read()
-            
-            # Encode image as base64
-            base64_data = base64.b64encode(image_data).decode('utf-8')
-            filename = os.path.basename(self.selected_image_path)
-            
-            # Send image to server
-            message = f"IMAGE:{filename}|{base64_data}\n"
-            self.client_socket.send(message.encode('utf-8'))
-            
-            self.log_activity(f"Image sent: {filename}")
-            
-        except Exception as e:
-            messagebox.showerror("Send Error", f"Failed to send image: {e}")
-            self.log_activity(f"Send error: {e}")
+        # Stream the file in chunks on the background upload queue
+        self.upload_queue.add([self.selected_image_path])
+        self.log_activity(f"Uploading {os.path.basename(self.selected_image_path)}...")
+    
+    def batch_upload(self):
+        """Queue several images, or a whole folder when none are picked, for pipelined upload"""
+        paths = filedialog.askopenfilenames(
+            title="Select Images (Cancel to pick a folder)",
+            filetypes=[("Image files", "*.png *.jpg *.jpeg *.gif *.bmp"), ("All files", "*.*")]
+        )
+        if not paths:
+            directory = filedialog.askdirectory(title="Select Folder to Upload")
+            if not directory:
+                return
+            paths = sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                           if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')))
+        added = self.upload_queue.add(paths)
+        self.log_activity(f"Queued {added} images for upload")
+    
+    def send_frame(self, frame):
+        """Send one complete frame from any thread without interleaving with other frames"""
+        with self.send_lock:
+            if not self.client_socket:
+                raise ConnectionError("Not connected")
+            self.client_socket.sendall(frame)
+    
+    def update_upload_progress(self, stats):
+        total = stats['bytes_total']
+        self.upload_progress['value'] = stats['bytes_sent'] * 100 / total if total else 0
+        self.upload_status_label.config(text=format_queue_stats(stats), fg="black")
+        self.cancel_upload_btn.config(state='normal' if stats['active'] else 'disabled')
+    
+    def upload_file_done(self, status, path, message):
+        if status == 'done':
+            self.log_activity(f"Image sent: {os.path.basename(path)}")
+        elif status == 'cancelled':
+            self.log_activity(message)
+        else:
+            self.log_activity(f"Send error: {os.path.basename(path)}: {message}")
+    
+    def cancel_upload(self):
+        self.upload_queue.cancel()
+    
+    def toggle_preprocess(self):
+        # Mirrored into a plain attribute because the upload thread can't read Tk variables
+        self.preprocess_enabled = self.preprocess_var.get()
+    
+    def prepare_upload(self, path):
+        """Upload queue hook (background thread): shrink and recompress the image if enabled"""
+        if self.preprocess_enabled:
+            return self.preprocessor(path)
+        return path, None
     
     def request_server_images(self):
         if not self.connected:
@@ -349,7 +485,7 @@ class ImageClient:
             
         try:
             message = "REQUEST_LIST\n"
-            self.client_socket.send(message.encode('utf-8'))
+            self.send_frame(message.encode('utf-8'))
             self.log_activity("Requested server images list")
             
         except Exception as e:
@@ -373,38 +509,39 @@ class ImageClient:
         filename = self.server_listbox.get(selection[0])
         
         try:
-            message = f"REQUEST_IMAGE:{filename}\n"
-            self.client_socket.send(message.encode('utf-8'))
+            # Send the hash of our cached copy so the server can answer NOT_MODIFIED
+            known_hash = self.cache.hash_for_name(filename)
+            message = f"REQUEST_IMAGE:{filename}|{known_hash}\n" if known_hash else f"REQUEST_IMAGE:{filename}\n"
+            self.send_frame(message.encode('utf-8'))
             self.log_activity(f"Requested image: {filename}")
             
         except Exception as e:
             self.log_activity(f"Error requesting image: {e}")
     
     def refresh_received_list(self):
-        self.received_listbox.delete(0, tk.END)
-        
-        if os.path.exists(self.received_images_dir):
-            images = [f for f in os.listdir(self.received_images_dir) 
-                     if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp'))]
-            images.sort(reverse=True)  # Newest first
-            
-            for image in images:
-                self.received_listbox.insert(tk.END, image)
+        # Full folder rescan; new arrivals are added to the gallery incrementally
+        self.gallery.rescan()
     
     def view_received_image(self, event=None):
-        selection = self.received_listbox.curselection()
-        if not selection:
+        filepath = self.gallery.selected_path()
+        if filepath and os.path.exists(filepath):
+            self.open_image_viewer(filepath)
+    
+    def open_image_viewer(self, filepath):
+        # Show an image in its own window, scaled to fit the screen
+        try:
+            limit = (int(self.root.winfo_screenwidth() * 0.9), int(self.root.winfo_screenheight() * 0.85))
+            photo = ImageTk.PhotoImage(load_scaled(filepath, limit))
+        except Exception as e:
+            messagebox.showerror("Error", f"Could not open image: {e}")
             return
-            
-        filename = self.received_listbox.get(selection[0])
-        filepath = os.path.join(self.received_images_dir, filename)
         
-        if os.path.exists(filepath):
-            try:
-                # Open image with default system viewer
-                os.startfile(filepath)
-            except:
-                messagebox.showerror("Error", "Could not open image")
+        viewer = tk.Toplevel(self.root)
+        viewer.title(os.path.basename(filepath))
+        label = tk.Label(viewer, image=photo)
+        label.image = photo  # Keep reference
+        label.pack()
+        viewer.bind('<Escape>', lambda e: viewer.destroy())
     
     def open_received_folder(self):
         try:
@@ -415,8 +552,8 @@ class ImageClient:
     def log_activity(self, message):
         timestamp = datetime.now().strftime("%H:%M:%S")
         log_entry = f"[{timestamp}] {message}\n"
-        self.activity_log.insert(tk.END, log_entry)
-        self.activity_log.see(tk.END)
+        # Safe from any thread: lines are coalesced into one widget update per frame
+        self.activity_log_model.append(log_entry)
     
     def disconnect_from_server(self):
         self.running = False
@@ -426,6 +563,7 @@ class ImageClient:
     def cleanup_connection(self):
         self.connected = False
         self.running = False
+        self.upload_queue.suspend()
         
         if self.client_socket:
             try:
@@ -442,6 +580,7 @@ class ImageClient:
         self.send_image_btn.config(state='disabled')
     
     def on_closing(self):
+        self.gallery.stop()
         self.disconnect_from_server()
         self.root.destroy()
     
@@ -452,7 +591,14 @@ class ImageClient:
 
 def main():
     try:
-        client = ImageClient()
+        import argparse
+        parser = argparse.ArgumentParser(description="Image transfer client")
+        parser.add_argument('--log-console', action='store_true', help="mirror the activity log to stdout")
+        parser.add_argument('--max-in-flight', type=int, default=4,
+                            help="uploads streamed ahead of the server's acknowledgement (default: 4)")
+        image_prep.add_arguments(parser)
+        args = parser.parse_args()
+        client = ImageClient(args.log_console, args.max_in_flight, image_prep.from_args(args), args.preprocess)
         client.run()
     except Exception as e:
         print(f"Error starting client: {e}")
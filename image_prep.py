@@ -0,0 +1,88 @@
+import os
+import tempfile
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+# Optional client-side downscale / recompress step run before an image is uploaded
+
+ORIENTATION = 0x0112  # EXIF tag
+
+
+class UploadPreprocessor:
+    """Shrink images to max_dimension and re-encode them as JPEG or WebP, optionally stripping EXIF"""
+
+    def __init__(self, max_dimension=1280, quality=85, image_format='JPEG', strip_exif=True):
+        self.max_dimension = max_dimension  # 0 keeps the original resolution
+        self.quality = quality
+        self.image_format = image_format.upper()
+        self.strip_exif = strip_exif
+        self.temp_dir = os.path.join(tempfile.gettempdir(), "upload_prep")
+        os.makedirs(self.temp_dir, exist_ok=True)
+
+    def __call__(self, path):
+        """UploadQueue prepare hook: return (send_path, send_filename)"""
+        return self.process(path)
+
+    def process(self, path):
+        if not PIL_AVAILABLE:
+            return path, None
+
+        image = Image.open(path)
+        if getattr(image, 'is_animated', False):
+            return path, None  # Re-encoding would drop animation frames
+
+        if self.max_dimension and image.format == 'JPEG':
+            # Let the JPEG decoder downscale by 1/2, 1/4 or 1/8 while decoding
+            image.draft('RGB', (self.max_dimension, self.max_dimension))
+        image = ImageOps.exif_transpose(image)  # Bake in orientation before the EXIF tag is dropped
+        # Taken after the transpose: the pixels are upright now, so Orientation must not travel with them
+        exif = image.getexif()
+        exif.pop(ORIENTATION, None)
+
+        if self.max_dimension and max(image.size) > self.max_dimension:
+            image.thumbnail((self.max_dimension, self.max_dimension), Image.Resampling.LANCZOS)
+
+        extension = '.webp' if self.image_format == 'WEBP' else '.jpg'
+        keep_alpha = self.image_format == 'WEBP' and image.mode in ('RGBA', 'LA')
+        image = image.convert('RGBA' if keep_alpha else 'RGB')
+
+        base_name = os.path.splitext(os.path.basename(path))[0]
+        fd, out_path = tempfile.mkstemp(suffix=extension, prefix=f"{base_name}_", dir=self.temp_dir)
+        options = {'quality': self.quality}
+        if self.image_format == 'JPEG':
+            options['optimize'] = True
+        if len(exif) and not self.strip_exif:
+            options['exif'] = exif.tobytes()
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, self.image_format, **options)
+
+        original_size = os.path.getsize(path)
+        new_size = os.path.getsize(out_path)
+        if new_size >= original_size:
+            # Already small and well compressed: the original is the better upload
+            os.remove(out_path)
+            return path, None
+
+        print(f"Preprocessed {os.path.basename(path)}: {original_size} -> {new_size} bytes "
+              f"({100 - new_size * 100 // original_size}% smaller)")
+        return out_path, base_name + extension
+
+
+def add_arguments(parser):
+    """Register the preprocessing command line options on an argparse parser"""
+    parser.add_argument('--preprocess', action='store_true',
+                        help="downscale and recompress images before uploading")
+    parser.add_argument('--max-dimension', type=int, default=1280,
+                        help="longest side after downscaling, 0 keeps resolution (default: 1280)")
+    parser.add_argument('--quality', type=int, default=85, help="JPEG/WebP quality (default: 85)")
+    parser.add_argument('--format', dest='image_format', choices=('jpeg', 'webp'), default='jpeg',
+                        help="upload encoding (default: jpeg)")
+    parser.add_argument('--keep-exif', action='store_true', help="keep EXIF metadata (stripped by default)")
+
+
+def from_args(args):
+    """Build an UploadPreprocessor from parsed add_arguments() options"""
+    return UploadPreprocessor(args.max_dimension, args.quality, args.image_format, not args.keep_exif)
@@ -5,18 +5,34 @@ import base64
 import os
 import json
 from datetime import datetime
+from transfer import UploadAssembler
+from content_cache import HashCache, ContentStore
+from discovery import DiscoveryResponder, SERVER_VERSION
+from handshake import hello_frame, parse_hello, select_features
+from buffers import (MemoryBudget, FrameBuffer, SpilledFrame, InboundLimitError, decode_spilled_image,
+                     add_budget_arguments, budget_from_args)
+from netconfig import SocketTuning, add_tuning_arguments, tuning_from_args
 
 class ImageServer:
-    def __init__(self, host='0.0.0.0', port=12346):
+    def __init__(self, host='0.0.0.0', port=12346, discovery=True, memory_budget=None, tuning=None):
         self.host = host
         self.port = port
+        self.discovery = DiscoveryResponder(self.discovery_info) if discovery else None
         self.clients = []
         self.clients_lock = threading.Lock()
+        # Reader threads (replies) and the console (server images) share each socket; one frame at a time
+        self.send_locks = {}
+        self.budget = memory_budget or MemoryBudget()
+        self.inbound = {}  # client_address -> FrameBuffer
+        self.tuning = tuning or SocketTuning()
         self.server_socket = None
         self.running = False
         self.received_images_dir = "received_images"
         self.server_images_dir = "server_images"
         self.setup_directories()
+        self.uploads = UploadAssembler(os.path.join(self.received_images_dir, ".partial"))
+        self.store = ContentStore(os.path.join(self.received_images_dir, ".store"))
+        self.hashes = HashCache()
     
     def setup_directories(self):
         """Create directories for storing images"""
@@ -28,20 +44,26 @@ class ImageServer:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
+            self.tuning.listen(self.server_socket)
             self.running = True
             
             print(f"Image Server started on {self.host}:{self.port}")
+            if self.discovery:
+                self.discovery.start()
             print("Waiting for connections...")
             
             while self.running:
                 try:
                     client_socket, client_address = self.server_socket.accept()
                     print(f"Image client connected: {client_address}")
+                    self.tuning.apply(client_socket)
                     with self.clients_lock:
+                        self.send_locks[client_socket] = threading.Lock()
                         self.clients.append({
                             'socket': client_socket,
-                            'address': client_address
+                            'address': client_address,
+                            'features': set(),
+                            'protocol': None  # Version from HELLO, None for older clients
                         })
                     
                     # Handle client in separate thread
@@ -60,30 +82,52 @@ class ImageServer:
         finally:
             self.cleanup()
     
+    def discovery_info(self):
+        """Fields for UDP discovery replies"""
+        with self.clients_lock:
+            clients = len(self.clients)
+        return {'service': 'image', 'name': socket.gethostname(), 'port': self.port, 'clients': clients}
+    
     def handle_client(self, client_socket, client_address):
-        buffer = b""
+        inbound = FrameBuffer(self.budget)
+        self.inbound[client_address] = inbound
+        last_observed = time.time()
         try:
             while self.running:
                 try:
-                    data = client_socket.recv(4096)
+                    data = client_socket.recv(self.tuning.recv_size)
                     if not data:
                         break
-                    
-                    buffer += data
+                    if time.time() - last_observed >= 1.0:
+                        last_observed = time.time()
+                        self.tuning.observe(client_socket)
                     
                     # Process complete messages
-                    while b'\n' in buffer:
-                        line, buffer = buffer.split(b'\n', 1)
-                        if line:
+                    for line in inbound.feed(data):
+                        if isinstance(line, SpilledFrame):
+                            self.handle_spilled_frame(line, client_address)
+                        elif line:
                             self.process_message(line, client_socket, client_address)
                             
                 except socket.error:
                     break
                     
+        except InboundLimitError as e:
+            self.budget.record_rejection()
+            print(f"Rejecting {client_address}: {e}")
+            try:
+                self.send_to(client_socket, f"CONNECTION_REJECTED:{e}\n".encode('utf-8'))
+            except Exception:
+                pass
         except Exception as e:
             print(f"Error handling client {client_address}: {e}")
         finally:
+            inbound.close()
+            self.inbound.pop(client_address, None)
             self.remove_client(client_socket)
+            with self.clients_lock:
+                self.send_locks.pop(client_socket, None)
+            self.uploads.detach(client_address)  # Partial uploads stay resumable after a reconnect
             try:
                 client_socket.close()
             except:
@@ -99,18 +143,77 @@ class ImageServer:
                 image_data = message_str[6:]  # Remove 'IMAGE:' prefix
                 self.handle_received_image(image_data, sender_address)
                 
+            elif message_str.startswith(('IMAGE_BEGIN:', 'IMAGE_CHUNK:', 'IMAGE_END:', 'IMAGE_CANCEL:', 'IMAGE_LINK:',
+                                         'IMAGE_RESUME:')):
+                # Chunked upload frames, or a store-by-hash request
+                self.handle_upload_frame(message_str.strip(), sender_socket, sender_address)
+                
             elif message_str.startswith('REQUEST_LIST'):
                 # Send list of available server images
                 self.send_image_list(sender_socket)
                 
             elif message_str.startswith('REQUEST_IMAGE:'):
-                # Send specific image to client
-                filename = message_str[14:]  # Remove 'REQUEST_IMAGE:' prefix
-                self.send_image_to_client(filename, sender_socket)
+                # Send specific image to client (format: filename[|sha256 the client already has])
+                filename, _, known_hash = message_str[14:].strip().partition('|')
+                self.send_image_to_client(filename, sender_socket, known_hash)
+                
+            elif message_str.startswith('HELLO:'):
+                # Capability handshake (handshake.py): same features as FEATURES, plus version and limits
+                try:
+                    version, offered, limits, body = parse_hello(message_str[6:])
+                except (ValueError, TypeError) as e:
+                    print(f"Ignoring malformed HELLO from {sender_address}: {e}")
+                    return
+                self.set_client_info(sender_socket, features=offered, protocol=version)
+                features = select_features(offered, ('dedup', 'resume'), ('offers',), compress=False)
+                print(f"Client {sender_address} HELLO: protocol {version}, {body.get('client', 'unknown client')}")
+                self.send_to(sender_socket, hello_frame(features, {'max_frame': self.budget.max_frame}, server=SERVER_VERSION))
+                
+            elif message_str.startswith('FEATURES:'):
+                # Optional protocol features the client understands; ignored once agreed by HELLO
+                if self.get_client_info(sender_socket).get('protocol'):
+                    return
+                features = {f.strip() for f in message_str[9:].split(',') if f.strip()}
+                self.set_client_info(sender_socket, features=features)
+                self.send_to(sender_socket, b"FEATURES:dedup,resume\n")
+                
+            elif message_str.startswith('TEST_CONNECTION'):
+                # test_connection.py probe
+                self.send_to(sender_socket, f"TEST_OK:{SERVER_VERSION}\n".encode('ascii'))
                 
         except Exception as e:
             print(f"Error processing message: {e}")
     
+    def get_client_info(self, client_socket):
+        with self.clients_lock:
+            for client_info in self.clients:
+                if client_info['socket'] == client_socket:
+                    return dict(client_info)
+        return {}
+    
+    def set_client_info(self, client_socket, **fields):
+        with self.clients_lock:
+            for client_info in self.clients:
+                if client_info['socket'] == client_socket:
+                    client_info.update(fields)
+    
+    def handle_spilled_frame(self, frame, sender_address):
+        """Frame too large for the memory budget: decode images from the temp file, drop anything else"""
+        try:
+            if frame.startswith(b'IMAGE:'):
+                original_filename, temp_path = decode_spilled_image(frame, b'IMAGE:', lambda name: self.store.temp_path())
+                filepath = self.received_image_path(original_filename, sender_address)
+                self.store.put_file(temp_path, filepath)
+                print(f"Image received and saved: {os.path.basename(filepath)} ({frame.size} byte frame, spilled to disk)")
+                self.broadcast_image_notification(os.path.basename(filepath), sender_address)
+            else:
+                kind = frame.head[:32].split(b':', 1)[0].decode('ascii', errors='replace')
+                print(f"Dropped oversized {kind} frame from {sender_address} ({frame.size} bytes)")
+        except Exception as e:
+            print(f"Error handling spilled frame: {e}")
+        finally:
+            frame.close()
+    
     def handle_received_image(self, image_data_str, sender_address):
         try:
             # Parse image data (format: filename|base64_data)
@@ -125,14 +228,11 @@ class ImageServer:
             image_bytes = base64.b64decode(base64_data)
             
             # Generate unique filename with timestamp
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            sender_ip = sender_address[0].replace('.', '_')
-            filename = f"{timestamp}_{sender_ip}_{original_filename}"
-            filepath = os.path.join(self.received_images_dir, filename)
+            filepath = self.received_image_path(original_filename, sender_address)
+            filename = os.path.basename(filepath)
             
-            # Save image to file
-            with open(filepath, 'wb') as f:
-                f.write(image_bytes)
+            # Save image to the deduplicating store
+            self.store.put_bytes(image_bytes, filepath)
             
             print(f"Image received and saved: {filename}")
             
@@ -142,6 +242,67 @@ class ImageServer:
         except Exception as e:
             print(f"Error handling received image: {e}")
     
+    def received_image_path(self, original_filename, sender_address):
+        """Timestamped path under received_images/ for an upload"""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        sender_ip = sender_address[0].replace('.', '_')
+        filename = f"{timestamp}_{sender_ip}_{os.path.basename(original_filename)}"
+        return os.path.join(self.received_images_dir, filename)
+    
+    def handle_upload_frame(self, message_str, sender_socket, sender_address):
+        """Handle IMAGE_BEGIN / IMAGE_CHUNK / IMAGE_END / IMAGE_CANCEL frames"""
+        command, payload = message_str.split(':', 1)
+        try:
+            if command == 'IMAGE_BEGIN':
+                self.uploads.begin(sender_address, payload)
+            elif command == 'IMAGE_CHUNK':
+                self.uploads.chunk(sender_address, payload)
+            elif command == 'IMAGE_END':
+                original_filename, temp_path, _ = self.uploads.end(sender_address, payload)
+                filepath = self.received_image_path(original_filename, sender_address)
+                self.store.put_file(temp_path, filepath)
+                self.send_to(sender_socket, f"IMAGE_DONE:{payload}\n".encode('utf-8'))
+                print(f"Image received and saved: {os.path.basename(filepath)}")
+                self.broadcast_image_notification(os.path.basename(filepath), sender_address)
+            elif command == 'IMAGE_CANCEL':
+                self.uploads.cancel(sender_address, payload)
+            elif command == 'IMAGE_RESUME':
+                # IMAGE_RESUME:<id>|<filename>|<size>: continue an upload after a reconnect
+                transfer_id, original_filename, size = payload.split('|', 2)
+                offset = self.uploads.resume(sender_address, transfer_id, original_filename, size)
+                if offset is None:
+                    self.send_to(sender_socket, f"IMAGE_DONE:{transfer_id}\n".encode('utf-8'))
+                else:
+                    self.send_to(sender_socket, f"IMAGE_OFFSET:{transfer_id}|{offset}\n".encode('utf-8'))
+                    print(f"Upload {transfer_id} resumed by {sender_address} at byte {offset}")
+            elif command == 'IMAGE_LINK':
+                # IMAGE_LINK:<id>|<filename>|<size>|<sha256>: the client uploads only if we answer IMAGE_MISSING
+                transfer_id, original_filename, _, digest = payload.split('|', 3)
+                filepath = self.received_image_path(original_filename, sender_address)
+                if not self.store.link(digest, filepath):
+                    self.send_to(sender_socket, f"IMAGE_MISSING:{transfer_id}\n".encode('utf-8'))
+                    return
+                self.send_to(sender_socket, f"IMAGE_DONE:{transfer_id}\n".encode('utf-8'))
+                print(f"Image stored by hash, upload skipped: {os.path.basename(filepath)}")
+                self.broadcast_image_notification(os.path.basename(filepath), sender_address)
+        except Exception as e:
+            print(f"Upload error from {sender_address}: {e}")
+            transfer_id = payload.split('|', 1)[0]
+            try:
+                self.send_to(sender_socket, f"IMAGE_FAILED:{transfer_id}|{e}\n".encode('utf-8'))
+            except Exception:
+                pass
+    
+    def send_to(self, client_socket, data):
+        """Write one whole frame; sendall under the socket's lock so frames never interleave"""
+        with self.clients_lock:
+            lock = self.send_locks.get(client_socket)
+        if lock is None:
+            client_socket.sendall(data)
+            return
+        with lock:
+            client_socket.sendall(data)
+    
     def broadcast_image_notification(self, filename, sender_address):
         """Notify all clients about new image"""
         notification = f"IMAGE_RECEIVED:{sender_address[0]}|{filename}\n"
@@ -152,7 +313,7 @@ class ImageServer:
         for client_info in clients_copy:
             if client_info['address'] != sender_address:  # Don't send back to sender
                 try:
-                    client_info['socket'].send(notification.encode('utf-8'))
+                    self.send_to(client_info['socket'], notification.encode('utf-8'))
                 except:
                     self.remove_client(client_info['socket'])
     
@@ -167,18 +328,23 @@ class ImageServer:
             
             image_list = json.dumps(images)
             message = f"IMAGE_LIST:{image_list}\n"
-            client_socket.send(message.encode('utf-8'))
+            self.send_to(client_socket, message.encode('utf-8'))
             
         except Exception as e:
             print(f"Error sending image list: {e}")
     
-    def send_image_to_client(self, filename, client_socket):
-        """Send specific image to client"""
+    def send_image_to_client(self, filename, client_socket, known_hash=''):
+        """Send specific image to client, or NOT_MODIFIED if its cached copy is current"""
         try:
             filepath = os.path.join(self.server_images_dir, filename)
             if not os.path.exists(filepath):
                 error_msg = f"IMAGE_ERROR:File not found: {filename}\n"
-                client_socket.send(error_msg.encode('utf-8'))
+                self.send_to(client_socket, error_msg.encode('utf-8'))
+                return
+            
+            if known_hash and known_hash == self.hashes.get(filepath):
+                self.send_to(client_socket, f"NOT_MODIFIED:{filename}|{known_hash}\n".encode('utf-8'))
+                print(f"Image unchanged for client, skipped: {filename}")
                 return
             
             # Read and encode image
@@ -187,7 +353,7 @@ class ImageServer:
             
             base64_data = base64.b64encode(image_data).decode('utf-8')
             message = f"SERVER_IMAGE:{filename}|{base64_data}\n"
-            client_socket.send(message.encode('utf-8'))
+            self.send_to(client_socket, message.encode('utf-8'))
             
             print(f"Sent image to client: {filename}")
             
@@ -207,6 +373,8 @@ class ImageServer:
             
             base64_data = base64.b64encode(image_data).decode('utf-8')
             message = f"SERVER_IMAGE:{filename}|{base64_data}\n"
+            # Caching clients get a small offer and request the bytes only if they lack them
+            offer = f"IMAGE_OFFER:{filename}|{self.hashes.get(filepath)}|{len(image_data)}\n"
             
             with self.clients_lock:
                 clients_copy = list(self.clients)
@@ -214,7 +382,10 @@ class ImageServer:
             sent_count = 0
             for client_info in clients_copy:
                 try:
-                    client_info['socket'].send(message.encode('utf-8'))
+                    if 'offers' in client_info['features']:
+                        self.send_to(client_info['socket'], offer.encode('utf-8'))
+                    else:
+                        self.send_to(client_info['socket'], message.encode('utf-8'))
                     sent_count += 1
                 except:
                     self.remove_client(client_info['socket'])
@@ -251,6 +422,8 @@ class ImageServer:
         print("- 'list' - Show available server images")
         print("- 'send <filename>' - Send image to all clients")
         print("- 'clients' - Show connected clients")
+        print("- 'stats' - Show inbound buffer usage and image store savings")
+        print("- 'network' - Show socket tuning and per-connection buffers")
         print("- 'quit' - Stop server\n")
         
         while self.running:
@@ -273,6 +446,19 @@ class ImageServer:
                         else:
                             print("No clients connected")
                             
+                elif user_input.lower() == 'network':
+                    print(f"Listening on {self.host}:{self.port}")
+                    with self.clients_lock:
+                        sockets = [client['socket'] for client in self.clients]
+                    print(self.tuning.describe(sockets))
+                    
+                elif user_input.lower() == 'stats':
+                    print(self.budget.summary())
+                    print(self.store.summary())
+                    for address, buffer in list(self.inbound.items()):
+                        if buffer.buffered():
+                            print(f"  {address}: {buffer.buffered() / 1024:.0f} KB buffered")
+                            
                 elif user_input.lower().startswith('send '):
                     filename = user_input[5:].strip()
                     if filename:
@@ -290,6 +476,8 @@ class ImageServer:
     def cleanup(self):
         print("\nShutting down image server...")
         self.running = False
+        if self.discovery:
+            self.discovery.stop()
         
         with self.clients_lock:
             clients_copy = list(self.clients)
@@ -310,7 +498,14 @@ class ImageServer:
         print("Image server shut down complete")
 
 def main():
-    server = ImageServer()
+    import argparse
+    parser = argparse.ArgumentParser(description="Image transfer server")
+    parser.add_argument('--no-discovery', action='store_true', help="don't answer UDP discovery probes")
+    add_budget_arguments(parser)
+    add_tuning_arguments(parser)
+    args = parser.parse_args()
+    server = ImageServer(discovery=not args.no_discovery, memory_budget=budget_from_args(args),
+                         tuning=tuning_from_args(args))
     
     # Start server in separate thread
     server_thread = threading.Thread(target=server.start_server)
@@ -0,0 +1,68 @@
+import threading
+from collections import deque
+import tkinter as tk
+
+# Capped, rate-coalesced log model backing the Tk message/activity areas
+
+
+class MessageLog:
+    """Ring buffer of log lines flushed into a Text widget at most once per frame interval"""
+
+    def __init__(self, root, widget, max_lines=5000, flush_interval_ms=50, mirror_console=False):
+        self.root = root
+        self.widget = widget
+        self.max_lines = max_lines
+        self.flush_interval_ms = flush_interval_ms
+        self.mirror_console = mirror_console
+        self.lines = deque(maxlen=max_lines)  # What the widget currently shows
+        self.pending = deque()  # Appended from any thread, drained on the Tk thread
+        self.flush_scheduled = False
+        self.lock = threading.Lock()
+        self.dropped = 0  # Lines that never reached the widget because a burst exceeded max_lines
+
+    def append(self, line):
+        """Queue one line (thread-safe); the widget is updated on the next flush"""
+        self.pending.append(line.rstrip('\n'))
+        with self.lock:
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        try:
+            self.root.after(self.flush_interval_ms, self.flush)
+        except (RuntimeError, tk.TclError):
+            pass  # Window already destroyed
+
+    def flush(self):
+        """Write all pending lines in one widget update and trim to max_lines"""
+        with self.lock:
+            self.flush_scheduled = False
+        batch = []
+        while self.pending:
+            batch.append(self.pending.popleft())
+        if not batch:
+            return
+
+        if self.mirror_console:
+            print("\n".join(f"GUI Updated: {line}" for line in batch))
+
+        if len(batch) > self.max_lines:
+            self.dropped += len(batch) - self.max_lines
+            batch = batch[-self.max_lines:]
+        self.lines.extend(batch)
+
+        try:
+            at_bottom = self.widget.yview()[1] >= 0.999
+            self.widget.insert(tk.END, "\n".join(batch) + "\n")
+            # The widget ends with an empty line after the last newline
+            excess = int(self.widget.index('end-1c').split('.')[0]) - 1 - self.max_lines
+            if excess > 0:
+                self.widget.delete('1.0', f'{excess + 1}.0')
+            if at_bottom:
+                self.widget.see(tk.END)  # Only follow new output if the user hasn't scrolled up
+        except tk.TclError:
+            pass
+
+    def clear(self):
+        self.pending.clear()
+        self.lines.clear()
+        self.widget.delete('1.0', tk.END)
@@ -0,0 +1,202 @@
+import json
+import socket
+import struct
+import threading
+
+# Socket tuning shared by server.py and image_server.py.
+#
+# Settings come from defaults, then an optional JSON file (--net-config), then command line flags:
+#   {"rcvbuf": 4194304, "sndbuf": 4194304, "nodelay": true, "keepalive": true, "keepidle": 60,
+#    "keepintvl": 10, "keepcnt": 5, "backlog": 128, "recv_size": 262144, "auto_tune": false}
+# rcvbuf/sndbuf of 0 leave the OS default (and its own autotuning) in place.
+#
+# auto_tune sizes both buffers to twice the bandwidth-delay product measured on live connections
+# (TCP_INFO round trip time and delivery rate, Linux only). A static figure from
+# `test_connection.py --diag --save-config` works everywhere.
+
+KB = 1024
+MIN_AUTO_BUFFER = 64 * KB
+MAX_AUTO_BUFFER = 16 * 1024 * KB
+
+DEFAULTS = {
+    'rcvbuf': 0,
+    'sndbuf': 0,
+    'nodelay': True,
+    'keepalive': True,
+    'keepidle': 60,  # Seconds idle before the first probe
+    'keepintvl': 10,  # Seconds between probes
+    'keepcnt': 5,  # Unanswered probes before the connection is dropped
+    'backlog': 128,
+    'recv_size': 256 * KB,
+    'auto_tune': False,
+}
+
+
+def buffer_for_bdp(bdp_bytes):
+    """Socket buffer for a bandwidth-delay product: room for two windows, within sane bounds"""
+    return int(min(MAX_AUTO_BUFFER, max(MIN_AUTO_BUFFER, 2 * bdp_bytes)))
+
+
+def tcp_info(sock):
+    """(rtt_seconds, delivery_rate_bytes_per_second) from TCP_INFO, or None where unsupported"""
+    if not hasattr(socket, 'TCP_INFO'):
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 168)
+    except OSError:
+        return None
+    if len(info) < 72:
+        return None
+    rtt_us = struct.unpack_from('<I', info, 68)[0]  # tcpi_rtt, smoothed
+    # tcpi_delivery_rate (Linux 4.9+); older kernels return a shorter struct
+    rate = struct.unpack_from('<Q', info, 160)[0] if len(info) >= 168 else 0
+    return rtt_us / 1e6, rate
+
+
+class SocketTuning:
+    """Socket options for a listening socket and the connections it accepts"""
+
+    def __init__(self, **settings):
+        unknown = set(settings) - set(DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown socket settings: {', '.join(sorted(unknown))}")
+        self.settings = dict(DEFAULTS, **settings)
+        self.lock = threading.Lock()
+        self.bdp = 0  # Smoothed bandwidth-delay product from auto_tune samples, bytes
+        self.samples = 0
+        self.listener = None
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(**json.load(f))
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.settings, f, indent=2)
+
+    def __getattr__(self, name):
+        settings = self.__dict__.get('settings', {})
+        if name in settings:
+            return settings[name]
+        raise AttributeError(name)
+
+    def buffer_sizes(self):
+        """(rcvbuf, sndbuf) to apply now; the auto-tuned size once there is a measurement"""
+        with self.lock:
+            if self.auto_tune and self.bdp:
+                size = buffer_for_bdp(self.bdp)
+                return size, size
+        return self.rcvbuf, self.sndbuf
+
+    def apply_buffers(self, sock):
+        rcvbuf, sndbuf = self.buffer_sizes()
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        if sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+
+    def listen(self, sock):
+        # Receive buffer before listen(): the window scale is fixed in the handshake
+        self.listener = sock
+        self.apply_buffers(sock)
+        sock.listen(self.backlog)
+
+    def apply(self, sock):
+        """Options for one accepted connection"""
+        try:
+            self.apply_buffers(sock)
+            if self.nodelay:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.keepalive:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                if hasattr(socket, 'TCP_KEEPIDLE'):
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepidle)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, self.keepintvl)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, self.keepcnt)
+                elif hasattr(socket, 'SIO_KEEPALIVE_VALS'):  # Windows
+                    sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, self.keepidle * 1000, self.keepintvl * 1000))
+        except OSError as e:
+            print(f"Could not apply socket options: {e}")
+
+    def observe(self, sock):
+        """auto_tune: fold one connection's measured BDP into the estimate and resize its buffers"""
+        if not self.auto_tune:
+            return
+        measured = tcp_info(sock)
+        if not measured or not measured[0] or not measured[1]:
+            return
+        rtt, rate = measured
+        with self.lock:
+            bdp = rate * rtt
+            # Rises quickly to a faster link, decays slowly so one idle client doesn't shrink everyone
+            weight = 0.5 if bdp > self.bdp else 0.1
+            self.bdp = bdp if not self.samples else self.bdp + weight * (bdp - self.bdp)
+            self.samples += 1
+        try:
+            self.apply_buffers(sock)
+            if self.listener:
+                self.apply_buffers(self.listener)
+        except OSError:
+            pass
+
+    def describe(self, sockets=()):
+        """Console summary: configured values, effective buffer sizes and per-connection measurements"""
+        lines = ["Socket tuning:"]
+        configured = ", ".join(f"{key}={value}" for key, value in self.settings.items())
+        lines.append(f"  {configured}")
+        if self.auto_tune:
+            with self.lock:
+                bdp, samples = self.bdp, self.samples
+            if samples:
+                lines.append(f"  Auto-tune: BDP {bdp / KB:.0f} KB over {samples} samples -> "
+                             f"{buffer_for_bdp(bdp) // KB} KB buffers")
+            else:
+                lines.append("  Auto-tune: no measurement yet (needs TCP_INFO, Linux)")
+        if self.listener:
+            lines.append(f"  Listener buffers: {effective_buffers(self.listener)}")
+        for sock in sockets:
+            try:
+                address = sock.getpeername()
+            except OSError:
+                continue  # Disconnecting
+            measured = tcp_info(sock)
+            detail = effective_buffers(sock)
+            if measured:
+                rtt, rate = measured
+                detail += f", rtt {rtt * 1000:.2f} ms, delivery {rate / 1e6:.1f} MB/s, BDP {rate * rtt / KB:.0f} KB"
+            lines.append(f"  {address}: {detail}")
+        return "\n".join(lines)
+
+
+def effective_buffers(sock):
+    try:
+        rcvbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        sndbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+    except OSError:
+        return "closed"
+    return f"rcvbuf {rcvbuf // KB} KB, sndbuf {sndbuf // KB} KB"
+
+
+def add_tuning_arguments(parser):
+    parser.add_argument('--net-config', metavar='FILE', help="JSON file of socket settings (see netconfig.py)")
+    parser.add_argument('--rcvbuf', type=int, metavar='BYTES', help="SO_RCVBUF for accepted connections")
+    parser.add_argument('--sndbuf', type=int, metavar='BYTES', help="SO_SNDBUF for accepted connections")
+    parser.add_argument('--no-nodelay', dest='nodelay', action='store_false', default=None,
+                        help="leave Nagle's algorithm on")
+    parser.add_argument('--no-keepalive', dest='keepalive', action='store_false', default=None,
+                        help="don't enable TCP keepalive probes")
+    parser.add_argument('--keepidle', type=int, metavar='SECONDS', help="idle time before keepalive probes")
+    parser.add_argument('--backlog', type=int, help="listen backlog (default: 128)")
+    parser.add_argument('--recv-size', type=int, metavar='BYTES', help="bytes per recv() call (default: 262144)")
+    parser.add_argument('--auto-tune', action='store_true', default=None,
+                        help="size buffers from the bandwidth-delay product measured on connections")
+
+
+def tuning_from_args(args):
+    tuning = SocketTuning.load(args.net_config) if args.net_config else SocketTuning()
+    for key in ('rcvbuf', 'sndbuf', 'nodelay', 'keepalive', 'keepidle', 'backlog', 'recv_size', 'auto_tune'):
+        value = getattr(args, key)
+        if value is not None:
+            tuning.settings[key] = value
+    return tuning
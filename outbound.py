@@ -0,0 +1,372 @@
+import time
+import socket
+import threading
+from collections import deque
+
+# Per-connection outbound writer with priority classes.
+#
+# Every frame for a client goes through its ConnectionWriter; one thread per connection writes
+# them out, always taking the most urgent class first. Large payloads are queued as iterators of
+# frames (chunked images, bulk test data), so between any two chunks the writer goes back to the
+# higher classes: a chat line waits at most for one chunk on the wire, not a whole image.
+#
+# Small frames are coalesced: whatever small frames are queued when the writer gets to them go out in
+# one vectored write (sendmsg), and a frame that isn't urgent waits up to flush_window for company.
+# Control frames and frames a sender waits for are flushed at once, so pings and echo replies keep
+# their latency while a burst of broadcasts costs one syscall instead of one per line.
+
+CONTROL, TEXT, DETECTIONS, BULK = range(4)
+CLASS_NAMES = ('control', 'text', 'detections', 'bulk')
+
+BULK_QUEUE_LIMIT = 8 * 1024 * 1024  # Queued bulk bytes before send(..., BULK) blocks the caller
+FLUSH_WINDOW = 0.002  # Seconds a non-urgent small frame may wait for others to share its write
+SMALL_FRAME = 16 * 1024  # Larger frames are written on their own
+BATCH_LIMIT = 64 * 1024  # Bytes per coalesced write
+MAX_BUFFERS = 64  # sendmsg buffers per write, well under any IOV_MAX
+
+
+class ConnectionWriter:
+    """Serializes all writes to one socket, most urgent priority class first"""
+
+    def __init__(self, sock, name="", on_error=None, scheduler=None, flush_window=FLUSH_WINDOW):
+        self.sock = sock
+        self.name = name
+        self.on_error = on_error  # Called once from the writer thread when a send fails
+        # Shared EgressScheduler: fair share and rate caps across connections
+        self.scheduler = scheduler
+        self.flow = scheduler.register(name) if scheduler else None
+        self.compressor = None  # compression.FrameCompressor once the client has negotiated a codec
+        self.flush_window = flush_window
+        self.writes = 0  # Send calls that put frames on the socket; frames / writes is the coalescing gain
+        self.queues = [deque() for _ in CLASS_NAMES]
+        self.queued_bytes = [0] * len(CLASS_NAMES)
+        self.condition = threading.Condition()
+        self.closed = False
+        self.error = None
+        # Per class: frames and bytes written, and the longest a frame waited in the queue
+        self.sent_frames = [0] * len(CLASS_NAMES)
+        self.sent_bytes = [0] * len(CLASS_NAMES)
+        self.max_wait = [0.0] * len(CLASS_NAMES)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self, data, priority=TEXT, wait=False, flush=None):
+        """Queue one complete frame; wait=True returns only once it is on the socket.
+        flush=True skips the coalescing window (default: for control frames and waited-for frames)."""
+        if flush is None:
+            flush = priority == CONTROL or wait
+        self.enqueue(data, len(data), priority, wait, flush)
+
+    def send_frames(self, frames, priority=BULK, wait=False):
+        """Queue an iterator of frames, produced one at a time as the writer gets to them"""
+        self.enqueue(iter(frames), 0, priority, wait, True)
+
+    def enqueue(self, item, size, priority, wait, flush=True):
+        done = threading.Event() if wait else None
+        with self.condition:
+            if priority == BULK:
+                # Backpressure for bulk producers only; control and text frames are small
+                while not self.closed and self.queued_bytes[BULK] > BULK_QUEUE_LIMIT:
+                    self.condition.wait()
+            if self.closed:
+                raise ConnectionError(self.error or "connection closed")
+            self.queues[priority].append((item, size, time.perf_counter(), done, flush))
+            self.queued_bytes[priority] += size
+            self.condition.notify_all()
+        if done:
+            done.wait()
+            if self.error:
+                raise ConnectionError(self.error)
+
+    def next_batch(self):
+        """[(priority, entry), ...]: one chunked payload, or one or more whole frames to write together"""
+        with self.condition:
+            while not self.closed and not any(self.queues):
+                self.condition.wait()
+            if self.closed:
+                return None
+            priority = next(p for p, queue in enumerate(self.queues) if queue)
+            entry = self.queues[priority].popleft()
+            batch = [(priority, entry)]
+            if not isinstance(entry[0], bytes) or entry[1] > SMALL_FRAME:
+                return batch
+            if not entry[4] and self.flush_window:
+                # Not urgent: give other small frames until flush_window after this one was queued
+                deadline = entry[2] + self.flush_window
+                while not self.closed and self.small_bytes() + entry[1] < BATCH_LIMIT:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0 or any(e[4] for queue in self.queues for e in queue):
+                        break
+                    self.condition.wait(remaining)
+            self.take_small(batch, entry[1])
+            return batch
+
+    def small_bytes(self):
+        return sum(e[1] for queue in self.queues for e in queue if isinstance(e[0], bytes) and e[1] <= SMALL_FRAME)
+
+    def take_small(self, batch, size):
+        # Most urgent first, FIFO within a class; a class stops at its first chunked or large item
+        for priority, queue in enumerate(self.queues):
+            while queue and len(batch) < MAX_BUFFERS:
+                item, item_size = queue[0][0], queue[0][1]
+                if not isinstance(item, bytes) or item_size > SMALL_FRAME or size + item_size > BATCH_LIMIT:
+                    break
+                batch.append((priority, queue.popleft()))
+                size += item_size
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            frames = []
+            resume = None
+            for priority, (item, size, queued_at, done, flush) in batch:
+                if isinstance(item, bytes):
+                    frame, finished = item, True
+                else:
+                    try:
+                        frame = next(item, None)
+                    except Exception as e:
+                        print(f"Outbound payload for {self.name} failed: {e}")
+                        frame = None
+                    finished = frame is None
+                    if not finished:
+                        resume = (priority, (item, size, time.perf_counter(), done, flush))
+                if frame and self.compressor:
+                    frame = self.compressor.compress(frame)
+                frames.append(frame)
+            try:
+                total = sum(len(frame) for frame in frames if frame)
+                if total:
+                    if self.flow:
+                        self.scheduler.acquire(self.flow, total)
+                    self.write_all([frame for frame in frames if frame])
+            except Exception as e:
+                self.fail(str(e) or e.__class__.__name__)
+                for _, entry in batch:
+                    if entry[3]:
+                        entry[3].set()  # Waiting senders see the error instead of hanging
+                return
+
+            now = time.perf_counter()
+            released = []
+            with self.condition:
+                for (priority, (item, size, queued_at, done, flush)), frame in zip(batch, frames):
+                    if frame:
+                        self.sent_frames[priority] += 1
+                        self.sent_bytes[priority] += len(frame)
+                        self.max_wait[priority] = max(self.max_wait[priority], now - queued_at)
+                    if resume is None or resume[1][0] is not item:
+                        self.queued_bytes[priority] -= size
+                        if done:
+                            released.append(done)
+                if resume:
+                    # More chunks to come: resume this payload after anything more urgent
+                    self.queues[resume[0]].appendleft(resume[1])
+                self.condition.notify_all()
+            for done in released:
+                done.set()
+
+    def write_all(self, frames):
+        if len(frames) == 1 or not hasattr(self.sock, 'sendmsg'):
+            self.write(frames[0] if len(frames) == 1 else b"".join(frames))
+            return
+        # One sendmsg for the whole batch; on a partial send, continue from the first unsent byte
+        buffers = [memoryview(frame) for frame in frames]
+        while buffers:
+            try:
+                sent = self.sock.sendmsg(buffers)
+            except socket.timeout:
+                if self.closed:
+                    raise
+                continue
+            self.writes += 1
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            if buffers and sent:
+                buffers[0] = buffers[0][sent:]
+
+    def write(self, frame):
+        # Like sendall, but a slow reader only stalls us: the reader thread's recv timeout is
+        # also set on this socket and would otherwise abort a large frame half way through
+        view = memoryview(frame)
+        while view:
+            try:
+                sent = self.sock.send(view)
+            except socket.timeout:
+                if self.closed:
+                    raise
+                continue
+            self.writes += 1
+            view = view[sent:]
+
+    def fail(self, error):
+        with self.condition:
+            if self.closed:
+                return
+            self.error = error
+        self.close()
+        if self.on_error:
+            self.on_error(error)
+
+    def close(self):
+        """Stop writing; anything still queued is dropped and waiting senders are released"""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.error = self.error or "connection closed"
+            pending = [entry for queue in self.queues for entry in queue]
+            for queue in self.queues:
+                queue.clear()
+            self.condition.notify_all()
+        for _, _, _, done, _ in pending:
+            if done:
+                done.set()
+        if self.flow:
+            self.scheduler.unregister(self.flow)
+
+    def stats(self):
+        with self.condition:
+            return {name: {'frames': self.sent_frames[p], 'bytes': self.sent_bytes[p],
+                           'queued': len(self.queues[p]), 'max_wait_ms': self.max_wait[p] * 1000}
+                    for p, name in enumerate(CLASS_NAMES)}
+
+
+class Flow:
+    """One connection's share of the egress scheduler"""
+
+    def __init__(self, name, weight=1.0, rate=0):
+        self.name = name
+        self.weight = weight
+        self.rate = rate  # Bytes per second cap, 0 for none
+        self.allowance = 0.0  # Token bucket; may go negative so frames larger than a burst still pass
+        self.refilled = time.perf_counter()
+        self.finish = 0.0  # Virtual finish time of this flow's last granted frame
+        self.closed = False
+        self.sent = 0
+        self.recent = deque()  # (time, bytes) over the last RATE_WINDOW seconds
+        self.connected = time.perf_counter()
+
+    def throughput(self, now):
+        while self.recent and now - self.recent[0][0] > EgressScheduler.RATE_WINDOW:
+            self.recent.popleft()
+        window = min(EgressScheduler.RATE_WINDOW, max(now - self.connected, 1e-6))
+        return sum(size for _, size in self.recent) / window
+
+
+class EgressScheduler:
+    """Shares outbound bandwidth across connections by weighted fair queuing.
+
+    Writers call acquire() before each frame. Without caps it only counts bytes. With a global
+    and/or per-client cap, waiting frames are granted in order of virtual finish time
+    (start + size / weight), so a client pulling large images can't starve the others.
+    """
+
+    RATE_WINDOW = 5.0
+    BURST = 0.05  # Seconds of tokens a bucket may save up
+
+    def __init__(self, rate=0, client_rate=0):
+        self.rate = rate  # Global bytes per second, 0 for none
+        self.client_rate = client_rate  # Default per-client cap for new connections
+        self.allowance = 0.0
+        self.refilled = time.perf_counter()
+        self.virtual_time = 0.0
+        self.waiting = []  # [start_tag, finish_tag, sequence, flow, size], granted lowest finish first
+        self.sequence = 0
+        self.flows = []
+        self.condition = threading.Condition()
+
+    def register(self, name, weight=1.0):
+        flow = Flow(name, weight, self.client_rate)
+        with self.condition:
+            self.flows.append(flow)
+        return flow
+
+    def unregister(self, flow):
+        with self.condition:
+            flow.closed = True
+            if flow in self.flows:
+                self.flows.remove(flow)
+            self.condition.notify_all()
+
+    def set_rate(self, rate):
+        with self.condition:
+            self.rate = rate
+            self.allowance = 0.0
+            self.condition.notify_all()
+
+    def set_flow(self, flow, rate=None, weight=None):
+        with self.condition:
+            if rate is not None:
+                flow.rate = rate
+                flow.allowance = 0.0
+            if weight is not None:
+                flow.weight = weight
+            self.condition.notify_all()
+
+    def refill(self, holder, rate, now):
+        if rate:
+            holder.allowance = min(rate * self.BURST, holder.allowance + (now - holder.refilled) * rate)
+        holder.refilled = now
+
+    def acquire(self, flow, size):
+        """Block until flow may put size bytes on the wire"""
+        with self.condition:
+            if self.rate or flow.rate:
+                start = max(self.virtual_time, flow.finish)
+                flow.finish = start + size / flow.weight
+                self.sequence += 1
+                entry = [start, flow.finish, self.sequence, flow, size]
+                self.waiting.append(entry)
+                self.condition.notify_all()  # A new earliest frame can change who goes next
+                try:
+                    self.wait_turn(entry)
+                finally:
+                    self.waiting.remove(entry)
+                    self.condition.notify_all()
+            now = time.perf_counter()
+            flow.sent += size
+            flow.recent.append((now, size))
+
+    def wait_turn(self, entry):
+        while not entry[3].closed:
+            now = time.perf_counter()
+            self.refill(self, self.rate, now)
+            delay = None
+            for candidate in sorted(self.waiting, key=lambda e: (e[1], e[2])):
+                flow = candidate[3]
+                self.refill(flow, flow.rate, now)
+                if self.rate and self.allowance < 0:
+                    delay = -self.allowance / self.rate  # Nobody may send until the global bucket refills
+                    break
+                if flow.rate and flow.allowance < 0:
+                    # Held by its own cap only: the next flow in line goes first
+                    flow_delay = -flow.allowance / flow.rate
+                    delay = flow_delay if delay is None else min(delay, flow_delay)
+                    continue
+                if candidate is entry:
+                    self.virtual_time = entry[0]
+                    if self.rate:
+                        self.allowance -= entry[4]
+                    if flow.rate:
+                        flow.allowance -= entry[4]
+                    return
+                break  # An earlier frame is eligible; it is granted by its own thread
+            self.condition.wait(delay)
+
+    def report(self):
+        """Console lines: caps, and each client's achieved throughput"""
+        now = time.perf_counter()
+        with self.condition:
+            flows = list(self.flows)
+            lines = [f"Egress cap: {self.rate / 1e6:.2f} MB/s" if self.rate else "Egress cap: none",
+                     f"Default client cap: {self.client_rate / 1e6:.2f} MB/s" if self.client_rate
+                     else "Default client cap: none"]
+            for number, flow in enumerate(flows, 1):
+                cap = f"{flow.rate / 1e6:.2f} MB/s" if flow.rate else "none"
+                lines.append(f"  {number}. {flow.name}: {flow.throughput(now) / 1e6:.2f} MB/s now, "
+                             f"{flow.sent / 1e6:.1f} MB total, weight {flow.weight:g}, cap {cap}")
+        return "\n".join(lines)
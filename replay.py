@@ -0,0 +1,199 @@
+import time
+import asyncio
+import argparse
+from collections import defaultdict, deque
+from capture import read_capture, OPEN, FRAME, CLOSE
+from compression import decompress_frame
+from stream import STREAM_ID_MAX
+
+# Replays a VMServer capture (server.py --record DIR) against a server and reports throughput and latency.
+#
+#   python replay.py captures/capture_20250101_120000.vmcap --speed 1      original timing
+#   python replay.py capture.vmcap --speed 10 --copies 20                  10x faster, 20 connections per recorded one
+#   python replay.py capture.vmcap --speed 0                               as fast as possible
+
+# Request frame prefix -> reply frame prefixes; latency is measured from send to the first matching reply
+REPLIES = {
+    b'IMAGE_END:': (b'IMAGE_DONE:', b'IMAGE_FAILED:'),
+    b'REQUEST_LIST': (b'IMAGE_LIST:',),
+    # Chunking clients get SERVER_IMAGE_BEGIN, caching clients of image_server.py an IMAGE_OFFER
+    b'REQUEST_IMAGE:': (b'SERVER_IMAGE:', b'SERVER_IMAGE_BEGIN:', b'IMAGE_OFFER:', b'NOT_MODIFIED:', b'IMAGE_ERROR:'),
+    b'ECHO:': (b'ECHO_REPLY:',),
+    b'TEST_CONNECTION': (b'TEST_OK:',),
+    b'HELLO:': (b'HELLO:',),
+}
+FAILURES = (b'IMAGE_FAILED:', b'IMAGE_ERROR:')  # Replies that mean the server refused the request
+
+# Frames whose first field is a transfer or stream id. The server allows each id on one connection
+# at a time, so every synthetic copy of a connection sends them under ids of its own.
+TRANSFER_FRAMES = (b'IMAGE_BEGIN:', b'IMAGE_CHUNK:', b'IMAGE_END:', b'IMAGE_CANCEL:', b'IMAGE_RESUME:',
+                   b'IMAGE_LINK:')
+STREAM_FRAMES = (b'STREAM_FRAME:', b'STREAM_END:')
+
+
+def load_sessions(path):
+    """Group capture records into {connection: [(timestamp, frame), ...]} with open/close times"""
+    sessions = defaultdict(lambda: {'frames': [], 'start': None, 'end': None})
+    for kind, connection, timestamp, data in read_capture(path):
+        session = sessions[connection]
+        if kind == OPEN:
+            session['start'] = timestamp
+        elif kind == FRAME:
+            session['frames'].append((timestamp, data))
+        elif kind == CLOSE:
+            session['end'] = timestamp
+    for session in sessions.values():
+        if session['start'] is None:
+            session['start'] = session['frames'][0][0] if session['frames'] else 0.0
+    return list(sessions.values())
+
+
+def rename_ids(frame, copy):
+    """The frame with its transfer or stream id suffixed for synthetic copy number copy (0: unchanged)"""
+    if not copy:
+        return frame
+    if frame.startswith(TRANSFER_FRAMES):
+        suffix, limit = b'r%d' % copy, 64  # Transfer ids stay alphanumeric
+    elif frame.startswith(STREAM_FRAMES):
+        suffix, limit = b'-%d' % copy, STREAM_ID_MAX
+    else:
+        return frame
+    command, _, payload = frame.partition(b':')
+    frame_id, separator, rest = payload.partition(b'|')
+    return command + b':' + frame_id[:limit - len(suffix)] + suffix + separator + rest
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Stats:
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.lag_ms = []  # How far behind its scheduled time each frame went out
+        self.latency_ms = defaultdict(list)  # Request prefix -> reply latencies
+        self.errors = 0
+        self.unanswered = 0
+        self.failed = 0  # Requests the server answered with IMAGE_FAILED or IMAGE_ERROR
+
+
+async def read_replies(reader, pending, stats):
+    """Match server frames to outstanding requests in FIFO order per reply type"""
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        # Captures hold frames as decompressed, so a replayed client offers its codecs again
+        if line.startswith(b'ZFRAME:'):
+            try:
+                line = decompress_frame(line.rstrip(b'\n'))
+            except Exception as e:
+                print(f"Bad compressed reply: {e}")
+                continue
+        for prefixes, waiting in pending.items():
+            if line.startswith(prefixes) and waiting:
+                request, sent_at = waiting.popleft()
+                stats.latency_ms[request].append((time.perf_counter() - sent_at) * 1000)
+                if line.startswith(FAILURES):
+                    stats.failed += 1
+                break
+
+
+async def replay_session(session, host, port, speed, replay_start, stats, copy=0):
+    # Connections open at their recorded offset (scaled), then send each frame on schedule
+    def due(timestamp):
+        return replay_start + timestamp / speed if speed else None
+
+    start_at = due(session['start'])
+    if start_at:
+        await asyncio.sleep(max(0.0, start_at - time.perf_counter()))
+    try:
+        reader, writer = await asyncio.open_connection(host, port, limit=64 * 1024 * 1024)
+    except OSError as e:
+        print(f"Connect failed: {e}")
+        stats.errors += 1
+        return
+
+    pending = {prefixes: deque() for prefixes in REPLIES.values()}
+    reply_task = asyncio.create_task(read_replies(reader, pending, stats))
+    try:
+        for timestamp, frame in session['frames']:
+            send_at = due(timestamp)
+            if send_at:
+                delay = send_at - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    stats.lag_ms.append(-delay * 1000)
+            frame = rename_ids(frame, copy)
+            writer.write(frame + b"\n")
+            await writer.drain()
+            sent_at = time.perf_counter()
+            stats.frames += 1
+            stats.bytes += len(frame) + 1
+            for request, prefixes in REPLIES.items():
+                if frame.startswith(request):
+                    pending[prefixes].append((request, sent_at))
+                    break
+
+        # Give outstanding requests a moment to be answered before hanging up
+        deadline = time.perf_counter() + 5.0
+        while any(pending.values()) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        stats.unanswered += sum(len(waiting) for waiting in pending.values())
+    except OSError as e:
+        print(f"Replay connection error: {e}")
+        stats.errors += 1
+    finally:
+        reply_task.cancel()
+        writer.close()
+
+
+async def replay(path, host, port, speed, copies):
+    sessions = load_sessions(path)
+    frames = sum(len(s['frames']) for s in sessions)
+    print(f"Replaying {len(sessions)} recorded connections ({frames} frames) x{copies} "
+          f"against {host}:{port} at {'max' if not speed else f'{speed:g}x'} speed")
+    stats = Stats()
+    started = time.perf_counter()
+    await asyncio.gather(*(replay_session(session, host, port, speed, started, stats, copy)
+                           for session in sessions for copy in range(copies)))
+    report(stats, time.perf_counter() - started)
+    return stats
+
+
+def report(stats, elapsed):
+    print(f"\nSent {stats.frames} frames, {stats.bytes / 1e6:.1f} MB in {elapsed:.2f} s: "
+          f"{stats.frames / elapsed:.0f} frames/s, {stats.bytes / elapsed / 1e6:.1f} MB/s")
+    if stats.lag_ms:
+        lag = sorted(stats.lag_ms)
+        print(f"Behind schedule: {len(lag)} frames, median {percentile(lag, 0.5):.1f} ms, "
+              f"max {lag[-1]:.1f} ms")
+    if stats.latency_ms:
+        print(f"\n{'request':<18} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        for request, values in sorted(stats.latency_ms.items()):
+            values.sort()
+            print(f"{request.decode('ascii').rstrip(':'):<18} {len(values):>6} {percentile(values, 0.5):>8.1f} "
+                  f"{percentile(values, 0.95):>8.1f} {percentile(values, 0.99):>8.1f} {values[-1]:>8.1f}")
+    if stats.unanswered or stats.errors or stats.failed:
+        print(f"\nUnanswered requests: {stats.unanswered}   Failed requests: {stats.failed}   "
+              f"Connection errors: {stats.errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a server.py --record capture and measure the server")
+    parser.add_argument('capture', help="capture file written by server.py --record")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="timing multiplier, 1 = original, 10 = ten times faster, 0 = as fast as possible")
+    parser.add_argument('--copies', type=int, default=1,
+                        help="synthetic connections per recorded connection (default: 1)")
+    args = parser.parse_args()
+    asyncio.run(replay(args.capture, args.host, args.port, args.speed, args.copies))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,21 +5,84 @@ import base64
 import os
 import json
 from datetime import datetime
+from transfer import UploadAssembler, server_image_frames, DOWNLOAD_CHUNK_SIZE
+from content_cache import HashCache, ContentStore
+from stream import LatestMailbox, SequenceFilter, parse_frame
+from discovery import DiscoveryResponder, SERVER_VERSION
+from capture import CaptureWriter
+from buffers import (MemoryBudget, FrameBuffer, SpilledFrame, InboundLimitError, decode_spilled_image,
+                     add_budget_arguments, budget_from_args)
+from netconfig import SocketTuning, add_tuning_arguments, tuning_from_args
+from outbound import ConnectionWriter, EgressScheduler, CONTROL, TEXT, DETECTIONS, BULK, FLUSH_WINDOW
+from admission import AdmissionControl, ClientLimiter
+from compression import CompressionStats, FrameCompressor, negotiate, decompress_frame, MIN_SIZE
+from handshake import hello_frame, parse_hello, select_features
 
 # TCP server for text and image messaging between VM and Windows clients
 
 class VMServer:
+    MAX_STREAMS = 4  # Live streams one client may send at once
+    
     # Server state and configuration
-    def __init__(self, host='0.0.0.0', port=12345):
+    def __init__(self, host='0.0.0.0', port=12345, detection_service=None, discovery=True, record_dir=None,
+                 memory_budget=None, tuning=None, egress=None, admission=None, compress_min=MIN_SIZE,
+                 flush_window=FLUSH_WINDOW):
         self.host = host
         self.port = port
+        # Answer UDP discovery probes so clients find this server without typing an IP
+        self.discovery = DiscoveryResponder(self.discovery_info) if discovery else None
+        # Optional capture of every inbound frame for replay.py
+        self.recorder = None
+        if record_dir:
+            os.makedirs(record_dir, exist_ok=True)
+            capture_name = f"capture_{datetime.now().strftime('%Y%m%d_%H%M%S')}.vmcap"
+            self.recorder = CaptureWriter(os.path.join(record_dir, capture_name))
+            print(f"Recording inbound traffic to {self.recorder.path}")
+        # Optional shared YOLOv5 stage (detector.DetectionService); None disables it
+        self.detection_service = detection_service
         self.clients = []
         self.clients_lock = threading.Lock()
+        # Caps inbound buffer memory; oversized frames spill to temp files (buffers.py)
+        self.budget = memory_budget or MemoryBudget()
+        self.inbound = {}  # client_address -> FrameBuffer, for stats
+        # Buffer sizes, NODELAY, keepalive, backlog and recv size (netconfig.py)
+        self.tuning = tuning or SocketTuning()
+        # Optional protocol features a client announced with FEATURES:<a,b,...>
+        self.client_features = {}
+        self.client_protocol = {}  # Socket -> protocol version, for clients that said HELLO
+        # sha256 of server images, reused until the file changes
+        self.hashes = HashCache()
+        # One prioritized writer per client socket; every outbound frame goes through it
+        self.writers = {}
+        # How long a non-urgent small frame waits to share a write with others (outbound.py)
+        self.flush_window = flush_window
+        # Fair share of outbound bandwidth across clients, with optional global/per-client caps
+        self.egress = egress or EgressScheduler()
+        # Connection cap, accept pacing and per-client frame/byte rate limits
+        self.admission = admission or AdmissionControl()
+        self.limiters = {}  # client_address -> ClientLimiter
+        # Per-connection frame compression for clients that offer a codec; 0 turns it off
+        self.compress_min = compress_min
+        self.compression = CompressionStats()
+        # Live streams: newest pending frame per stream for each receiving client
+        self.stream_outboxes = {}
+        self.stream_seq = SequenceFilter()
+        self.stream_detection = {}  # stream_id -> {'busy': bool, 'next': (seq, data) or None}
+        self.stream_owners = {}  # stream_id -> sending socket; each client may run MAX_STREAMS at once
+        self.stream_lock = threading.Lock()
+        # Diagnostics: payload bytes received per connection during a BULK_SINK test
+        self.bulk_received = {}
         self.server_socket = None
         self.running = False
         self.received_images_dir = "received_images"
         self.server_images_dir = "server_images"
         self.setup_directories()
+        # Chunked uploads are assembled in a hidden folder until IMAGE_END
+        self.uploads = UploadAssembler(os.path.join(self.received_images_dir, ".partial"))
+        # Uploads are stored once per distinct content; received_images/ names are links into it
+        self.store = ContentStore(os.path.join(self.received_images_dir, ".store"))
+        self.stream_dir = os.path.join(self.received_images_dir, ".streams")
+        os.makedirs(self.stream_dir, exist_ok=True)
     
     def setup_directories(self):
         # Create folders for incoming and server-side images
@@ -32,18 +95,31 @@ class VMServer:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
+            self.tuning.listen(self.server_socket)
             self.running = True
             
             print(f"Server started on {self.host}:{self.port}")
+            if self.discovery:
+                self.discovery.start()
             print("Waiting for connections...")
             
             while self.running:
                 try:
+                    self.admission.pace_accept()
                     client_socket, client_address = self.server_socket.accept()
+                    with self.clients_lock:
+                        connected = len(self.clients)
+                    if not self.admission.admit(connected):
+                        self.refuse_connection(client_socket, client_address, f"server full ({connected} clients)")
+                        continue
                     print(f"Connection established with {client_address}")
+                    self.tuning.apply(client_socket)
                     with self.clients_lock:
                         self.clients.append(client_socket)
+                        self.writers[client_socket] = ConnectionWriter(
+                            client_socket, str(client_address), scheduler=self.egress,
+                            on_error=lambda error, s=client_socket: self.drop_socket(s),
+                            flush_window=self.flush_window)
                     
                     # One thread for keepalive pings and one for reading client messages
                     threading.Thread(target=self.handle_client_writer, args=(client_socket, client_address), daemon=True).start()
@@ -58,12 +134,30 @@ class VMServer:
         finally:
             self.cleanup()
     
+    def refuse_connection(self, client_socket, client_address, reason):
+        # Over the connection cap: one rejection frame straight on the socket, then close
+        print(f"Refusing {client_address}: {reason}")
+        try:
+            client_socket.settimeout(1.0)
+            client_socket.sendall(f"CONNECTION_REJECTED:{reason}\n".encode('utf-8'))
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        client_socket.close()
+    
+    def discovery_info(self):
+        # Fields for discovery replies; clients is the load figure used to pick between servers
+        with self.clients_lock:
+            clients = len(self.clients)
+        return {'service': 'vm', 'name': socket.gethostname(), 'port': self.port, 'clients': clients}
+    
     def handle_client_writer(self, client_socket, client_address):
         # Periodically send ping to keep the connection active
         try:
             while self.running:
                 try:
-                    client_socket.sendall(b"ping\n")
+                    self.send_to(client_socket, b"ping\n", CONTROL)
+                    self.tuning.observe(client_socket)
                     time.sleep(1)
                 except:
                     break
@@ -73,6 +167,15 @@ class VMServer:
             with self.clients_lock:
                 if client_socket in self.clients:
                     self.clients.remove(client_socket)
+                self.client_features.pop(client_socket, None)
+                self.client_protocol.pop(client_socket, None)
+                writer = self.writers.pop(client_socket, None)
+                outbox = self.stream_outboxes.pop(client_socket, None)
+            if writer:
+                writer.close()
+            if outbox:
+                outbox.close()
+            self.end_client_streams(client_socket)
             try:
                 client_socket.shutdown(socket.SHUT_RDWR)
             except Exception:
@@ -82,20 +185,36 @@ class VMServer:
 
     def handle_client_reader(self, client_socket, client_address):
         # Read incoming data, frame by newline, handle protocol commands
-        buffer = b""  # Use bytes buffer for better handling
+        inbound = FrameBuffer(self.budget)
+        self.inbound[client_address] = inbound
+        limiter = ClientLimiter(self.admission, client_address)
+        self.limiters[client_address] = limiter
         client_socket.settimeout(1.0)
+        connection_id = self.recorder.open_connection(client_address) if self.recorder else None
         try:
             while self.running:
                 try:
-                    data = client_socket.recv(65536)  # Larger buffer for image payloads
+                    data = client_socket.recv(self.tuning.recv_size)
                     if not data:
                         break
                     
-                    buffer += data
+                    # Over its upload or frame rate, this reader pauses; TCP slows the client down
+                    limiter.admit_bytes(len(data))
                     
                     # Process complete frames (ending with \n)
-                    while b'\n' in buffer:
-                        line_bytes, buffer = buffer.split(b'\n', 1)
+                    for line_bytes in inbound.feed(data):
+                        if isinstance(line_bytes, SpilledFrame):
+                            self.handle_spilled_frame(line_bytes, client_socket, client_address, connection_id)
+                            continue
+                        if line_bytes.startswith(b'ZFRAME:'):
+                            try:
+                                line_bytes = decompress_frame(line_bytes, self.compression)
+                            except Exception as e:
+                                print(f"Bad compressed frame from {client_address}: {e}")
+                                continue
+                        limiter.admit_frame(line_bytes)
+                        if connection_id:
+                            self.recorder.frame(connection_id, line_bytes)
                         try:
                             line = line_bytes.decode('utf-8').strip()
                         except UnicodeDecodeError:
@@ -116,24 +235,151 @@ class VMServer:
                             image_data = line[6:]  # Remove 'IMAGE:' prefix
                             print(f"Received image from client {client_address} (message size: {len(line)} bytes)")
                             self.handle_received_image(image_data, client_address)
+                        # IMAGE_BEGIN/CHUNK/END/CANCEL -> chunked upload
+                        elif line.startswith(('IMAGE_BEGIN:', 'IMAGE_CHUNK:', 'IMAGE_END:', 'IMAGE_CANCEL:',
+                                              'IMAGE_LINK:', 'IMAGE_RESUME:')):
+                            self.handle_upload_frame(line, client_socket, client_address)
+                        # STREAM_FRAME / STREAM_END -> relay newest live frame to other clients
+                        elif line.startswith(('STREAM_FRAME:', 'STREAM_END:')):
+                            self.handle_stream_frame(line, client_socket, client_address)
+                        # DETECTIONS:<json> -> client-side results, relayed so peers draw them locally
+                        elif line.startswith('DETECTIONS:'):
+                            self.relay_detections(line[11:], client_socket, client_address)
+                        # ECHO / TEST_CONNECTION / BULK_* -> network diagnostics (test_connection.py --diag)
+                        elif line.startswith(('ECHO:', 'TEST_CONNECTION', 'BULK_')):
+                            self.handle_diagnostic(line, client_socket, client_address)
                         # REQUEST_LIST -> send available server images
                         elif line.startswith('REQUEST_LIST'):
                             # Send list of available server images
                             self.send_image_list(client_socket)
-                        # REQUEST_IMAGE:<filename> -> send specific image
+                        # REQUEST_IMAGE:<filename>[|<sha256 the client has>] -> send specific image
                         elif line.startswith('REQUEST_IMAGE:'):
                             # Send specific image to client
-                            filename = line[14:]  # Remove 'REQUEST_IMAGE:' prefix
-                            self.send_image_to_client(filename, client_socket)
+                            filename, _, known_hash = line[14:].partition('|')
+                            self.send_image_to_client(filename, client_socket, known_hash)
+                        # SERVER_IMAGE_RESUME:<id>|<filename>|<sha256>|<offset> -> rest of an interrupted download
+                        elif line.startswith('SERVER_IMAGE_RESUME:'):
+                            self.resume_download(line[20:], client_socket, client_address)
+                        # HELLO:<json> -> capability handshake (version, features, limits), see handshake.py
+                        elif line.startswith('HELLO:'):
+                            self.handle_hello(line[6:], client_socket, client_address)
+                        # FEATURES:<name,...> -> optional protocol features the client understands
+                        elif line.startswith('FEATURES:'):
+                            if client_socket in self.client_protocol:
+                                continue  # Already agreed by HELLO; this copy is for older servers
+                            features = {f.strip() for f in line[9:].split(',') if f.strip()}
+                            print(f"Client {client_address} features: {', '.join(sorted(features)) or 'none'}")
+                            # Our side of the exchange; older clients ignore frames they don't know
+                            codec = self.apply_features(client_socket, features)
+                            reply = ['dedup', 'resume'] + ([codec] if codec else [])
+                            self.send_to(client_socket, f"FEATURES:{','.join(reply)}\n".encode('utf-8'), CONTROL)
                 except socket.timeout:
                     continue
+                except InboundLimitError as e:
+                    self.reject_connection(client_socket, client_address, e)
+                    break
                 except Exception as e:
                     print(f"Error in client reader: {e}")
                     break
         finally:
             # Reader ends; writer cleanup will handle removal/close
+            inbound.close()
+            self.inbound.pop(client_address, None)
+            self.limiters.pop(client_address, None)
+            self.uploads.detach(client_address)  # Partial uploads stay resumable after a reconnect
+            self.bulk_received.pop(client_address, None)
+            if connection_id:
+                self.recorder.close_connection(connection_id)
+    
+    def handle_spilled_frame(self, frame, client_socket, client_address, connection_id):
+        # A frame too large for the in-memory budget, waiting in a temp file
+        try:
+            if connection_id:
+                self.recorder.frame_file(connection_id, frame)
+            if frame.startswith(b'IMAGE:'):
+                # Legacy single-frame upload: decode straight from the temp file to the image file
+                original_filename, temp_path = decode_spilled_image(frame, b'IMAGE:', lambda name: self.store.temp_path())
+                filepath = self.received_image_path(original_filename, client_address)
+                self.store.put_file(temp_path, filepath)
+                print(f"Image received from client and saved: {os.path.basename(filepath)} "
+                      f"({frame.size} byte frame, spilled to disk)")
+                self.broadcast_image_notification(original_filename, client_address)
+                self.submit_detection(filepath, original_filename)
+            elif frame.startswith(b'BULK_SINK:'):
+                self.bulk_received[client_address] = self.bulk_received.get(client_address, 0) + frame.size - 10
+            else:
+                kind = frame.head[:32].split(b':', 1)[0].decode('ascii', errors='replace')
+                print(f"Dropped oversized {kind} frame from {client_address} ({frame.size} bytes)")
+        except Exception as e:
+            print(f"Error handling spilled frame from {client_address}: {e}")
+        finally:
+            frame.close()
+    
+    def reject_connection(self, client_socket, client_address, reason):
+        # Hard inbound limit broken: tell the client why, then shut the socket so the writer cleans up
+        self.budget.record_rejection()
+        print(f"Rejecting {client_address}: {reason}")
+        try:
+            self.send_to(client_socket, f"CONNECTION_REJECTED:{reason}\n".encode('utf-8'), CONTROL, wait=True)
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except Exception:
             pass
     
+    def show_stats(self):
+        print("\nServer Statistics:")
+        print("=" * 50)
+        with self.clients_lock:
+            print(f"Connected clients: {len(self.clients)}")
+        print(self.budget.summary())
+        print(self.store.summary())
+        print(self.compression.summary())
+        inbound = sorted(list(self.inbound.items()), key=lambda item: item[1].buffered(), reverse=True)
+        for address, buffer in inbound[:5]:
+            if buffer.buffered():
+                print(f"  {address}: {buffer.buffered() / 1024:.0f} KB buffered")
+        with self.clients_lock:
+            writers = list(self.writers.values())
+        if writers:
+            print("Outbound by class (frames / MB / longest queue wait), then frames per write:")
+        for writer in writers:
+            classes = writer.stats()
+            detail = "  ".join(f"{name} {c['frames']}/{c['bytes'] / 1e6:.1f}/{c['max_wait_ms']:.0f}ms"
+                               for name, c in classes.items() if c['frames'])
+            frames = sum(c['frames'] for c in classes.values())
+            coalescing = f"  ({frames / writer.writes:.1f} frames/write)" if writer.writes else ""
+            print(f"  {writer.name}: {detail or 'idle'}{coalescing}")
+        print(self.egress.report())
+        print(self.admission.summary(list(self.limiters.values())))
+        print("=" * 50)
+    
+    def limits_command(self, args):
+        # limits | limits <msgs|burst|upload|max|accept> <value>; 0 turns a limit off
+        if len(args) == 2:
+            try:
+                self.admission.set_limit(args[0].lower(), float(args[1]))
+            except ValueError as e:
+                print(f"Usage: limits [msgs|burst|upload|max|accept <value>] ({e})")
+                return
+        elif args:
+            print("Usage: limits [msgs|burst|upload|max|accept <value>]")
+            return
+        print(self.admission.summary(list(self.limiters.values())))
+    
+    def egress_command(self, args):
+        # egress | egress <MB/s> | egress <client number> <MB/s> [weight]
+        try:
+            if len(args) == 1:
+                self.egress.set_rate(float(args[0]) * 1e6)
+            elif len(args) >= 2:
+                flows = list(self.egress.flows)
+                flow = flows[int(args[0]) - 1]
+                weight = float(args[2]) if len(args) > 2 else None
+                self.egress.set_flow(flow, rate=float(args[1]) * 1e6, weight=weight)
+        except (ValueError, IndexError):
+            print("Usage: egress [MB/s] | egress <client number> <MB/s> [weight]")
+            return
+        print(self.egress.report())
+    
     def broadcast_message(self, message, is_from_server=False):
         # Send MESSAGE:<payload> to all connected clients
         with self.clients_lock:
@@ -146,7 +392,7 @@ class VMServer:
         for client in clients_snapshot:
             try:
                 full_message = f"MESSAGE:{message}\n"
-                client.sendall(full_message.encode('utf-8'))
+                self.send_to(client, full_message.encode('utf-8'))
                 # Avoid printing full base64 payloads
                 if not message.startswith('SERVER_IMAGE:'):
                     if is_from_server:
@@ -184,23 +430,75 @@ class VMServer:
             image_bytes = base64.b64decode(base64_data)
             
             # Generate unique filename with timestamp
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            sender_ip = sender_address[0].replace('.', '_')
-            filename = f"{timestamp}_{sender_ip}_{original_filename}"
-            filepath = os.path.join(self.received_images_dir, filename)
+            filepath = self.received_image_path(original_filename, sender_address)
             
-            # Save image to file
-            with open(filepath, 'wb') as f:
-                f.write(image_bytes)
+            # Save image to the store (a link to the existing copy if these bytes were seen before)
+            self.store.put_bytes(image_bytes, filepath)
             
-            print(f"Image received from client and saved: {filename}")
+            print(f"Image received from client and saved: {os.path.basename(filepath)}")
             
             # Broadcast image notification to other clients
             self.broadcast_image_notification(original_filename, sender_address)
+            self.submit_detection(filepath, original_filename)
             
         except Exception as e:
             print(f"Error handling received image: {e}")
     
+    def received_image_path(self, original_filename, sender_address):
+        # Timestamped path under received_images/ for an upload
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        sender_ip = sender_address[0].replace('.', '_')
+        filename = f"{timestamp}_{sender_ip}_{os.path.basename(original_filename)}"
+        return os.path.join(self.received_images_dir, filename)
+    
+    def handle_upload_frame(self, line, client_socket, client_address):
+        # IMAGE_BEGIN:<id>|<filename>|<size>, IMAGE_CHUNK:<id>|<base64>, IMAGE_END:<id>, IMAGE_CANCEL:<id>,
+        # IMAGE_LINK:<id>|<filename>|<size>|<sha256> (store by hash, no upload if we have the bytes),
+        # IMAGE_RESUME:<id>|<filename>|<size> (continue an upload interrupted by a disconnect)
+        command, payload = line.split(':', 1)
+        try:
+            if command == 'IMAGE_BEGIN':
+                transfer_id = self.uploads.begin(client_address, payload)
+                print(f"Chunked upload {transfer_id} started by {client_address}")
+            elif command == 'IMAGE_CHUNK':
+                self.uploads.chunk(client_address, payload)
+            elif command == 'IMAGE_END':
+                original_filename, temp_path, _ = self.uploads.end(client_address, payload)
+                filepath = self.received_image_path(original_filename, client_address)
+                self.store.put_file(temp_path, filepath)
+                self.send_to(client_socket, f"IMAGE_DONE:{payload}\n".encode('utf-8'), CONTROL)
+                print(f"Image received from client and saved: {os.path.basename(filepath)}")
+                self.broadcast_image_notification(original_filename, client_address)
+                self.submit_detection(filepath, original_filename)
+            elif command == 'IMAGE_CANCEL':
+                self.uploads.cancel(client_address, payload)
+                print(f"Chunked upload {payload} cancelled by {client_address}")
+            elif command == 'IMAGE_RESUME':
+                transfer_id, original_filename, size = payload.split('|', 2)
+                offset = self.uploads.resume(client_address, transfer_id, original_filename, size)
+                if offset is None:
+                    self.send_to(client_socket, f"IMAGE_DONE:{transfer_id}\n".encode('utf-8'), CONTROL)
+                else:
+                    self.send_to(client_socket, f"IMAGE_OFFSET:{transfer_id}|{offset}\n".encode('utf-8'), CONTROL)
+                    print(f"Chunked upload {transfer_id} resumed by {client_address} at byte {offset}")
+            elif command == 'IMAGE_LINK':
+                transfer_id, original_filename, _, digest = payload.split('|', 3)
+                filepath = self.received_image_path(original_filename, client_address)
+                if not self.store.link(digest, filepath):
+                    self.send_to(client_socket, f"IMAGE_MISSING:{transfer_id}\n".encode('utf-8'), CONTROL)
+                    return
+                self.send_to(client_socket, f"IMAGE_DONE:{transfer_id}\n".encode('utf-8'), CONTROL)
+                print(f"Image stored by hash, upload skipped: {os.path.basename(filepath)}")
+                self.broadcast_image_notification(original_filename, client_address)
+                self.submit_detection(filepath, original_filename)
+        except Exception as e:
+            print(f"Upload error from {client_address}: {e}")
+            transfer_id = payload.split('|', 1)[0]
+            try:
+                self.send_to(client_socket, f"IMAGE_FAILED:{transfer_id}|{e}\n".encode('utf-8'), CONTROL)
+            except Exception:
+                pass
+    
     def broadcast_image_notification(self, filename, sender_address):
         # Notify all clients about a new image arrival
         notification = f"IMAGE_RECEIVED:{sender_address[0]}|{filename}"
@@ -217,29 +515,27 @@ class VMServer:
             
             image_list = json.dumps(images)
             message = f"IMAGE_LIST:{image_list}\n"
-            client_socket.send(message.encode('utf-8'))
+            self.send_to(client_socket, message.encode('utf-8'))
             
         except Exception as e:
             print(f"Error sending image list: {e}")
     
-    def send_image_to_client(self, filename, client_socket):
-        # Send one image by filename to a single client
+    def send_image_to_client(self, filename, client_socket, known_hash=''):
+        # Send one image by filename to a single client, or NOT_MODIFIED if it already has these bytes
         try:
             filepath = os.path.join(self.server_images_dir, filename)
             if not os.path.exists(filepath):
                 error_msg = f"IMAGE_ERROR:File not found: {filename}\n"
-                client_socket.send(error_msg.encode('utf-8'))
+                self.send_to(client_socket, error_msg.encode('utf-8'))
                 return
             
-            # Read and encode image
-            with open(filepath, 'rb') as f:
-                image_data = f.read()
-            
-            base64_data = base64.b64encode(image_data).decode('utf-8')
-            message = f"SERVER_IMAGE:{filename}|{base64_data}\n"
-            client_socket.send(message.encode('utf-8'))
+            if known_hash and known_hash == self.hashes.get(filepath):
+                self.send_to(client_socket, f"NOT_MODIFIED:{filename}|{known_hash}\n".encode('utf-8'), CONTROL)
+                print(f"Image unchanged for client, skipped: {filename}")
+                return
             
-            print(f"Sent image to client: {filename}")
+            self.send_image_frames(client_socket, filepath, filename)
+            print(f"Queued image for client: {filename}")
             
         except Exception as e:
             print(f"Error sending image: {e}")
@@ -263,10 +559,13 @@ class VMServer:
             
             # Create the message - format: SERVER_IMAGE:filename|base64_data
             message = f"SERVER_IMAGE:{filename}|{base64_data}\n"
+            # Caching clients get a small offer and fetch the bytes only if they don't have them
+            offer = f"IMAGE_OFFER:{filename}|{self.hashes.get(filepath)}|{len(image_data)}\n"
             
             # Send image directly to clients
             with self.clients_lock:
                 clients_snapshot = list(self.clients)
+                offer_clients = {c for c in clients_snapshot if 'offers' in self.client_features.get(c, ())}
             
             if not clients_snapshot:
                 print("No clients connected to send image to")
@@ -276,10 +575,12 @@ class VMServer:
             sent_count = 0
             for client in clients_snapshot:
                 try:
-                    print(f"Sending server image to client: {len(message)} bytes total")
-                    client.sendall(message.encode('utf-8'))
+                    if client in offer_clients:
+                        self.send_to(client, offer.encode('utf-8'))
+                        sent_count += 1
+                        continue
+                    self.send_image_frames(client, filepath, filename, message.encode('utf-8'))
                     sent_count += 1
-                    print(f"Successfully sent server image to client {sent_count}")
                 except Exception as e:
                     print(f"Failed to send image to client: {e}")
                     disconnected_clients.append(client)
@@ -291,12 +592,281 @@ class VMServer:
                             self.clients.remove(client)
             
             print(f"Server image '{filename}' sent to {sent_count} clients")
+            self.submit_detection(filepath, filename)
             
         except Exception as e:
             print(f"Error sending server image: {e}")
             import traceback
             traceback.print_exc()
     
+    def submit_detection(self, filepath, image_name):
+        # Queue a stored image for the shared detection stage, if enabled
+        if not self.detection_service:
+            return
+        image_hash = self.hashes.get(filepath)
+        self.detection_service.submit(
+            filepath, lambda result: self.broadcast_detections(image_name, result, image_hash=image_hash)
+        )
+    
+    def send_to(self, client_socket, data, priority=TEXT, wait=False):
+        # Queue a frame on the client's writer; wait=True blocks until it is on the socket
+        writer = self.writers.get(client_socket)
+        if writer is None:
+            raise ConnectionError("client is disconnected")
+        writer.send(data, priority, wait)
+    
+    def send_image_frames(self, client_socket, filepath, filename, legacy_frame=None):
+        # Chunking clients get SERVER_IMAGE_* frames that text can overtake; others one SERVER_IMAGE frame
+        writer = self.writers.get(client_socket)
+        if writer is None:
+            raise ConnectionError("client is disconnected")
+        features = self.client_features.get(client_socket, ())
+        if 'chunked' in features:
+            # Resuming clients get the hash in BEGIN, to ask for the rest after a disconnect
+            digest = self.hashes.get(filepath) if 'resume' in features else None
+            writer.send_frames(server_image_frames(filepath, filename, digest=digest), BULK)
+            return
+        if legacy_frame is None:
+            with open(filepath, 'rb') as f:
+                legacy_frame = f"SERVER_IMAGE:{filename}|".encode('utf-8') + base64.b64encode(f.read()) + b"\n"
+        writer.send(legacy_frame, BULK)
+    
+    def resume_download(self, payload, client_socket, client_address):
+        # Continue a chunked download from the client's offset, if the file still has the same content
+        transfer_id, filename, digest, offset = payload.split('|', 3)
+        filepath = os.path.join(self.server_images_dir, os.path.basename(filename))
+        try:
+            if not os.path.exists(filepath) or self.hashes.get(filepath) != digest:
+                self.send_to(client_socket, f"SERVER_IMAGE_CANCEL:{transfer_id}|{filename} has changed\n".encode('utf-8'),
+                             CONTROL)
+                return
+            writer = self.writers.get(client_socket)
+            if writer is None:
+                return
+            writer.send_frames(server_image_frames(filepath, filename, transfer_id=transfer_id, offset=int(offset)), BULK)
+            print(f"Resuming download of {filename} for {client_address} at byte {offset}")
+        except Exception as e:
+            print(f"Error resuming download for {client_address}: {e}")
+    
+    def drop_socket(self, client_socket):
+        # A write failed: shut the socket so the reader and ping threads notice and clean up
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    
+    def apply_features(self, client_socket, offered):
+        """Record what a client offered and switch on compression; returns the codec or None"""
+        with self.clients_lock:
+            self.client_features[client_socket] = offered
+        codec = negotiate(offered) if self.compress_min else None
+        writer = self.writers.get(client_socket)
+        if codec and writer:
+            writer.compressor = FrameCompressor(codec, self.compression, self.compress_min)
+        return codec
+    
+    def handle_hello(self, payload, client_socket, client_address):
+        try:
+            version, offered, limits, body = parse_hello(payload)
+        except (ValueError, TypeError) as e:
+            print(f"Ignoring malformed HELLO from {client_address}: {e}")
+            return
+        self.apply_features(client_socket, offered)
+        features = select_features(offered, ('dedup', 'resume'), compress=bool(self.compress_min))
+        with self.clients_lock:
+            self.client_protocol[client_socket] = version
+        # A client may ask to be sent less than its fair share (slow link, metered connection)
+        writer = self.writers.get(client_socket)
+        try:
+            max_rate = float(limits.get('max_rate') or 0)
+        except (TypeError, ValueError):
+            max_rate = 0
+        if max_rate > 0 and writer and writer.flow:
+            self.egress.set_flow(writer.flow, rate=max_rate)
+        print(f"Client {client_address} HELLO: protocol {version}, {body.get('client', 'unknown client')}, "
+              f"using {', '.join(features) or 'no optional features'}")
+        ours = {'max_frame': self.budget.max_frame, 'msg_rate': self.admission.message_rate,
+                'msg_burst': self.admission.message_burst, 'upload_rate': self.admission.upload_rate,
+                'download_chunk': DOWNLOAD_CHUNK_SIZE, 'compress_min': self.compress_min}
+        self.send_to(client_socket, hello_frame(features, ours, server=SERVER_VERSION), CONTROL)
+    
+    def handle_diagnostic(self, line, client_socket, client_address):
+        # ECHO:<token> -> ECHO_REPLY:<token>|<server time ns>, answered straight from the reader
+        if line.startswith('ECHO:'):
+            self.send_to(client_socket, f"ECHO_REPLY:{line[5:]}|{time.time_ns()}\n".encode('ascii'), CONTROL)
+        elif line.startswith('TEST_CONNECTION'):
+            self.send_to(client_socket, f"TEST_OK:{SERVER_VERSION}\n".encode('ascii'), CONTROL)
+        # BULK_SINK:<base64> ... BULK_SINK_END -> count and discard, reply with the byte total
+        elif line.startswith('BULK_SINK:'):
+            self.bulk_received[client_address] = (self.bulk_received.get(client_address, 0)
+                                                  + len(line) - 10)
+        elif line.startswith('BULK_SINK_END'):
+            received = self.bulk_received.pop(client_address, 0) * 3 // 4  # Approximate decoded size
+            self.send_to(client_socket, f"BULK_SINK_DONE:{received}\n".encode('ascii'), CONTROL)
+        # BULK_SOURCE:<total>|<chunk> -> stream that many bytes back as BULK_DATA frames
+        elif line.startswith('BULK_SOURCE:'):
+            total, chunk_size = (int(v) for v in line[12:].split('|'))
+            total = min(total, 256 * 1024 * 1024)
+            chunk_size = max(1024, min(chunk_size, 4 * 1024 * 1024))
+            threading.Thread(target=self.send_bulk, args=(client_socket, total, chunk_size), daemon=True).start()
+    
+    def send_bulk(self, client_socket, total, chunk_size):
+        # Download half of the bulk throughput test; one encoded chunk reused for every frame
+        frame = b"BULK_DATA:" + base64.b64encode(os.urandom(chunk_size)) + b"\n"
+        sent = 0
+        try:
+            while sent < total:
+                self.send_to(client_socket, frame, BULK)
+                sent += chunk_size
+            self.send_to(client_socket, f"BULK_SOURCE_END:{sent}\n".encode('ascii'), BULK)
+        except Exception as e:
+            print(f"Bulk download test aborted: {e}")
+    
+    def handle_stream_frame(self, line, client_socket, client_address):
+        # STREAM_FRAME:<stream_id>|<seq>|<base64> or STREAM_END:<stream_id>
+        if line.startswith('STREAM_END:'):
+            stream_id = line[11:]
+            with self.stream_lock:
+                owned = self.stream_owners.get(stream_id) is client_socket
+            if owned:
+                self.end_stream(stream_id, client_socket)
+                print(f"Stream {stream_id} from {client_address} ended")
+            return
+        
+        try:
+            stream_id, seq, data = parse_frame(line[13:])
+        except ValueError as e:
+            print(f"Invalid stream frame from {client_address}: {e}")
+            return
+        with self.stream_lock:
+            owner = self.stream_owners.get(stream_id)
+            if owner is None:
+                running = sum(1 for s in self.stream_owners.values() if s is client_socket)
+                if running >= self.MAX_STREAMS:
+                    owner = False
+                else:
+                    owner = self.stream_owners[stream_id] = client_socket
+        if owner is not client_socket:
+            return  # Another client's stream id, or over this client's stream limit
+        if not self.stream_seq.accept(stream_id, seq):
+            return  # Older than a frame we already relayed
+        if seq == 1:
+            print(f"Stream {stream_id} started by {client_address}")
+        self.relay_stream(stream_id, f"{line}\n".encode('ascii'), client_socket)
+        self.detect_stream_frame(stream_id, seq, data)
+    
+    def end_stream(self, stream_id, client_socket):
+        # Forget a stream's state and tell the viewers it stopped
+        self.stream_seq.forget(stream_id)
+        with self.stream_lock:
+            self.stream_owners.pop(stream_id, None)
+            self.stream_detection.pop(stream_id, None)
+        try:
+            os.remove(os.path.join(self.stream_dir, f"{stream_id}.jpg"))
+        except OSError:
+            pass
+        self.relay_stream(stream_id, f"STREAM_END:{stream_id}\n".encode('ascii'), client_socket)
+    
+    def end_client_streams(self, client_socket):
+        with self.stream_lock:
+            streams = [sid for sid, owner in self.stream_owners.items() if owner is client_socket]
+        for stream_id in streams:
+            self.end_stream(stream_id, client_socket)
+    
+    def relay_stream(self, stream_id, frame, sender_socket):
+        # Hand the frame to each receiver's outbox, replacing any frame it hasn't sent yet
+        started = []
+        with self.clients_lock:
+            targets = [c for c in self.clients if c is not sender_socket]
+            for client in targets:
+                if client not in self.stream_outboxes:
+                    self.stream_outboxes[client] = LatestMailbox()
+                    started.append(client)
+            outboxes = [self.stream_outboxes[c] for c in targets]
+        for client in started:
+            threading.Thread(target=self.stream_writer, args=(client, self.stream_outboxes[client]), daemon=True).start()
+        for outbox in outboxes:
+            outbox.put(stream_id, frame)
+    
+    def stream_writer(self, client_socket, outbox):
+        # Sends stream frames to one client; while it is slow only the newest frame waits
+        while self.running and not outbox.closed:
+            for frame in outbox.take(timeout=1.0).values():
+                try:
+                    # wait: returns once sent, so frames arriving meanwhile replace each other in the outbox
+                    self.send_to(client_socket, frame, DETECTIONS, wait=True)
+                except Exception:
+                    outbox.close()
+                    break
+        with self.clients_lock:
+            if self.stream_outboxes.get(client_socket) is outbox:
+                del self.stream_outboxes[client_socket]
+    
+    def detect_stream_frame(self, stream_id, seq, data):
+        # One frame per stream in the detector at a time; a newer frame replaces the one waiting
+        if not self.detection_service:
+            return
+        with self.stream_lock:
+            state = self.stream_detection.setdefault(stream_id, {'busy': False, 'next': None})
+            if state['busy']:
+                state['next'] = (seq, data)
+                return
+            state['busy'] = True
+        self.run_stream_detection(stream_id, seq, data)
+    
+    def run_stream_detection(self, stream_id, seq, data):
+        filepath = os.path.join(self.stream_dir, f"{stream_id}.jpg")
+        with open(filepath, 'wb') as f:
+            f.write(base64.b64decode(data))
+        self.detection_service.submit(filepath, lambda result: self.stream_detection_done(stream_id, seq, result))
+    
+    def stream_detection_done(self, stream_id, seq, result):
+        self.broadcast_detections(f"stream:{stream_id}#{seq}", result, verbose=False)
+        with self.stream_lock:
+            state = self.stream_detection.get(stream_id)
+            next_frame = state['next'] if state else None
+            if state:
+                state['next'] = None
+                state['busy'] = next_frame is not None
+        if next_frame:
+            self.run_stream_detection(stream_id, *next_frame)
+    
+    def broadcast_detections(self, image_name, result, verbose=True, image_hash=None):
+        # Send one compact DETECTIONS frame so clients draw overlays without running a model
+        if 'error' in result:
+            print(f"Detection failed for {image_name}: {result['error']}")
+            return
+        from detector import encode_detections
+        payload = encode_detections(image_name, result['size'], result['detections'], image_hash)
+        sent_count = self.send_detections_frame(f"DETECTIONS:{payload}\n".encode('utf-8'))
+        if verbose:
+            print(f"Detections for {image_name}: {len(result['detections'])} objects sent to {sent_count} clients")
+    
+    def relay_detections(self, payload, sender_socket, sender_address):
+        # A client shared its own detection results: pass the small frame on to everyone else
+        try:
+            from detector import decode_detections
+            image_name, _, detections, _ = decode_detections(payload)
+        except Exception as e:
+            print(f"Invalid detections frame from {sender_address}: {e}")
+            return
+        sent_count = self.send_detections_frame(f"DETECTIONS:{payload}\n".encode('utf-8'), exclude=sender_socket)
+        print(f"Detections for {image_name} from {sender_address}: {len(detections)} objects "
+              f"relayed to {sent_count} clients ({len(payload)} bytes)")
+    
+    def send_detections_frame(self, frame, exclude=None):
+        # Returns how many clients the frame reached
+        with self.clients_lock:
+            clients_snapshot = [c for c in self.clients if c is not exclude]
+        sent_count = 0
+        for client in clients_snapshot:
+            try:
+                self.send_to(client, frame, DETECTIONS)
+                sent_count += 1
+            except Exception as e:
+                print(f"Failed to send detections to client: {e}")
+        return sent_count
+    
     def list_server_images(self):
         # Print the images available under server_images/
         if os.path.exists(self.server_images_dir):
@@ -353,6 +923,9 @@ class VMServer:
                 print(f"Could not get network info: {e}")
             
             print(f"\nServer listening on: {self.host}:{self.port}")
+            with self.clients_lock:
+                clients = list(self.clients)
+            print(self.tuning.describe(clients))
             print("\nConnection Tips:")
             print("• For mobile hotspots: Check if 'Client Isolation' is disabled")
             print("• Try different ports if 12345 is blocked (8080, 8888, 3000)")
@@ -370,6 +943,10 @@ class VMServer:
         print("- 'send <filename>' - Send image to all clients")
         print("- 'clients' - Show connected clients")
         print("- 'network' - Show network information")
+        print("- 'stats' - Show inbound buffer usage and outbound queues")
+        print("- 'egress [MB/s]' - Show per-client throughput, or set the total outbound cap (0 = none)")
+        print("- 'egress <n> <MB/s> [weight]' - Cap client n (numbered as in 'egress') and set its share")
+        print("- 'limits [msgs|burst|upload|max|accept <value>]' - Show or change admission and rate limits")
         print("- 'quit' - Stop server\n")
         
         while self.running:
@@ -398,6 +975,15 @@ class VMServer:
                             
                 elif user_input.lower() == 'network':
                     self.show_network_info()
+                    
+                elif user_input.lower() == 'stats':
+                    self.show_stats()
+                    
+                elif user_input.lower() == 'limits' or user_input.lower().startswith('limits '):
+                    self.limits_command(user_input.split()[1:])
+                    
+                elif user_input.lower() == 'egress' or user_input.lower().startswith('egress '):
+                    self.egress_command(user_input.split()[1:])
                             
                 elif user_input.lower().startswith('send '):
                     filename = user_input[5:].strip()
@@ -417,6 +1003,12 @@ class VMServer:
         # Close all sockets and clear state
         print("\nShutting down server...")
         self.running = False
+        if self.discovery:
+            self.discovery.stop()
+        if self.recorder:
+            self.recorder.close()
+        if self.detection_service:
+            self.detection_service.shutdown()
         
         with self.clients_lock:
             clients_copy = list(self.clients)
@@ -445,7 +1037,45 @@ class VMServer:
 
 def main():
     # Start server in background thread and run console input loop
-    server = VMServer()
+    import argparse
+    parser = argparse.ArgumentParser(description="VM text and image server")
+    parser.add_argument('--detect', action='store_true',
+                        help="run YOLOv5 once on the server and broadcast DETECTIONS frames")
+    parser.add_argument('--detect-workers', type=int, default=1, help="detection worker processes")
+    parser.add_argument('--detect-backend', default='eager', help="eager, torchscript or quantized")
+    parser.add_argument('--model', default="yolov5s.pt", help="YOLOv5 weights")
+    parser.add_argument('--no-discovery', action='store_true', help="don't answer UDP discovery probes")
+    parser.add_argument('--record', metavar='DIR', help="record inbound frames to a capture file in DIR for replay.py")
+    add_budget_arguments(parser)
+    add_tuning_arguments(parser)
+    parser.add_argument('--egress-rate', type=float, default=0, metavar='MB/s',
+                        help="cap total outbound bandwidth, shared fairly across clients (default: none)")
+    parser.add_argument('--client-rate', type=float, default=0, metavar='MB/s',
+                        help="cap each client's outbound bandwidth (default: none)")
+    parser.add_argument('--flush-window', type=float, default=FLUSH_WINDOW * 1000, metavar='MS',
+                        help="how long small non-urgent frames wait to be sent together (default: 2, 0 = only "
+                             "coalesce what is already queued)")
+    parser.add_argument('--compress-min', type=int, default=MIN_SIZE, metavar='BYTES',
+                        help="compress text frames at least this large for clients that support it (0 = off)")
+    parser.add_argument('--max-connections', type=int, default=100, help="refuse clients beyond this (0 = no cap)")
+    parser.add_argument('--accept-rate', type=float, default=50, help="new connections accepted per second")
+    parser.add_argument('--msg-rate', type=float, default=100,
+                        help="frames per second per client before its reader is paused (default: 100)")
+    parser.add_argument('--upload-rate', type=float, default=0, metavar='MB/s',
+                        help="inbound bytes per second per client (default: unlimited)")
+    args = parser.parse_args()
+    
+    detection_service = None
+    if args.detect:
+        from detector import DetectionService
+        detection_service = DetectionService(args.detect_backend, args.model, args.detect_workers)
+    server = VMServer(detection_service=detection_service, discovery=not args.no_discovery,
+                      record_dir=args.record, memory_budget=budget_from_args(args),
+                      tuning=tuning_from_args(args),
+                      egress=EgressScheduler(args.egress_rate * 1e6, args.client_rate * 1e6),
+                      admission=AdmissionControl(args.max_connections, args.accept_rate, args.msg_rate,
+                                                 2 * args.msg_rate, args.upload_rate * 1e6),
+                      compress_min=args.compress_min, flush_window=args.flush_window / 1000)
     
     server_thread = threading.Thread(target=server.start_server)
     server_thread.daemon = True
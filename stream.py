@@ -0,0 +1,158 @@
+import time
+import uuid
+import base64
+import threading
+
+# Live stream channel for continuous camera/screen frames where only the newest frame matters.
+#
+#   STREAM_FRAME:<stream_id>|<seq>|<base64 jpeg>\n   sender -> server -> every other client
+#   STREAM_END:<stream_id>\n                          sender stopped
+#
+# Every hop keeps at most one pending frame per stream: a newer frame replaces an unsent one, so a
+# slow link or a slow detector drops frames instead of building a queue, and latency stays bounded.
+
+
+def encode_frame(stream_id, seq, jpeg_bytes):
+    data = base64.b64encode(jpeg_bytes).decode('ascii')
+    return f"STREAM_FRAME:{stream_id}|{seq}|{data}\n".encode('ascii')
+
+
+STREAM_ID_MAX = 32
+STREAM_ID_CHARS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_-")
+
+
+def check_stream_id(stream_id):
+    """The id back if it is short and [A-Za-z0-9_-] only (it names files on the server), else ValueError"""
+    if not stream_id or len(stream_id) > STREAM_ID_MAX or not STREAM_ID_CHARS.issuperset(stream_id):
+        raise ValueError(f"invalid stream id {stream_id[:STREAM_ID_MAX]!r}")
+    return stream_id
+
+
+def parse_frame(payload):
+    """Split a STREAM_FRAME payload into (stream_id, seq, base64_data) without decoding the image"""
+    stream_id, seq, data = payload.split('|', 2)
+    return check_stream_id(stream_id), int(seq), data
+
+
+class LatestMailbox:
+    """Holds the newest item per key; put() overwrites anything not yet taken"""
+
+    def __init__(self):
+        self.items = {}
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, key, item):
+        with self.condition:
+            if key in self.items:
+                self.dropped += 1
+            self.items[key] = item
+            self.condition.notify()
+
+    def take(self, timeout=None):
+        """Wait for items and return {key: newest item}; empty dict on timeout or close"""
+        with self.condition:
+            if not self.items and not self.closed:
+                self.condition.wait(timeout)
+            items, self.items = self.items, {}
+            return items
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class SequenceFilter:
+    """Drops frames that are not newer than the last one accepted for their stream"""
+
+    def __init__(self):
+        self.last = {}
+        self.lock = threading.Lock()
+
+    def accept(self, stream_id, seq):
+        with self.lock:
+            if seq <= self.last.get(stream_id, 0):
+                return False
+            self.last[stream_id] = seq
+            return True
+
+    def forget(self, stream_id):
+        with self.lock:
+            self.last.pop(stream_id, None)
+
+
+class FrameSender:
+    """Sends stream frames from its own thread; frames submitted while a send is in progress are dropped"""
+
+    def __init__(self, send_frame, stream_id=None):
+        self.send_frame = send_frame
+        self.stream_id = stream_id or uuid.uuid4().hex[:8]
+        self.seq = 0
+        self.sent = 0
+        self.mailbox = LatestMailbox()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, jpeg_bytes):
+        self.seq += 1
+        self.mailbox.put(self.stream_id, (self.seq, jpeg_bytes))
+
+    def run(self):
+        while self.running:
+            for seq, jpeg_bytes in self.mailbox.take(timeout=0.5).values():
+                try:
+                    # Blocks while the socket buffer is full; newer frames overwrite the mailbox meanwhile
+                    self.send_frame(encode_frame(self.stream_id, seq, jpeg_bytes))
+                    self.sent += 1
+                except Exception as e:
+                    print(f"Stream {self.stream_id} send failed: {e}")
+                    self.running = False
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.mailbox.close()
+        try:
+            self.send_frame(f"STREAM_END:{self.stream_id}\n".encode('ascii'))
+        except Exception:
+            pass
+
+    def stats(self):
+        return {'stream_id': self.stream_id, 'submitted': self.seq, 'sent': self.sent,
+                'dropped': self.mailbox.dropped}
+
+
+class ScreenStreamer:
+    """Captures the screen at up to fps frames per second and feeds a FrameSender"""
+
+    def __init__(self, sender, fps=10, max_dimension=1280, quality=70):
+        self.sender = sender
+        self.interval = 1.0 / fps
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self.running = True
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        import io
+        from PIL import Image, ImageGrab
+        while self.running:
+            started = time.monotonic()
+            try:
+                image = ImageGrab.grab()
+                image.thumbnail((self.max_dimension, self.max_dimension), Image.Resampling.BILINEAR)
+                buffer = io.BytesIO()
+                image.convert('RGB').save(buffer, 'JPEG', quality=self.quality)
+                self.sender.submit(buffer.getvalue())
+            except Exception as e:
+                print(f"Screen capture failed: {e}")
+                self.running = False
+                break
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def stop(self):
+        self.running = False
@@ -1,5 +1,9 @@
+import os
 import socket
 import time
+import base64
+import netconfig
+from handshake import hello_frame, parse_hello
 
 def test_connection(ip, port, timeout=5):
     """Test connection to server"""
@@ -18,10 +22,11 @@ def test_connection(ip, port, timeout=5):
         if result == 0:
             print(f"✅ SUCCESS: Connected to {ip}:{port} in {end_time - start_time:.2f} seconds")
             
-            # Try to send a test message
+            # Try to send a test message; current servers answer HELLO or TEST_OK:<version>
             try:
-                sock.send(b"TEST_CONNECTION\n")
-                print("✅ SUCCESS: Test message sent successfully")
+                print(f"✅ SUCCESS: Server answered ({greet(sock, LineReader(sock))})")
+            except socket.timeout:
+                print("⚠️  WARNING: Test message sent but the server did not answer (older server?)")
             except Exception as e:
                 print(f"⚠️  WARNING: Could not send test message: {e}")
             
@@ -38,48 +43,199 @@ def test_connection(ip, port, timeout=5):
         print(f"❌ FAILED: Connection error: {e}")
         return False
 
+class LineReader:
+    """Newline frame reader over a socket that skips the server's keepalive pings"""
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b""
+    
+    def read_line(self, prefix):
+        """Return the next line starting with prefix, discarding anything else"""
+        while True:
+            while b"\n" in self.buffer:
+                line, self.buffer = self.buffer.split(b"\n", 1)
+                if line.startswith(prefix):
+                    return line
+            data = self.sock.recv(1024 * 1024)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            self.buffer += data
+
+
+def greet(sock, reader):
+    """HELLO with no optional features (so nothing is compressed), TEST_CONNECTION for older servers;
+    returns a description of whichever the server answered"""
+    sock.sendall(hello_frame([], client="test_connection.py") + b"TEST_CONNECTION\n")
+    reply = reader.read_line((b"HELLO:", b"TEST_OK:"))
+    if reply.startswith(b"TEST_OK:"):
+        return f"version {reply[8:].decode('ascii')}, no HELLO support"
+    version, features, limits, body = parse_hello(reply[6:].decode('utf-8'))
+    shown = ", ".join(f"{name} {value}" for name, value in sorted(limits.items()))
+    return (f"version {body.get('server', '?')}, protocol {version}; features: "
+            f"{', '.join(sorted(features)) or 'none'}; limits: {shown or 'none'}")
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure_rtt(sock, reader, count=50, interval=0.02):
+    """One ECHO in flight at a time; prints the RTT distribution, jitter and clock offset, returns median ms"""
+    rtts, offsets = [], []
+    for i in range(count):
+        sent_ns = time.time_ns()
+        start = time.perf_counter()
+        sock.sendall(f"ECHO:{i}\n".encode('ascii'))
+        reply = reader.read_line(b"ECHO_REPLY:").decode('ascii')
+        rtt = (time.perf_counter() - start) * 1000
+        token, server_ns = reply[11:].split('|')
+        if int(token) != i:
+            continue
+        rtts.append(rtt)
+        # Server clock minus ours, assuming the reply was stamped half way through the round trip
+        offsets.append((int(server_ns) - sent_ns) / 1e6 - rtt / 2)
+        time.sleep(interval)
+    
+    if not rtts:
+        print("❌ No echo replies")
+        return None
+    ordered = sorted(rtts)
+    # Jitter as in RFC 3550: mean difference between consecutive round trips
+    jitter = sum(abs(b - a) for a, b in zip(rtts, rtts[1:])) / max(1, len(rtts) - 1)
+    print(f"RTT over {len(rtts)} echoes (ms): min {ordered[0]:.2f}  median {percentile(ordered, 0.5):.2f}  "
+          f"p95 {percentile(ordered, 0.95):.2f}  p99 {percentile(ordered, 0.99):.2f}  max {ordered[-1]:.2f}")
+    print(f"Jitter: {jitter:.2f} ms   Clock offset (server - local): {sorted(offsets)[len(offsets) // 2]:+.1f} ms")
+    return percentile(ordered, 0.5)
+
+
+def measure_upload(sock, reader, total, chunk_size):
+    """Send total bytes as BULK_SINK frames; MB/s counted until the server confirms receipt"""
+    frame = b"BULK_SINK:" + base64.b64encode(os.urandom(chunk_size)) + b"\n"
+    start = time.perf_counter()
+    sent = 0
+    while sent < total:
+        sock.sendall(frame)
+        sent += chunk_size
+    sock.sendall(b"BULK_SINK_END\n")
+    reader.read_line(b"BULK_SINK_DONE:")
+    return sent / (time.perf_counter() - start) / 1e6
+
+
+def measure_download(sock, reader, total, chunk_size):
+    """Ask the server for total bytes as BULK_DATA frames and time their arrival"""
+    start = time.perf_counter()
+    sock.sendall(f"BULK_SOURCE:{total}|{chunk_size}\n".encode('ascii'))
+    received = int(reader.read_line(b"BULK_SOURCE_END:")[16:])
+    return received / (time.perf_counter() - start) / 1e6
+
+
+def run_diagnostics(ip, port, pings=50, bulk_mb=8, chunk_sizes=(16, 64, 256, 1024), save_config=None):
+    """RTT/jitter plus upload and download MB/s for each chunk size (in KB); save_config writes
+    netconfig settings with buffers sized from the measured bandwidth-delay product"""
+    print(f"Diagnostics against {ip}:{port}")
+    sock = socket.create_connection((ip, port), timeout=30)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reader = LineReader(sock)
+    try:
+        print(f"✅ Server {greet(sock, reader)}")
+        median_rtt = measure_rtt(sock, reader, pings)
+        
+        total = bulk_mb * 1024 * 1024
+        print(f"\nBulk transfer, {bulk_mb} MB per run (payload MB/s; base64 adds 33% on the wire):")
+        print(f"{'chunk':>8} {'upload':>10} {'download':>10}")
+        best = None
+        peak = 0.0
+        for chunk_kb in chunk_sizes:
+            up = measure_upload(sock, reader, total, chunk_kb * 1024)
+            down = measure_download(sock, reader, total, chunk_kb * 1024)
+            print(f"{chunk_kb:>6}KB {up:>10.1f} {down:>10.1f}")
+            peak = max(peak, up, down)
+            if best is None or up + down > best[1]:
+                best = (chunk_kb, up + down)
+        print(f"Best chunk size: {best[0]} KB")
+        
+        if median_rtt:
+            # Bytes in flight needed to keep the link busy; base64 framing puts 4/3 of that on the wire
+            bdp = peak * 1e6 * 4 / 3 * median_rtt / 1000
+            size = netconfig.buffer_for_bdp(bdp)
+            print(f"Bandwidth-delay product: {bdp / 1024:.0f} KB -> suggested socket buffers {size // 1024} KB "
+                  f"(server.py --rcvbuf {size} --sndbuf {size})")
+            if save_config:
+                tuning = netconfig.SocketTuning(rcvbuf=size, sndbuf=size, recv_size=min(size, 1024 * 1024))
+                tuning.save(save_config)
+                print(f"Saved socket settings to {save_config} (use with --net-config)")
+    except Exception as e:
+        print(f"❌ Diagnostics failed: {e}")
+    finally:
+        sock.close()
+
+
 def main():
+    import argparse
+    import discovery
+    parser = argparse.ArgumentParser(description="Find and test servers on the LAN")
+    parser.add_argument('host', nargs='?', help="test only this address")
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--scan', action='store_true',
+                        help="also try a TCP connect to every address in the local /24 subnets")
+    parser.add_argument('--diag', action='store_true',
+                        help="measure RTT, jitter and bulk throughput against host (or the fastest server found)")
+    parser.add_argument('--pings', type=int, default=50, help="echo round trips for --diag (default: 50)")
+    parser.add_argument('--bulk-mb', type=int, default=8, help="MB per bulk transfer run for --diag (default: 8)")
+    parser.add_argument('--save-config', metavar='FILE',
+                        help="with --diag, write socket settings sized from the measured BDP for --net-config")
+    args = parser.parse_args()
+    
     print("Network Connection Test Tool")
     print("=" * 40)
     
-    # Test common VM IP addresses
-    vm_ips = [
-        "172.20.10.7",       # Your VM on mobile hotspot (from ifconfig)
-        "192.168.56.1",      # VirtualBox/Hyper-V default
-        "192.168.1.100",     # Common home network
-        "10.0.2.15",         # VirtualBox NAT
-        "172.20.10.6",       # Your Windows machine on mobile hotspot
-        "localhost",          # Local connection
-        "127.0.0.1"          # Loopback
-    ]
+    if args.host:
+        if args.diag:
+            run_diagnostics(args.host, args.port, args.pings, args.bulk_mb, save_config=args.save_config)
+        else:
+            test_connection(args.host, args.port)
+        return
     
-    port = 12345
+    # UDP discovery: broadcast and unicast probes go out together, replies ranked by RTT
+    start_time = time.time()
+    servers = discovery.discover()
+    print(f"Discovery finished in {time.time() - start_time:.2f} seconds")
     
-    print(f"Testing port: {port}")
+    # Servers without discovery (or with UDP blocked): connect to all candidates at once
+    candidates = list(discovery.FALLBACK_HOSTS)
+    if args.scan:
+        candidates += discovery.subnet_hosts()
+    start_time = time.time()
+    reachable = discovery.probe_tcp(candidates, args.port)
+    print(f"TCP probe of {len(candidates)} addresses finished in {time.time() - start_time:.2f} seconds")
     print()
     
-    successful_connections = []
-    
-    for ip in vm_ips:
-        if test_connection(ip, port):
-            successful_connections.append(ip)
-        print()
-    
     print("=" * 40)
-    if successful_connections:
-        print("✅ SUCCESSFUL CONNECTIONS:")
-        for ip in successful_connections:
-            print(f"   • {ip}:{port}")
+    if servers or reachable:
+        print("✅ SERVERS FOUND (fastest first):")
+        for reply in servers:
+            print(f"   • {discovery.format_server(reply)}")
+        for reply in reachable:
+            print(f"   • {discovery.format_server(reply)}")
         print()
         print("Use one of these IP addresses in your client!")
+        # Only the VM server (or an unidentified TCP listener on --port) speaks the diagnostics commands
+        best = next((r for r in servers + reachable if r.get('service') in ('vm', 'tcp')), None)
+        if args.diag and best:
+            print()
+            run_diagnostics(best['address'], best['port'], args.pings, args.bulk_mb,
+                            save_config=args.save_config)
     else:
-        print("❌ NO SUCCESSFUL CONNECTIONS")
+        print("❌ NO SERVERS FOUND")
         print()
         print("Troubleshooting tips:")
         print("1. Make sure the server is running")
-        print("2. Check if port 12345 is not blocked by firewall")
+        print(f"2. Check if port {args.port} (TCP) and {discovery.DISCOVERY_PORT} (UDP) are not blocked by firewall")
         print("3. For mobile hotspot: disable 'Client Isolation'")
         print("4. Ensure both devices are on the same network")
+        print("5. Try --scan to probe every address on the local subnet")
     
     print()
     print("Press Enter to exit...")
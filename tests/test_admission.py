@@ -0,0 +1,74 @@
+import time
+import unittest
+
+from admission import TokenBucket, ClientLimiter, AdmissionControl
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_debt(self):
+        bucket = TokenBucket(rate=100, burst=5)
+        self.assertEqual([bucket.consume(1) for _ in range(5)], [0.0] * 5)
+        delay = bucket.consume(3)
+        self.assertAlmostEqual(delay, 0.03, delta=0.005)  # 3 tokens short at 100/s
+
+    def test_zero_rate_is_unlimited(self):
+        bucket = TokenBucket(rate=0, burst=0)
+        self.assertEqual(bucket.consume(10 ** 9), 0.0)
+
+    def test_refills_over_time(self):
+        bucket = TokenBucket(rate=1000, burst=10)
+        bucket.consume(10)
+        time.sleep(0.02)
+        self.assertEqual(bucket.consume(10), 0.0)
+
+
+class ClientLimiterTest(unittest.TestCase):
+
+    def test_frame_rate_pauses_reader(self):
+        control = AdmissionControl(message_rate=50, message_burst=2)
+        limiter = ClientLimiter(control, "client")
+        started = time.perf_counter()
+        for _ in range(4):
+            limiter.admit_frame(b"CLIENT:hi")
+        self.assertGreater(time.perf_counter() - started, 0.03)  # Two frames over the burst at 50/s
+        self.assertGreater(limiter.throttled, 0)
+        self.assertGreater(control.metrics['throttle_events_frames'], 0)
+
+    def test_bulk_frames_skip_frame_rate(self):
+        control = AdmissionControl(message_rate=1, message_burst=1)
+        limiter = ClientLimiter(control, "client")
+        for _ in range(50):
+            self.assertEqual(limiter.admit_frame(b"IMAGE_CHUNK:abc|AAAA"), 0.0)
+
+    def test_limits_apply_to_connected_clients(self):
+        control = AdmissionControl(message_rate=1, message_burst=1)
+        limiter = ClientLimiter(control, "client")
+        control.set_limit('msgs', 0)  # Console: no frame limit
+        for _ in range(50):
+            self.assertEqual(limiter.admit_frame(b"CLIENT:hi"), 0.0)
+
+
+class AdmissionControlTest(unittest.TestCase):
+
+    def test_connection_cap(self):
+        control = AdmissionControl(max_connections=2)
+        self.assertTrue(control.admit(0))
+        self.assertTrue(control.admit(1))
+        self.assertFalse(control.admit(2))
+        self.assertEqual(control.metrics['rejected_full'], 1)
+        control.set_limit('max', 0)
+        self.assertTrue(control.admit(500))
+
+    def test_set_limit(self):
+        control = AdmissionControl()
+        control.set_limit('msgs', 20)
+        self.assertEqual((control.message_rate, control.message_burst), (20, 40))
+        control.set_limit('upload', 2)
+        self.assertEqual(control.upload_rate, 2e6)
+        with self.assertRaises(ValueError):
+            control.set_limit('bogus', 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import base64
+import os
+import tempfile
+import unittest
+
+from buffers import MB, MemoryBudget, FrameBuffer, SpilledFrame, InboundLimitError, decode_spilled_image
+
+
+class FrameBufferTest(unittest.TestCase):
+
+    def test_frames_split_across_reads(self):
+        budget = MemoryBudget()
+        buffer = FrameBuffer(budget)
+        self.assertEqual(buffer.feed(b"CLIENT:he"), [])
+        self.assertEqual(buffer.feed(b"llo\nCLIENT:a\nCLI"), [b"CLIENT:hello", b"CLIENT:a"])
+        self.assertEqual(budget.used, 3)  # Only the partial frame is held
+        buffer.close()
+        self.assertEqual(budget.used, 0)
+
+    def test_large_frame_spills_and_reads_back(self):
+        budget = MemoryBudget(connection_limit=1024)
+        buffer = FrameBuffer(budget)
+        payload = os.urandom(10000)
+        frame = b"IMAGE:big.bin|" + base64.b64encode(payload)
+        frames = []
+        for i in range(0, len(frame), 700):
+            frames += buffer.feed(frame[i:i + 700])
+        self.assertEqual(frames, [])
+        self.assertEqual(budget.used, 0)  # The partial frame moved out of memory
+        frames = buffer.feed(b"\nCLIENT:after\n")
+        self.assertIsInstance(frames[0], SpilledFrame)
+        self.assertEqual(frames[1], b"CLIENT:after")
+        spilled = frames[0]
+        self.assertEqual(spilled.size, len(frame))
+        self.assertTrue(spilled.startswith(b"IMAGE:big.bin|"))
+        self.assertEqual(b"".join(spilled.chunks(chunk_size=4096)), frame)
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename, path = decode_spilled_image(spilled, b"IMAGE:", lambda name: os.path.join(directory, name))
+            self.assertEqual(filename, "big.bin")
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), payload)
+        self.assertEqual(budget.spilled, len(frame))
+        spilled.close()
+        self.assertEqual(budget.spilled, 0)
+        self.assertEqual(budget.spilled_frames, 1)
+
+    def test_global_budget_spills_before_connection_limit(self):
+        budget = MemoryBudget(limit=100, connection_limit=MB)
+        first, second = FrameBuffer(budget), FrameBuffer(budget)
+        first.feed(b"x" * 80)
+        second.feed(b"y" * 40)  # Does not fit next to the first connection's 80 bytes
+        self.assertIsNotNone(second.spill)
+        self.assertEqual(budget.used, 80)
+        first.close()
+        second.close()
+        self.assertEqual((budget.used, budget.spilled), (0, 0))
+
+    def test_frame_over_max_frame_is_rejected(self):
+        budget = MemoryBudget(connection_limit=100, max_frame=1000)
+        buffer = FrameBuffer(budget)
+        buffer.feed(b"a" * 500)
+        with self.assertRaises(InboundLimitError):
+            buffer.feed(b"a" * 600)
+        buffer.close()
+        self.assertEqual(budget.spilled, 0)
+
+    def test_spill_limit_across_connections(self):
+        budget = MemoryBudget(connection_limit=100, spill_limit=300)
+        first, second = FrameBuffer(budget), FrameBuffer(budget)
+        first.feed(b"a" * 200)
+        with self.assertRaises(InboundLimitError):
+            second.feed(b"b" * 200)
+        first.close()
+        second.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
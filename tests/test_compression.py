@@ -0,0 +1,65 @@
+import base64
+import os
+import unittest
+import zlib
+
+import compression
+from compression import (FrameCompressor, CompressionStats, decompress_frame, decompress_bytes, negotiate,
+                         available_codecs, MAX_DECOMPRESSED)
+
+
+class FrameCompressorTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        stats = CompressionStats()
+        frame = b"IMAGE_LIST:" + b'["holiday_photo.jpg", ' * 100 + b"]\n"
+        packed = FrameCompressor('zlib', stats).compress(frame)
+        self.assertTrue(packed.startswith(b"ZFRAME:zlib|") and packed.endswith(b"\n"))
+        self.assertLess(len(packed), len(frame))
+        self.assertEqual(decompress_frame(packed[:-1], stats), frame[:-1])
+        self.assertEqual((stats.frames, stats.inflated_frames), (1, 1))
+
+    def test_small_binary_and_incompressible_frames_pass_through(self):
+        stats = CompressionStats()
+        compressor = FrameCompressor('zlib', stats, min_size=512)
+        small = b"CLIENT:" + b"a" * 100 + b"\n"
+        image = b"IMAGE_CHUNK:t1|" + b"A" * 4000 + b"\n"
+        noise = b"CLIENT:" + base64.b64encode(os.urandom(3000)) + b"\n"
+        self.assertIs(compressor.compress(small), small)
+        self.assertIs(compressor.compress(image), image)
+        self.assertIs(compressor.compress(noise), noise)
+        self.assertEqual((stats.frames, stats.skipped), (0, 1))
+
+    def test_expansion_past_limit_is_rejected(self):
+        bomb = zlib.compress(bytes(MAX_DECOMPRESSED + 1), 9)
+        with self.assertRaises(ValueError):
+            decompress_bytes('zlib', bomb)
+        frame = b"ZFRAME:zlib|" + base64.b64encode(bomb)
+        with self.assertRaises(ValueError):
+            decompress_frame(frame)
+        self.assertEqual(len(decompress_bytes('zlib', zlib.compress(bytes(MAX_DECOMPRESSED)))), MAX_DECOMPRESSED)
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            decompress_bytes('lz4', b"")
+
+    @unittest.skipUnless(compression.ZSTD_AVAILABLE, "zstandard not installed")
+    def test_zstd_round_trip_and_limit(self):
+        frame = b"MESSAGE:" + b"server says hello " * 100 + b"\n"
+        self.assertEqual(decompress_frame(FrameCompressor('zstd').compress(frame)[:-1]), frame[:-1])
+        bomb = compression.compress_bytes('zstd', bytes(MAX_DECOMPRESSED + 1))
+        with self.assertRaises(ValueError):
+            decompress_bytes('zstd', bomb)
+
+
+class NegotiateTest(unittest.TestCase):
+
+    def test_best_shared_codec(self):
+        self.assertEqual(negotiate({'zlib', 'offers'}), 'zlib')
+        self.assertIsNone(negotiate({'offers', 'lz4'}))
+        self.assertEqual(negotiate({'zstd', 'zlib'}), 'zstd' if compression.ZSTD_AVAILABLE else 'zlib')
+        self.assertEqual(available_codecs()[-1], 'zlib')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from content_cache import ContentCache, sha256_bytes
+
+
+class ContentCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.directory = self.temp.name
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def ready_cache(self):
+        cache = ContentCache(self.directory)
+        deadline = time.time() + 5
+        while not os.path.exists(cache.index_path) and time.time() < deadline:
+            time.sleep(0.01)  # First run: the background scan writes the index
+        return cache
+
+    def save_image(self, cache, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return cache.add(path, name=name, data=data)
+
+    def test_changes_are_journaled_not_rewritten(self):
+        cache = self.ready_cache()
+        with open(cache.index_path, 'rb') as f:
+            index = f.read()
+        digests = [self.save_image(cache, f"img{i}.jpg", os.urandom(64)) for i in range(50)]
+        cache.remember("renamed.jpg", digests[0])
+        with open(cache.index_path, 'rb') as f:
+            self.assertEqual(f.read(), index)
+        with open(cache.journal_path, 'r', encoding='utf-8') as f:
+            self.assertEqual(len(f.readlines()), 51)
+
+        # Next start folds the journal into the index
+        reloaded = ContentCache(self.directory)
+        self.assertFalse(os.path.exists(reloaded.journal_path))
+        self.assertEqual(reloaded.lookup(digests[7]), os.path.join(self.directory, "img7.jpg"))
+        self.assertEqual(reloaded.hash_for_name("renamed.jpg"), digests[0])
+        with open(reloaded.index_path, 'r', encoding='utf-8') as f:
+            self.assertEqual(len(json.load(f)['by_hash']), 50)
+
+    def test_torn_journal_line_is_skipped(self):
+        cache = self.ready_cache()
+        digest = self.save_image(cache, "a.jpg", b"a" * 10)
+        with open(cache.journal_path, 'a', encoding='utf-8') as f:
+            f.write('{"sha256": "' + sha256_bytes(b"b"))  # Crashed mid-write
+        reloaded = ContentCache(self.directory)
+        self.assertEqual(reloaded.hash_for_name("a.jpg"), digest)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import json
+import unittest
+
+import compression
+from handshake import PROTOCOL_VERSION, hello_frame, parse_hello, select_features
+
+SERVER_FEATURES = ('dedup', 'resume')
+
+
+class HelloFrameTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        frame = hello_frame(['offers', 'zlib'], {'max_rate': 1000}, client="client.py")
+        self.assertTrue(frame.startswith(b"HELLO:") and frame.endswith(b"\n"))
+        self.assertEqual(frame.count(b"\n"), 1)
+        version, features, limits, body = parse_hello(frame[6:-1].decode('utf-8'))
+        self.assertEqual(version, PROTOCOL_VERSION)
+        self.assertEqual(features, {'offers', 'zlib'})
+        self.assertEqual(limits, {'max_rate': 1000})
+        self.assertEqual(body['client'], "client.py")
+
+    def test_minimal_and_malformed_payloads(self):
+        self.assertEqual(parse_hello("{}")[:3], (1, set(), {}))
+        for payload in ("not json", "[1, 2]", json.dumps({'limits': [1]}), json.dumps({'version': 'two'})):
+            with self.assertRaises(ValueError):
+                parse_hello(payload)
+
+
+class SelectFeaturesTest(unittest.TestCase):
+
+    def test_with_compression(self):
+        offered = {'offers', 'chunked', 'resume', 'zlib', 'binary'}
+        self.assertEqual(select_features(offered, SERVER_FEATURES),
+                         ['offers', 'chunked', 'resume', 'dedup', 'zlib'])
+
+    def test_without_compression(self):
+        self.assertEqual(select_features({'offers', 'zlib'}, SERVER_FEATURES, compress=False),
+                         ['offers', 'dedup', 'resume'])
+
+    def test_prefers_zstd_when_both_sides_have_it(self):
+        features = select_features({'zstd', 'zlib'}, SERVER_FEATURES)
+        self.assertEqual(features[-1], 'zstd' if compression.ZSTD_AVAILABLE else 'zlib')
+
+    def test_legacy_or_empty_offer(self):
+        self.assertEqual(select_features(set(), SERVER_FEATURES), ['dedup', 'resume'])
+
+    def test_server_limits_client_features(self):
+        # The image server only implements offers among the optional client features
+        self.assertEqual(select_features({'offers', 'chunked', 'resume'}, SERVER_FEATURES, ('offers',), False),
+                         ['offers', 'dedup', 'resume'])
+
+
+if __name__ == '__main__':
+    unittest.main()
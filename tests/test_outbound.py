@@ -0,0 +1,161 @@
+import threading
+import time
+import unittest
+
+from outbound import ConnectionWriter, EgressScheduler, CONTROL, TEXT, BULK
+
+
+class GatedSocket:
+    """Socket stand-in without sendmsg whose first send blocks until the test opens the gate"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.entered = threading.Event()
+        self.gate = threading.Event()
+        self.sends = 0
+
+    def send(self, view):
+        self.sends += 1
+        self.entered.set()
+        self.gate.wait(5)
+        self.data += bytes(view)
+        return len(view)
+
+
+class TrickleSocket(GatedSocket):
+    """Adds sendmsg that takes at most limit bytes per call, like a full send buffer"""
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self.batches = []  # Buffer count of each sendmsg call
+
+    def sendmsg(self, buffers):
+        self.batches.append(len(buffers))
+        taken = 0
+        for buffer in buffers:
+            part = bytes(buffer[:self.limit - taken])
+            self.data += part
+            taken += len(part)
+            if taken == self.limit:
+                break
+        return taken
+
+
+class BrokenSocket:
+    def send(self, view):
+        raise OSError("broken pipe")
+
+
+class ConnectionWriterTest(unittest.TestCase):
+
+    def test_urgent_frames_go_between_chunks(self):
+        sock = GatedSocket()
+        writer = ConnectionWriter(sock, flush_window=0)
+        writer.send_frames([b"C1\n", b"C2\n", b"C3\n"], BULK)
+        self.assertTrue(sock.entered.wait(5))  # First chunk is on its way
+        writer.send(b"T\n", TEXT)
+        writer.send(b"P\n", CONTROL)
+        sock.gate.set()
+        writer.send(b"END\n", BULK, wait=True)
+        self.assertEqual(bytes(sock.data), b"C1\nP\nT\nC2\nC3\nEND\n")
+        stats = writer.stats()
+        self.assertEqual(stats['bulk']['frames'], 4)
+        self.assertEqual(stats['control']['frames'], 1)
+        writer.close()
+
+    def test_small_frames_coalesce_across_partial_sendmsg(self):
+        sock = TrickleSocket(limit=7)
+        writer = ConnectionWriter(sock, flush_window=0.05)
+        writer.send(b"first\n", CONTROL)
+        self.assertTrue(sock.entered.wait(5))
+        frames = [f"CLIENT:line {i}\n".encode('ascii') for i in range(10)]
+        for frame in frames:
+            writer.send(frame, TEXT)
+        sock.gate.set()
+        writer.send(b"last\n", TEXT, wait=True)
+        self.assertEqual(bytes(sock.data), b"first\n" + b"".join(frames) + b"last\n")
+        # The queued lines went out as one batch, resumed from the first unsent byte each call
+        self.assertGreaterEqual(sock.batches[0], 10)  # "last" may join them
+        self.assertEqual(writer.stats()['text']['frames'], 11)
+        self.assertEqual(writer.writes, sock.sends + len(sock.batches))
+        writer.close()
+
+    def test_failed_write_releases_waiters_and_closes(self):
+        errors = []
+        writer = ConnectionWriter(BrokenSocket(), on_error=errors.append, flush_window=0)
+        with self.assertRaises(ConnectionError):
+            writer.send(b"x\n", TEXT, wait=True)
+        self.assertEqual(errors, ["broken pipe"])
+        with self.assertRaises(ConnectionError):
+            writer.send(b"y\n")
+
+    def test_close_drops_queue(self):
+        sock = GatedSocket()
+        writer = ConnectionWriter(sock, flush_window=0)
+        writer.send(b"first\n")
+        self.assertTrue(sock.entered.wait(5))
+        writer.send(b"dropped\n")
+        writer.close()
+        sock.gate.set()
+        writer.thread.join(5)
+        self.assertNotIn(b"dropped", bytes(sock.data))
+
+
+class EgressSchedulerTest(unittest.TestCase):
+
+    def send_for(self, scheduler, flows, seconds, size=2000):
+        # One thread per flow acquiring size-byte frames until the deadline
+        deadline = time.perf_counter() + seconds
+
+        def pump(flow):
+            while time.perf_counter() < deadline:
+                scheduler.acquire(flow, size)
+
+        threads = [threading.Thread(target=pump, args=(flow,)) for flow in flows]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_uncapped_only_counts(self):
+        scheduler = EgressScheduler()
+        flow = scheduler.register("a")
+        started = time.perf_counter()
+        for _ in range(100):
+            scheduler.acquire(flow, 100000)
+        self.assertLess(time.perf_counter() - started, 0.5)
+        self.assertEqual(flow.sent, 10000000)
+
+    def test_client_cap(self):
+        scheduler = EgressScheduler()
+        flow = scheduler.register("a")
+        scheduler.set_flow(flow, rate=100000)
+        started = time.perf_counter()
+        for _ in range(10):
+            scheduler.acquire(flow, 5000)
+        # 50 KB at 100 KB/s, less the 5 KB the bucket may start with
+        self.assertGreater(time.perf_counter() - started, 0.35)
+
+    def test_global_cap_is_shared_by_weight(self):
+        scheduler = EgressScheduler(rate=400000)
+        light, heavy = scheduler.register("light"), scheduler.register("heavy", weight=2.0)
+        self.send_for(scheduler, (light, heavy), 1.0)
+        ratio = heavy.sent / light.sent
+        self.assertTrue(1.5 < ratio < 2.6, ratio)
+        self.assertLess(light.sent + heavy.sent, 400000 * 1.3)
+
+    def test_closed_flow_stops_waiting(self):
+        scheduler = EgressScheduler(rate=1000)
+        flow = scheduler.register("a")
+        scheduler.acquire(flow, 5000)  # Puts the global bucket well into debt
+        waiter = threading.Thread(target=scheduler.acquire, args=(flow, 5000))
+        waiter.start()
+        time.sleep(0.1)
+        scheduler.unregister(flow)
+        waiter.join(2)
+        self.assertFalse(waiter.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
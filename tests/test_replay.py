@@ -0,0 +1,101 @@
+import asyncio
+import base64
+import gzip
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from capture import MAGIC, HEADER, OPEN, FRAME, CLOSE
+from replay import rename_ids, replay
+from server import VMServer
+
+
+def write_capture(path, frames):
+    """One recorded connection sending [(seconds, frame bytes)]"""
+    with gzip.open(path, 'wb') as f:
+        f.write(MAGIC)
+        records = [(OPEN, 0.0, b"127.0.0.1:5000")] + [(FRAME, t, frame) for t, frame in frames]
+        records.append((CLOSE, frames[-1][0], b""))
+        for kind, timestamp, data in records:
+            f.write(HEADER.pack(kind, 1, timestamp, len(data)))
+            f.write(data)
+
+
+class FakeDetector:
+    """Records the files the server hands to detection"""
+
+    def __init__(self):
+        self.paths = []
+
+    def submit(self, filepath, callback):
+        self.paths.append(filepath)
+
+    def shutdown(self):
+        pass
+
+
+class RenameIdsTest(unittest.TestCase):
+
+    def test_ids_get_a_per_copy_suffix(self):
+        self.assertEqual(rename_ids(b"IMAGE_CHUNK:abc123|AAAA", 0), b"IMAGE_CHUNK:abc123|AAAA")
+        self.assertEqual(rename_ids(b"IMAGE_CHUNK:abc123|AAAA", 2), b"IMAGE_CHUNK:abc123r2|AAAA")
+        self.assertEqual(rename_ids(b"IMAGE_END:abc123", 1), b"IMAGE_END:abc123r1")
+        self.assertEqual(rename_ids(b"STREAM_END:cam", 3), b"STREAM_END:cam-3")
+        self.assertEqual(rename_ids(b"STREAM_FRAME:" + b"s" * 32 + b"|1|AA", 12), b"STREAM_FRAME:" + b"s" * 29 + b"-12|1|AA")
+        self.assertEqual(rename_ids(b"ECHO:abc|x", 1), b"ECHO:abc|x")
+
+
+class ReplayServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.temp.name)  # The server keeps its folders relative to the working directory
+        self.detector = FakeDetector()
+        self.server = VMServer(host='127.0.0.1', port=0, detection_service=self.detector, discovery=False)
+        threading.Thread(target=self.server.start_server, daemon=True).start()
+        deadline = time.time() + 5
+        while not self.server.running and time.time() < deadline:
+            time.sleep(0.01)
+        self.port = self.server.server_socket.getsockname()[1]
+
+    def tearDown(self):
+        self.server.running = False
+        self.server.server_socket.close()
+        os.chdir(self.cwd)
+        self.temp.cleanup()
+
+    def test_copies_upload_and_stream_side_by_side(self):
+        data = base64.b64encode(b"jpeg").decode('ascii')
+        capture = os.path.join(self.temp.name, "session.vmcap")
+        # The copies overlap: both have begun the upload and the stream before either ends
+        write_capture(capture, [
+            (0.0, b"IMAGE_BEGIN:abc123|photo.jpg|4"),
+            (0.0, f"STREAM_FRAME:cam1|1|{data}".encode('ascii')),
+            (0.3, f"IMAGE_CHUNK:abc123|{data}".encode('ascii')),
+            (0.3, b"IMAGE_END:abc123"),
+        ])
+        stats = asyncio.run(replay(capture, '127.0.0.1', self.port, 1.0, 2))
+        self.assertEqual(len(stats.latency_ms[b'IMAGE_END:']), 2)
+        self.assertEqual((stats.failed, stats.unanswered, stats.errors), (0, 0, 0))
+        streams = sorted(os.path.basename(p) for p in self.detector.paths if '.streams' in p)
+        self.assertEqual(streams, ["cam1-1.jpg", "cam1.jpg"])
+
+    def test_chunked_image_requests_are_answered(self):
+        with open(os.path.join(self.server.server_images_dir, "a.png"), 'wb') as f:
+            f.write(os.urandom(200 * 1024))  # Several SERVER_IMAGE_CHUNK frames
+        capture = os.path.join(self.temp.name, "chunked.vmcap")
+        write_capture(capture, [
+            (0.0, b"FEATURES:chunked,resume"),
+            (0.1, b"REQUEST_IMAGE:a.png"),
+            (0.2, b"REQUEST_IMAGE:a.png"),
+        ])
+        stats = asyncio.run(replay(capture, '127.0.0.1', self.port, 1.0, 1))
+        self.assertEqual(len(stats.latency_ms[b'REQUEST_IMAGE:']), 2)
+        self.assertEqual((stats.failed, stats.unanswered, stats.errors), (0, 0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
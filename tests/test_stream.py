@@ -0,0 +1,71 @@
+import base64
+import os
+import tempfile
+import unittest
+
+from stream import check_stream_id, parse_frame, encode_frame
+from server import VMServer
+
+
+class FakeDetector:
+    """Records the files a stream frame is written to instead of running a model"""
+
+    def __init__(self):
+        self.paths = []
+
+    def submit(self, filepath, callback):
+        self.paths.append(filepath)
+
+
+class StreamIdTest(unittest.TestCase):
+
+    def test_unsafe_ids_are_rejected(self):
+        for stream_id in ("../x", "..", "/etc/passwd", "a/b", "a\\b", "C:x", "x.jpg", "", "s" * 33):
+            with self.assertRaises(ValueError, msg=stream_id):
+                check_stream_id(stream_id)
+        self.assertEqual(check_stream_id("cam_1-A"), "cam_1-A")
+
+    def test_parse_frame_checks_the_id(self):
+        frame = encode_frame("../x", 1, b"jpeg").decode('ascii')
+        with self.assertRaises(ValueError):
+            parse_frame(frame[13:].strip())
+
+
+class ServerStreamPathTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.temp.name)  # The server keeps its folders relative to the working directory
+        self.detector = FakeDetector()
+        self.server = VMServer(detection_service=self.detector, discovery=False)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.temp.cleanup()
+
+    def files(self):
+        return sorted(os.path.relpath(os.path.join(root, name), self.temp.name)
+                      for root, _, names in os.walk(self.temp.name) for name in names)
+
+    def test_traversal_ids_write_nothing(self):
+        victim = os.path.join(self.temp.name, "victim.jpg")
+        with open(victim, 'wb') as f:
+            f.write(b"keep")
+        sender = object()
+        data = base64.b64encode(b"jpeg").decode('ascii')
+        for stream_id in ("../x", "../../victim", victim[:-4], "a/b", "a\\b"):
+            self.server.handle_stream_frame(f"STREAM_FRAME:{stream_id}|1|{data}", sender, "a")
+            self.server.handle_stream_frame(f"STREAM_END:{stream_id}", sender, "a")
+        self.assertEqual(self.detector.paths, [])
+        self.assertEqual(self.server.stream_owners, {})
+        self.assertEqual(self.files(), ["victim.jpg"])
+
+        self.server.handle_stream_frame(f"STREAM_FRAME:cam1|1|{data}", sender, "a")
+        stream_dir = os.path.realpath(self.server.stream_dir)
+        self.assertEqual([os.path.dirname(os.path.realpath(p)) for p in self.detector.paths], [stream_dir])
+        self.assertEqual(self.files(), [os.path.join("received_images", ".streams", "cam1.jpg"), "victim.jpg"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+import base64
+import os
+import tempfile
+import time
+import unittest
+
+from content_cache import sha256_bytes
+from transfer import UploadAssembler, UploadQueue
+
+
+def chunk_payload(transfer_id, data):
+    return f"{transfer_id}|{base64.b64encode(data).decode('ascii')}"
+
+
+class UploadAssemblerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.partial_dir = os.path.join(self.temp.name, ".partial")
+        self.data = os.urandom(5000)
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def test_resume_offset_survives_detach_and_restart(self):
+        assembler = UploadAssembler(self.partial_dir)
+        assembler.begin("client-a", f"t1|photo.jpg|{len(self.data)}|{sha256_bytes(self.data)}")
+        assembler.chunk("client-a", chunk_payload("t1", self.data[:2000]))
+        assembler.detach("client-a")
+
+        # New process, new connection: the partial file and sidecar are all that is left
+        assembler = UploadAssembler(self.partial_dir)
+        self.assertEqual([(tid, received) for tid, _, received in assembler.partials()], [("t1", 2000)])
+        self.assertEqual(assembler.resume("client-b", "t1", "photo.jpg", len(self.data)), 2000)
+        with self.assertRaises(ValueError):
+            assembler.chunk("client-a", chunk_payload("t1", self.data[2000:]))  # Old owner
+        assembler.chunk("client-b", chunk_payload("t1", self.data[2000:]))
+        filename, path, size = assembler.end("client-b", "t1")
+        self.assertEqual((filename, size), ("photo.jpg", len(self.data)))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        # A resume after a lost IMAGE_DONE is told the transfer completed
+        self.assertIsNone(assembler.resume("client-b", "t1", "photo.jpg", len(self.data)))
+
+    def test_resumed_upload_is_checked_against_its_hash(self):
+        assembler = UploadAssembler(self.partial_dir)
+        assembler.begin("a", f"t2|x.bin|{len(self.data)}|{sha256_bytes(self.data)}")
+        assembler.chunk("a", chunk_payload("t2", self.data[:1000]))
+        assembler.detach("a")
+        assembler.resume("a", "t2")
+        assembler.chunk("a", chunk_payload("t2", bytes(len(self.data) - 1000)))  # Wrong bytes
+        with self.assertRaises(ValueError):
+            assembler.end("a", "t2")
+
+    def test_unknown_or_mismatched_resume_starts_over(self):
+        assembler = UploadAssembler(self.partial_dir)
+        self.assertEqual(assembler.resume("a", "t3", "x.bin", 100), 0)
+        assembler.chunk("a", chunk_payload("t3", b"y" * 50))
+        assembler.detach("a")
+        self.assertEqual(assembler.resume("a", "t3", "x.bin", 200), 0)  # Different file under the id
+
+    def test_oversized_and_invalid_transfers_are_refused(self):
+        assembler = UploadAssembler(self.partial_dir)
+        assembler.begin("a", "t4|x.bin|10")
+        with self.assertRaises(ValueError):
+            assembler.chunk("a", chunk_payload("t4", b"z" * 11))
+        self.assertEqual(os.listdir(self.partial_dir), [])
+        with self.assertRaises(ValueError):
+            assembler.begin("a", "../t5|x.bin|10")
+
+    def test_expire_removes_part_and_sidecar_together(self):
+        assembler = UploadAssembler(self.partial_dir, ttl=3600)
+        for transfer_id in ("old", "busy"):
+            assembler.begin("a", f"{transfer_id}|x.bin|100")
+            assembler.chunk("a", chunk_payload(transfer_id, b"q" * 10))
+        assembler.detach("a")
+        long_ago = time.time() - 7200
+        for name in ("old.part", "old.json", "busy.json"):
+            os.utime(os.path.join(self.partial_dir, name), (long_ago, long_ago))  # busy.part stays recent
+        assembler.last_sweep = 0
+        assembler.expire()
+        self.assertEqual(sorted(os.listdir(self.partial_dir)), ["busy.json", "busy.part"])
+        self.assertEqual(assembler.resume("b", "busy", "x.bin", 100), 10)
+
+
+class UploadQueueTest(unittest.TestCase):
+
+    def test_failed_resume_request_keeps_transfer_id(self):
+        def send_frame(frame):
+            raise ConnectionError("connection lost")
+
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(b"x" * 1000)
+        try:
+            queue = UploadQueue(send_frame)
+            queue.add([f.name])
+            queue.pending[0]['transfer_id'] = "abc123"  # Interrupted by an earlier disconnect
+            queue.await_features()
+            queue.server_features({'resume'})
+            deadline = time.time() + 5
+            while queue.connected and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertFalse(queue.connected)
+            self.assertEqual(queue.pending[0]['transfer_id'], "abc123")
+        finally:
+            os.remove(f.name)
+
+    def wait_for(self, sent, prefix, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            frames = [frame for frame in list(sent) if frame.startswith(prefix)]
+            if frames:
+                return frames
+            time.sleep(0.01)
+        self.fail(f"no {prefix!r} frame sent")
+
+    def test_reconnect_waits_for_server_features_before_resuming(self):
+        sent = []
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(b"z" * 1000)
+        try:
+            queue = UploadQueue(sent.append)
+            queue.add([f.name])
+            queue.await_features()
+            queue.server_features({'resume'})
+            transfer_id = self.wait_for(sent, b"IMAGE_END:")[0][10:].strip()
+            queue.suspend()  # Disconnected before IMAGE_DONE
+
+            # Reconnect: the HELLO reply comes some time after the connection is up
+            sent.clear()
+            queue.await_features()
+            time.sleep(0.2)
+            self.assertEqual(sent, [])
+            queue.server_features({'dedup', 'resume'})
+            resumed = self.wait_for(sent, b"IMAGE_RESUME:")
+            self.assertEqual(resumed[0].split(b"|")[0], b"IMAGE_RESUME:" + transfer_id)
+            self.assertFalse([frame for frame in sent if frame.startswith((b"IMAGE_BEGIN:", b"IMAGE_LINK:"))])
+        finally:
+            os.remove(f.name)
+
+    def test_uploads_start_without_a_features_reply_after_timeout(self):
+        sent = []
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(b"w" * 100)
+        try:
+            queue = UploadQueue(sent.append)
+            queue.add([f.name])
+            queue.await_features(timeout=0.1)  # A server from before HELLO and FEATURES never answers
+            self.wait_for(sent, b"IMAGE_BEGIN:")
+            self.assertFalse(queue.resumable)
+        finally:
+            os.remove(f.name)
+
+    def test_acknowledgement_before_run_returns_is_kept(self):
+        done = []
+
+        def send_frame(frame):
+            if frame.startswith(b"IMAGE_END:"):
+                # The reply overtakes the queue thread before it has moved the file in flight
+                queue.acknowledge(frame[10:].strip().decode('ascii'))
+
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(b"x" * 1000)
+        try:
+            queue = UploadQueue(send_frame, on_file_done=lambda status, path, message: done.append(status))
+            queue.add([f.name])
+            queue.await_features()
+            queue.server_features(set())
+            deadline = time.time() + 5
+            while not queue.idle() and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(queue.idle())
+            self.assertEqual(done, ['done'])
+            self.assertEqual(queue.stats()['files_done'], 1)
+        finally:
+            os.remove(f.name)
+
+    def test_unreadable_file_fails_and_queue_moves_on(self):
+        done = []
+        sent = []
+        paths = []
+        for _ in range(2):
+            with tempfile.NamedTemporaryFile(delete=False) as f:
+                f.write(b"y" * 100)
+            paths.append(f.name)
+        try:
+            queue = UploadQueue(sent.append, on_file_done=lambda status, path, message: done.append((status, path)))
+            queue.add(paths)
+            os.remove(paths[0])  # Gone between add() and its turn
+            queue.await_features()
+            queue.server_features(set())
+            deadline = time.time() + 5
+            while not any(frame.startswith(b"IMAGE_END:") for frame in sent) and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(done, [('error', paths[0])])
+            self.assertTrue(any(frame.startswith(b"IMAGE_END:") for frame in sent))
+            self.assertEqual(queue.stats()['files_failed'], 1)
+        finally:
+            os.remove(paths[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
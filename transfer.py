@@ -0,0 +1,677 @@
+import os
+import json
+import time
+import base64
+import threading
+import uuid
+from collections import deque, OrderedDict
+from content_cache import sha256_file
+
+# Chunked image upload protocol shared by the servers and GUI clients:
+#   IMAGE_BEGIN:<transfer_id>|<filename>|<size>
+#   IMAGE_CHUNK:<transfer_id>|<base64 chunk>
+#   IMAGE_END:<transfer_id>
+#   IMAGE_CANCEL:<transfer_id>
+# The server answers IMAGE_DONE:<transfer_id> or IMAGE_FAILED:<transfer_id>|<reason>.
+# Each frame is its own line, so other traffic can go out between chunks.
+#
+# Servers that answer FEATURES:dedup keep one copy per content, so a client can try first with
+#   IMAGE_LINK:<transfer_id>|<filename>|<size>|<sha256>
+# which the server answers with IMAGE_DONE (stored without an upload) or IMAGE_MISSING:<transfer_id>.
+#
+# Servers that answer FEATURES:resume keep partial transfers after a disconnect. On reconnecting the
+# client continues an upload with
+#   IMAGE_RESUME:<transfer_id>|<filename>|<size>
+# and the server answers IMAGE_OFFSET:<transfer_id>|<bytes it has> (0 if it has forgotten it) or
+# IMAGE_DONE if the transfer had completed. Chunks and IMAGE_END then follow as usual.
+#
+# Downloads use the same framing in the other direction for clients that sent FEATURES:chunked:
+#   SERVER_IMAGE_BEGIN:<transfer_id>|<filename>|<size>
+#   SERVER_IMAGE_CHUNK:<transfer_id>|<base64 chunk>
+#   SERVER_IMAGE_END:<transfer_id>
+# and the client reassembles them with an UploadAssembler. For clients that sent FEATURES:resume
+# the BEGIN frame also carries the file's sha256, and after a disconnect the client asks for the rest:
+#   SERVER_IMAGE_RESUME:<transfer_id>|<filename>|<sha256>|<offset>
+# The server sends the remaining chunks and END under the same id, or SERVER_IMAGE_CANCEL:<transfer_id>|<reason>
+# if that content is no longer available.
+
+CHUNK_SIZE = 256 * 1024  # Raw bytes per IMAGE_CHUNK frame
+# Raw bytes per SERVER_IMAGE_CHUNK frame; small so text frames can be sent between chunks
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+PARTIAL_TTL = 6 * 3600  # Seconds an interrupted transfer stays resumable
+RESUME_TIMEOUT = 15.0  # Seconds to wait for IMAGE_OFFSET before uploading from the start
+FEATURES_TIMEOUT = 5.0  # Seconds to wait for the server's HELLO/FEATURES reply before uploading without it
+
+
+def server_image_frames(path, filename, chunk_size=DOWNLOAD_CHUNK_SIZE, digest=None,
+                        transfer_id=None, offset=None):
+    """SERVER_IMAGE_BEGIN/CHUNK/END frames for one file, read lazily as they are sent.
+    With an offset, the rest of an earlier transfer_id: no BEGIN, chunks from that byte on."""
+    transfer_id = transfer_id or uuid.uuid4().hex[:12]
+    with open(path, 'rb') as f:
+        if offset is None:
+            size = os.fstat(f.fileno()).st_size
+            hash_field = f"|{digest}" if digest else ""
+            yield f"SERVER_IMAGE_BEGIN:{transfer_id}|{filename}|{size}{hash_field}\n".encode('utf-8')
+        else:
+            f.seek(offset)
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield b"SERVER_IMAGE_CHUNK:" + transfer_id.encode('ascii') + b"|" + base64.b64encode(chunk) + b"\n"
+    yield f"SERVER_IMAGE_END:{transfer_id}\n".encode('utf-8')
+
+
+class UploadAssembler:
+    """Reassemble chunked transfers into files under partial_dir (server uploads, client downloads).
+
+    Each transfer is a <transfer_id>.part file with a .json sidecar. When its connection drops the
+    files stay on disk, so the transfer can be resumed from their size, even after a restart,
+    until they are older than ttl seconds.
+    """
+
+    def __init__(self, partial_dir, ttl=PARTIAL_TTL):
+        self.partial_dir = partial_dir
+        self.ttl = ttl
+        self.uploads = {}  # transfer_id -> state, while a connection owns the transfer
+        # Recently finished ids: a resume after a lost IMAGE_DONE is acknowledged, not re-sent
+        self.completed = OrderedDict()
+        self.last_sweep = 0.0
+        self.lock = threading.Lock()
+        os.makedirs(partial_dir, exist_ok=True)
+
+    def paths(self, transfer_id):
+        # Ids come from the peer and end up in file names
+        if not transfer_id.isalnum() or len(transfer_id) > 64:
+            raise ValueError(f"Invalid transfer id {transfer_id[:64]!r}")
+        base = os.path.join(self.partial_dir, transfer_id)
+        return base + ".part", base + ".json"
+
+    def begin(self, client_address, payload):
+        fields = payload.split('|')
+        transfer_id, filename, size = fields[:3]
+        meta = {'filename': os.path.basename(filename), 'size': int(size),
+                'sha256': fields[3] if len(fields) > 3 else ''}
+        path, meta_path = self.paths(transfer_id)
+        self.expire()
+        with self.lock:
+            if transfer_id in self.uploads:
+                raise ValueError(f"Transfer {transfer_id} already in progress")
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            self.uploads[transfer_id] = self.open_state(client_address, transfer_id, meta, 'wb')
+        return transfer_id
+
+    def open_state(self, client_address, transfer_id, meta, mode):
+        path, _ = self.paths(transfer_id)
+        upload = dict(meta, owner=client_address, path=path, file=open(path, mode), started=time.time())
+        upload['received'] = upload['resumed_from'] = os.path.getsize(path)
+        return upload
+
+    def resume(self, client_address, transfer_id, filename=None, size=None):
+        """Reattach a transfer to a (new) connection; returns the bytes already received, or None if it
+        has completed. An unknown or expired id starts over at 0 when filename and size are given."""
+        path, meta_path = self.paths(transfer_id)
+        with self.lock:
+            if transfer_id in self.completed:
+                return None
+            upload = self.uploads.pop(transfer_id, None)
+        if upload:
+            upload['file'].close()  # Taken over from a connection that hasn't noticed it is dead
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = None
+        if meta is None or not os.path.exists(path) or (size is not None and meta['size'] != int(size)):
+            if filename is None:
+                raise ValueError(f"Unknown transfer {transfer_id}")
+            self.begin(client_address, f"{transfer_id}|{filename}|{size}")
+            return 0
+        upload = self.open_state(client_address, transfer_id, meta, 'ab')
+        with self.lock:
+            self.uploads[transfer_id] = upload
+        return upload['received']
+
+    def chunk(self, client_address, payload):
+        transfer_id, data = payload.split('|', 1)
+        upload = self.get(client_address, transfer_id)
+        chunk = base64.b64decode(data)
+        if upload['received'] + len(chunk) > upload['size']:
+            self.cancel(client_address, transfer_id)
+            raise ValueError(f"Transfer {transfer_id} exceeded its declared size")
+        upload['file'].write(chunk)
+        upload['received'] += len(chunk)
+        return upload['received']
+
+    def end(self, client_address, transfer_id):
+        """Close a completed upload and return (filename, temp_path, size)"""
+        upload = self.get(client_address, transfer_id)
+        with self.lock:
+            self.uploads.pop(transfer_id, None)
+        upload['file'].close()
+        _, meta_path = self.paths(transfer_id)
+        os.remove(meta_path)
+        if upload['received'] != upload['size']:
+            os.remove(upload['path'])
+            raise ValueError(f"Transfer {transfer_id} incomplete: {upload['received']}/{upload['size']} bytes")
+        if upload['sha256'] and upload['resumed_from'] and sha256_file(upload['path']) != upload['sha256']:
+            os.remove(upload['path'])
+            raise ValueError(f"Transfer {transfer_id} failed its checksum after resuming")
+        with self.lock:
+            self.completed[transfer_id] = time.time()
+            while len(self.completed) > 1000:
+                self.completed.popitem(last=False)
+        elapsed = max(time.time() - upload['started'], 1e-6)
+        sent = upload['size'] - upload['resumed_from']
+        resumed = f" (resumed at {upload['resumed_from']})" if upload['resumed_from'] else ""
+        print(f"Upload {transfer_id} complete: {upload['size']} bytes{resumed} at {sent / elapsed / 1e6:.2f} MB/s")
+        return upload['filename'], upload['path'], upload['size']
+
+    def cancel(self, client_address, transfer_id):
+        with self.lock:
+            upload = self.uploads.pop(transfer_id, None)
+        if upload:
+            upload['file'].close()
+        for path in self.paths(transfer_id):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def detach(self, client_address):
+        """Connection gone: close its transfers but keep them on disk for resume()"""
+        with self.lock:
+            detached = [self.uploads.pop(transfer_id) for transfer_id, upload in list(self.uploads.items())
+                        if upload['owner'] == client_address]
+        for upload in detached:
+            upload['file'].close()
+
+    def partials(self):
+        """Detached transfers on disk: [(transfer_id, meta, bytes_received)]"""
+        found = []
+        for name in os.listdir(self.partial_dir):
+            transfer_id, ext = os.path.splitext(name)
+            if ext != '.json' or transfer_id in self.uploads:
+                continue
+            path, meta_path = self.paths(transfer_id)
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    found.append((transfer_id, json.load(f), os.path.getsize(path)))
+            except (OSError, ValueError):
+                continue
+        return found
+
+    def expire(self):
+        """Delete detached transfers untouched for ttl; runs at most once a minute.
+        The .part and .json go together, by the newer mtime: the sidecar is only written at begin."""
+        now = time.time()
+        if now - self.last_sweep < 60:
+            return
+        self.last_sweep = now
+        for transfer_id in {os.path.splitext(name)[0] for name in os.listdir(self.partial_dir)}:
+            if transfer_id in self.uploads:
+                continue
+            try:
+                paths = self.paths(transfer_id)
+            except ValueError:
+                continue
+            mtimes = [os.path.getmtime(path) for path in paths if os.path.exists(path)]
+            if mtimes and now - max(mtimes) > self.ttl:
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def get(self, client_address, transfer_id):
+        with self.lock:
+            upload = self.uploads.get(transfer_id)
+        if upload is None or upload['owner'] != client_address:
+            raise ValueError(f"Unknown transfer {transfer_id}")
+        return upload
+
+
+class Upload:
+    """Client side: stream one file as chunk frames on a background thread"""
+
+    def __init__(self, path, send_frame, on_progress=None, on_done=None,
+                 chunk_size=CHUNK_SIZE, filename=None, transfer_id=None, offset=None):
+        self.path = path
+        self.filename = filename or os.path.basename(path)
+        self.send_frame = send_frame  # Sends one complete frame (bytes); must be thread-safe
+        self.on_progress = on_progress  # (sent_bytes, total_bytes, bytes_per_second)
+        self.on_done = on_done  # (status, message) with status 'done', 'cancelled' or 'error'
+        self.chunk_size = chunk_size
+        self.transfer_id = transfer_id or uuid.uuid4().hex[:12]
+        self.offset = offset  # Resuming: bytes the server already has, sent without IMAGE_BEGIN
+        self.cancelled = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        try:
+            total = os.path.getsize(self.path)
+            if self.offset is None:
+                self.send_frame(f"IMAGE_BEGIN:{self.transfer_id}|{self.filename}|{total}\n".encode('utf-8'))
+            sent = resumed_from = self.offset or 0
+            started = last_report = time.time()
+            with open(self.path, 'rb') as f:
+                f.seek(sent)
+                while True:
+                    if self.cancelled.is_set():
+                        self.send_frame(f"IMAGE_CANCEL:{self.transfer_id}\n".encode('utf-8'))
+                        self.finish('cancelled', f"Upload cancelled: {self.filename}")
+                        return
+                    chunk = f.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    frame = b"IMAGE_CHUNK:" + self.transfer_id.encode('ascii') + b"|" + base64.b64encode(chunk) + b"\n"
+                    self.send_frame(frame)
+                    sent += len(chunk)
+                    now = time.time()
+                    if self.on_progress and (now - last_report >= 0.1 or sent == total):
+                        last_report = now
+                        self.on_progress(sent, total, (sent - resumed_from) / max(now - started, 1e-6))
+            self.send_frame(f"IMAGE_END:{self.transfer_id}\n".encode('utf-8'))
+            elapsed = max(time.time() - started, 1e-6)
+            resumed = f", resumed at {resumed_from}" if resumed_from else ""
+            self.finish('done', f"{self.filename} ({total} bytes{resumed}, "
+                                f"{(total - resumed_from) / elapsed / 1e6:.2f} MB/s)")
+        except Exception as e:
+            self.finish('error', str(e))
+
+    def finish(self, status, message):
+        if self.on_done:
+            self.on_done(status, message)
+
+
+class UploadQueue:
+    """Client side: stream queued files back to back, keeping up to max_in_flight unacknowledged"""
+
+    def __init__(self, send_frame, max_in_flight=4, on_progress=None, on_file_done=None,
+                 chunk_size=CHUNK_SIZE, prepare=None):
+        self.send_frame = send_frame
+        self.max_in_flight = max_in_flight
+        self.on_progress = on_progress  # (stats dict) from stats()
+        self.on_file_done = on_file_done  # (status, path, message)
+        self.chunk_size = chunk_size
+        # Optional prepare(path) -> (send_path, filename), run on the queue thread before streaming
+        self.prepare = prepare
+        self.pending = deque()  # Entries waiting to be streamed
+        self.in_flight = {}  # transfer_id -> entry, streamed but not yet acknowledged
+        self.current = None
+        self.current_sent = 0
+        self.connected = False  # Set by resume() once a connection is up
+        self.session = 0  # Counts connections, so a fallback timer from an earlier one does nothing
+        self.dedup = False  # Server answered FEATURES:dedup: offer each file's hash before uploading it
+        self.resumable = False  # Server answered FEATURES:resume: interrupted uploads continue where they stopped
+        self.offset_waiters = {}  # transfer_id -> {'event', 'offset'} while an IMAGE_RESUME is unanswered
+        # IMAGE_DONE/IMAGE_FAILED that beat the end of run() for the file being streamed:
+        # transfer_id -> (status, reason)
+        self.early_replies = {}
+        self.cond = threading.Condition()
+        self.reset_stats()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def reset_stats(self):
+        self.files_total = self.files_done = self.files_failed = 0
+        self.bytes_total = self.bytes_sent = self.bytes_saved = 0
+        self.files_linked = self.bytes_linked = 0  # Not uploaded: the server already had the content
+        self.started = None
+
+    def add(self, paths):
+        """Queue files for upload; returns how many were added"""
+        added = 0
+        with self.cond:
+            if self.idle():
+                self.reset_stats()
+            for path in paths:
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                # send_path/size change once prepare() has produced the bytes to put on the wire
+                self.pending.append({'path': path, 'size': size, 'send_path': None, 'filename': None,
+                                     'checked': False, 'linking': False, 'transfer_id': None})
+                self.files_total += 1
+                self.bytes_total += size
+                added += 1
+            self.cond.notify_all()
+        return added
+
+    def idle(self):
+        return not (self.pending or self.in_flight or self.current)
+
+    def send(self, frame):
+        self.send_frame(frame)
+
+    def prepare_entry(self, entry):
+        """Run prepare() once per entry; a re-queued entry keeps its prepared file.
+        OSError if the file can no longer be read"""
+        if entry['send_path']:
+            return
+        send_path, filename = entry['path'], None
+        if self.prepare:
+            try:
+                send_path, filename = self.prepare(entry['path'])
+            except Exception as e:
+                print(f"Preprocessing failed for {entry['path']}, sending original: {e}")
+        send_size = os.path.getsize(send_path)
+        with self.cond:
+            self.bytes_total += send_size - entry['size']
+            self.bytes_saved += entry['size'] - send_size
+        entry.update(send_path=send_path, filename=filename, size=send_size)
+
+    def release(self, entry):
+        """Delete a temporary prepared file once it is no longer needed"""
+        if entry['send_path'] and entry['send_path'] != entry['path']:
+            try:
+                os.remove(entry['send_path'])
+            except OSError:
+                pass
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not (self.connected and self.pending and len(self.in_flight) < self.max_in_flight):
+                    self.cond.wait()
+                entry = self.pending.popleft()
+                if self.started is None:
+                    self.started = time.time()
+                self.current, self.current_sent = entry, 0
+
+            try:
+                self.prepare_entry(entry)
+            except OSError as e:
+                self.give_up(entry, str(e))
+                continue
+            if self.dedup and not entry['checked'] and not entry['transfer_id'] and self.offer_hash(entry):
+                continue
+            offset = None
+            if entry['transfer_id'] and self.resumable:
+                offset = self.request_offset(entry)
+                if offset == 'done':
+                    self.complete(entry)  # Finished before the disconnect; only the IMAGE_DONE was lost
+                    continue
+                if offset == 'unsent':
+                    # Connection trouble: keep the transfer_id so the next connection resumes it
+                    with self.cond:
+                        self.current, self.current_sent = None, 0
+                        self.pending.appendleft(entry)
+                        self.connected = False
+                    continue
+            result = []
+            upload = Upload(entry['send_path'], self.send, on_progress=self.file_progress,
+                            on_done=lambda status, message: result.append((status, message)),
+                            chunk_size=self.chunk_size, filename=entry['filename'],
+                            transfer_id=entry['transfer_id'] if offset is not None else None, offset=offset)
+            entry['transfer_id'] = upload.transfer_id
+            with self.cond:
+                if self.current is None:  # Cancelled while preparing
+                    upload.cancel()
+                self.current = upload
+            upload.run()  # Streams every chunk; the server acknowledges asynchronously
+            status, message = result[0]
+
+            requeued = status == 'error' and os.path.exists(entry['send_path'])
+            with self.cond:
+                self.current, self.current_sent = None, 0
+                early = self.early_replies.pop(upload.transfer_id, None)
+                if status == 'done':
+                    self.in_flight[upload.transfer_id] = entry
+                    self.bytes_sent += entry['size']
+                elif requeued:
+                    # Connection trouble: keep the file at the front for resume()
+                    self.pending.appendleft(entry)
+                    self.connected = False
+                elif status == 'cancelled':
+                    self.files_total -= 1
+                    self.bytes_total -= entry['size']
+                else:
+                    self.files_failed += 1
+            if status != 'done' and not requeued:
+                self.release(entry)
+                if self.on_file_done:
+                    self.on_file_done(status, entry['path'], message)
+            elif status == 'done' and early:
+                early_status, reason = early
+                if early_status == 'done':
+                    self.acknowledge(upload.transfer_id)
+                else:
+                    self.fail(upload.transfer_id, reason)
+            self.report()
+
+    def give_up(self, entry, message):
+        """Fail an entry before it was streamed and move on to the next"""
+        with self.cond:
+            self.current, self.current_sent = None, 0
+            self.files_failed += 1
+        self.release(entry)
+        if self.on_file_done:
+            self.on_file_done('error', entry['path'], message)
+        self.report()
+
+    def early_reply(self, transfer_id, status, reason=None):
+        """Keep a reply for the file still being streamed; run() applies it once the file is in flight"""
+        with self.cond:
+            if isinstance(self.current, Upload) and self.current.transfer_id == transfer_id:
+                self.early_replies[transfer_id] = (status, reason)
+                return True
+        return False
+
+    def offer_hash(self, entry):
+        """Send IMAGE_LINK instead of the file; the answer decides whether it is uploaded after all"""
+        transfer_id = uuid.uuid4().hex[:12]
+        filename = entry['filename'] or os.path.basename(entry['path'])
+        try:
+            digest = sha256_file(entry['send_path'])
+        except OSError:
+            return False
+        with self.cond:
+            entry.update(checked=True, linking=True)
+            self.in_flight[transfer_id] = entry
+            self.current = None
+        try:
+            self.send(f"IMAGE_LINK:{transfer_id}|{filename}|{entry['size']}|{digest}\n".encode('utf-8'))
+        except Exception:
+            # Connection trouble: the entry waits in flight and suspend() puts it back
+            with self.cond:
+                self.connected = False
+        return True
+
+    def request_offset(self, entry):
+        """IMAGE_RESUME for an interrupted upload: bytes the server has, 'done', None to start over,
+        or 'unsent' if the request couldn't be sent"""
+        transfer_id = entry['transfer_id']
+        waiter = {'event': threading.Event(), 'offset': None}
+        with self.cond:
+            self.offset_waiters[transfer_id] = waiter
+        try:
+            filename = entry['filename'] or os.path.basename(entry['path'])
+            self.send(f"IMAGE_RESUME:{transfer_id}|{filename}|{entry['size']}\n".encode('utf-8'))
+            waiter['event'].wait(RESUME_TIMEOUT)
+        except Exception:
+            waiter['offset'] = 'unsent'
+        with self.cond:
+            self.offset_waiters.pop(transfer_id, None)
+        return waiter['offset']
+
+    def offset_reply(self, transfer_id, offset):
+        """IMAGE_OFFSET from the server"""
+        self.answer_resume(transfer_id, int(offset))
+
+    def answer_resume(self, transfer_id, offset):
+        with self.cond:
+            waiter = self.offset_waiters.get(transfer_id)
+        if waiter:
+            waiter['offset'] = offset
+            waiter['event'].set()
+        return waiter is not None
+
+    def complete(self, entry):
+        with self.cond:
+            self.current, self.current_sent = None, 0
+            self.files_done += 1
+            self.bytes_sent += entry['size']
+        self.release(entry)
+        if self.on_file_done:
+            self.on_file_done('done', entry['path'], os.path.basename(entry['path']))
+        self.report()
+
+    def missing(self, transfer_id):
+        """Server doesn't have the content (IMAGE_MISSING): upload the file next"""
+        with self.cond:
+            entry = self.in_flight.pop(transfer_id, None)
+            if entry:
+                entry['linking'] = False
+                self.pending.appendleft(entry)
+            self.cond.notify_all()
+
+    def file_progress(self, sent, total, rate):
+        self.current_sent = sent
+        self.report()
+
+    def acknowledge(self, transfer_id):
+        """Server stored the file (IMAGE_DONE)"""
+        if self.answer_resume(transfer_id, 'done'):
+            return
+        with self.cond:
+            entry = self.in_flight.pop(transfer_id, None)
+            if entry is None and self.early_reply(transfer_id, 'done'):
+                return
+            if entry:
+                self.files_done += 1
+                if entry['linking']:
+                    self.files_linked += 1
+                    self.bytes_linked += entry['size']
+                    self.bytes_sent += entry['size']
+            self.cond.notify_all()
+        if entry:
+            self.release(entry)
+            if self.on_file_done:
+                self.on_file_done('done', entry['path'], os.path.basename(entry['path']))
+            self.report()
+
+    def fail(self, transfer_id, reason):
+        """Server rejected the file (IMAGE_FAILED)"""
+        if self.answer_resume(transfer_id, None):
+            return  # It couldn't resume this one; the file is uploaded again from the start
+        with self.cond:
+            entry = self.in_flight.pop(transfer_id, None)
+            if entry is None and self.early_reply(transfer_id, 'error', reason):
+                return
+            if entry:
+                self.files_failed += 1
+            self.cond.notify_all()
+        if entry:
+            self.release(entry)
+            if self.on_file_done:
+                self.on_file_done('error', entry['path'], reason)
+            self.report()
+
+    def suspend(self):
+        """Connection lost: unacknowledged files go back to the front of the queue"""
+        with self.cond:
+            self.connected = False
+            self.session += 1
+            # The next server may not support these; it says so after connecting
+            self.dedup = self.resumable = False
+            for entry in reversed(list(self.in_flight.values())):
+                self.pending.appendleft(entry)
+                if entry['linking']:
+                    entry.update(checked=False, linking=False)
+                else:
+                    self.bytes_sent -= entry['size']  # Resumed (or re-sent) under its transfer_id
+            self.in_flight.clear()
+
+    def resume(self, send_frame=None):
+        """Connection (re)established: continue with whatever is still queued"""
+        with self.cond:
+            if send_frame:
+                self.send_frame = send_frame
+            self.connected = True
+            self.cond.notify_all()
+
+    def await_features(self, timeout=FEATURES_TIMEOUT):
+        """Connection up, features not yet known: hold uploads until server_features(), or for timeout
+        seconds from servers too old to answer HELLO or FEATURES"""
+        with self.cond:
+            self.session += 1
+            session = self.session
+        timer = threading.Timer(timeout, self.features_timeout, (session,))
+        timer.daemon = True
+        timer.start()
+
+    def features_timeout(self, session):
+        with self.cond:
+            if session != self.session or self.connected:
+                return
+            print("No HELLO or FEATURES reply from the server; uploading without dedup or resume")
+            self.resume()
+
+    def server_features(self, features):
+        """The server's HELLO or FEATURES reply: use what it supports and start uploading"""
+        with self.cond:
+            self.dedup = 'dedup' in features
+            self.resumable = 'resume' in features
+            self.resume()
+
+    def cancel(self):
+        """Drop queued files and abort the one being streamed"""
+        with self.cond:
+            for entry in self.pending:
+                self.files_total -= 1
+                self.bytes_total -= entry['size']
+                self.release(entry)
+            self.pending.clear()
+            if isinstance(self.current, Upload):
+                self.current.cancel()
+            else:
+                self.current = None  # Still preparing: run() cancels it before streaming
+        self.report()
+
+    def stats(self):
+        with self.cond:
+            sent = self.bytes_sent + self.current_sent
+            elapsed = time.time() - self.started if self.started else 0
+            rate = sent / elapsed if elapsed > 0 else 0.0
+            return {
+                'files_total': self.files_total,
+                'files_done': self.files_done,
+                'files_failed': self.files_failed,
+                'in_flight': len(self.in_flight),
+                'bytes_total': self.bytes_total,
+                'bytes_sent': sent,
+                'bytes_saved': self.bytes_saved,
+                'files_linked': self.files_linked,
+                'bytes_linked': self.bytes_linked,
+                'rate': rate,
+                'eta': (self.bytes_total - sent) / rate if rate > 0 else None,
+                'active': not self.idle(),
+            }
+
+    def report(self):
+        if self.on_progress:
+            self.on_progress(self.stats())
+
+
+def format_queue_stats(stats):
+    """One-line summary of UploadQueue.stats() for the GUI"""
+    if not stats['active']:
+        return ""
+    eta = stats['eta']
+    eta_text = f"{int(eta // 60)}m{int(eta % 60):02d}s" if eta is not None else "--"
+    return (f"{stats['files_done']}/{stats['files_total']} files  "
+            f"{stats['bytes_sent'] / 1e6:.1f}/{stats['bytes_total'] / 1e6:.1f} MB  "
+            f"{stats['rate'] / 1e6:.2f} MB/s  ETA {eta_text}"
+            + (f"  saved {stats['bytes_saved'] / 1e6:.1f} MB" if stats['bytes_saved'] > 0 else "")
+            + (f"  {stats['files_linked']} already on server" if stats['files_linked'] else ""))